@@ -17,6 +17,12 @@ def create_app() -> Flask:
         SQLALCHEMY_TRACK_MODIFICATIONS=False,
         REMEMBER_COOKIE_DURATION=60 * 60 * 24 * 30,  # 30 дней
         UPLOAD_FOLDER=os.environ.get("UPLOAD_FOLDER", "generated_kp"),
+        # раскладка папки с КП (как у бота): flat | date | hash — см. kp_bot/kpfiles.py
+        KP_STORAGE_LAYOUT=os.environ.get("KP_STORAGE_LAYOUT", "flat"),
+        # PDF: пул процессов xhtml2pdf и кеш готовых PDF по sha256 HTML (общий код с ботом)
+        KP_PDF_WORKERS=int(os.environ.get("KP_PDF_WORKERS", "2")),
+        KP_PDF_CACHE=os.environ.get("KP_PDF_CACHE", os.path.join("instance", "pdf_cache")),
+        KP_PDF_FONT=os.environ.get("KP_PDF_FONT", ""),
     )
 
     db.init_app(app)
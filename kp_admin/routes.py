@@ -1,5 +1,6 @@
 import os
 import re
+import time
 from datetime import datetime, timedelta
 from io import StringIO, BytesIO
 import csv
@@ -9,10 +10,12 @@ from flask import (
     redirect, url_for, send_file, flash, Response, abort
 )
 from flask_login import login_required, current_user, login_user, logout_user
+from werkzeug.security import safe_join
 
 from . import db
 from .models import KPFile, Lead, User
 from .utils import parse_kp_file_meta
+from kp_bot.kpfiles import iter_kp_files
 
 # NEW: для Excel
 from openpyxl import Workbook
@@ -27,6 +30,14 @@ def uploads_folder() -> str:
         os.path.join(current_app.root_path, "..", current_app.config["UPLOAD_FOLDER"])
     )
 
+def kp_file_path(kpf: KPFile) -> str | None:
+    """Абсолютный путь файла КП; filename может содержать подпапки раскладки ("2025/09/09/KP_...html")."""
+    return safe_join(uploads_folder(), kpf.filename)
+
+def _rescan_stamp_path() -> str:
+    os.makedirs(current_app.instance_path, exist_ok=True)
+    return os.path.join(current_app.instance_path, "kp_rescan.stamp")
+
 def paginate(query, per_page: int = 20):
     page = max(int(request.args.get("page", 1) or 1), 1)
     total = query.count()
@@ -101,24 +112,44 @@ def get_or_create_lead(meta: dict) -> Lead:
             lead.name = meta["name"]
     return lead
 
-def rescan_new_files(silent: bool = True) -> int:
+def rescan_new_files(silent: bool = True, full: bool = False) -> int:
+    """
+    Добавить в БД КП, которых там ещё нет. По умолчанию инкрементально: в
+    разложенной по папкам раскладке смотрим только папки, изменившиеся с
+    прошлого скана; full=True — обойти всё.
+    """
     folder = uploads_folder()
     os.makedirs(folder, exist_ok=True)
 
-    all_files = [f for f in os.listdir(folder) if f.lower().endswith((".html", ".htm"))]
+    stamp = _rescan_stamp_path()
+    since = 0.0
+    if not full and os.path.exists(stamp):
+        since = os.path.getmtime(stamp) - 2  # запас на грубую точность mtime
+    started = time.time()
+
+    all_files = list(iter_kp_files(folder, current_app.config.get("KP_STORAGE_LAYOUT", "flat"), since=since))
+    known = set()
+    for i in range(0, len(all_files), 500):  # одним запросом на пачку, а не по запросу на файл
+        chunk = all_files[i:i + 500]
+        known.update(fn for (fn,) in db.session.query(KPFile.filename).filter(KPFile.filename.in_(chunk)))
     added = 0
 
     for name in sorted(all_files):
-        if KPFile.query.filter_by(filename=name).first():
+        if name in known:
+            continue
+        path = os.path.join(folder, *name.split("/"))
+        try:
+            if os.path.getsize(path) == 0:
+                continue    # заглушка reserve_kp_name: бот ещё пишет КП, добавим следующим сканом
+        except OSError:
             continue
-        path = os.path.join(folder, name)
 
         try:
             meta = (parse_kp_file_meta(path) or {})
         except Exception:
             meta = {}
 
-        fb = _fallback_from_filename(name)
+        fb = _fallback_from_filename(os.path.basename(name))
         if fb.get("phone") and not meta.get("phone"):
             meta["phone"] = fb["phone"]
         meta["username"] = _sanitize_username(meta.get("username"))
@@ -144,6 +175,9 @@ def rescan_new_files(silent: bool = True) -> int:
 
     if added:
         db.session.commit()
+    with open(stamp, "w", encoding="utf-8"):
+        pass
+    os.utime(stamp, (started, started))
 
     if not silent:
         flash(f"Сканирую: {uploads_folder()}", "info")
@@ -222,7 +256,7 @@ def kp_list():
 @bp.route("/kp/rescan", methods=["POST", "GET"], endpoint="kp_rescan")
 @login_required
 def kp_rescan():
-    rescan_new_files(silent=False)
+    rescan_new_files(silent=False, full=bool(request.args.get("full")))
     return redirect(url_for("kp.kp_list", **request.args))
 
 # ---- CSV (улучшено: ; и заголовки на русском) ----
@@ -357,16 +391,16 @@ def kp_xlsx():
 @login_required
 def kp_download(id: int):
     kpf = KPFile.query.get_or_404(id)
-    path = os.path.join(uploads_folder(), kpf.filename)
-    if not os.path.exists(path):
+    path = kp_file_path(kpf)
+    if not path or not os.path.exists(path):
         abort(404, "Файл не найден на диске")
-    return send_file(path, as_attachment=True, download_name=kpf.filename, mimetype="text/html")
+    return send_file(path, as_attachment=True, download_name=os.path.basename(kpf.filename), mimetype="text/html")
 
 @bp.route("/kp/<int:id>/preview", endpoint="kp_preview")
 @login_required
 def kp_preview(id: int):
     kpf = KPFile.query.get_or_404(id)
-    path = os.path.join(uploads_folder(), kpf.filename)
-    if not os.path.exists(path):
+    path = kp_file_path(kpf)
+    if not path or not os.path.exists(path):
         abort(404, "Файл не найден на диске")
     return send_file(path, as_attachment=False, mimetype="text/html")
@@ -1,3 +1,4 @@
+import os
 import re
 from kp_admin import create_app, db
 from kp_admin.models import KPFile
@@ -15,7 +16,7 @@ def sanitize_username(u):
 FN_PHONE = re.compile(r"^KP_(\d{11,12})_", re.IGNORECASE)
 
 def phone_from_filename(fn):
-    m = FN_PHONE.match(fn or "")
+    m = FN_PHONE.match(os.path.basename(fn or ""))  # filename может быть с подпапками раскладки
     if m:
         return "+" + m.group(1)
     return None
@@ -1,9 +1,15 @@
 # kp_admin/utils.py
 from __future__ import annotations
+import os
 import re
+import threading
 import html as ihtml
 from typing import Optional
 
+from flask import current_app
+
+from kp_bot.pdf import PdfError, PdfRenderer
+
 # Телефон: допускаем пробелы/скобки/дефисы, берём 10–15 цифр
 PHONE_RE = re.compile(
     r"(?:тел(?:ефон)?\s*[:\-]?\s*)?(\+?\d[\d\-\s().]{7,}\d)",
@@ -107,3 +113,34 @@ def parse_kp_file_meta(path: str) -> dict:
         "name": name,
         # "chat_id": можно доставать, если ты где-то его пишешь в HTML
     }
+
+
+# ---------- PDF (общий с ботом пул xhtml2pdf, см. kp_bot/pdf.py) ----------
+_pdf: Optional[PdfRenderer] = None
+_pdf_lock = threading.Lock()
+
+def pdf_renderer() -> PdfRenderer:
+    """Пул рендера на процесс админки: создаётся при первом PDF, процессы живут дальше."""
+    global _pdf
+    with _pdf_lock:
+        if _pdf is None:
+            cfg = current_app.config
+            _pdf = PdfRenderer(
+                workers=cfg.get("KP_PDF_WORKERS", 2),
+                cache_dir=cfg.get("KP_PDF_CACHE", ""),
+                font=cfg.get("KP_PDF_FONT") or None,
+            )
+        return _pdf
+
+def save_html_as_pdf(html: str, out_path: str) -> bool:
+    """HTML -> PDF через пул (с кешем по sha256 HTML). Returns True/False."""
+    try:
+        data = pdf_renderer().render(html)
+    except PdfError:
+        current_app.logger.exception("pdf render failed")
+        return False
+    tmp = out_path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, out_path)
+    return True
@@ -0,0 +1,2 @@
+# kp_bot/__init__.py
+"""Инфраструктура Telegram-бота КП (main.py): хранение сессий и т.п."""
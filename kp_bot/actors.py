@@ -0,0 +1,209 @@
+# kp_bot/actors.py
+"""
+Последовательная обработка апдейтов одного чата при параллельной — разных.
+
+Хендлеры меняют USER[ch] (idx, flow, выбор мультивыбора) без блокировок.
+Пока апдейты одного чата могли выполняться одновременно (воркеры TeleBot,
+пул WebhookServer, gather в AsyncTeleBot), быстрый двойной тап «Готово»
+проходил два шага, а текст, отправленный сразу за нажатием кнопки, мог
+попасть в хендлер старого состояния.
+
+ChatDispatcher — «актор» на каждый chat_id:
+
+- у чата своя очередь (не длиннее max_per_chat; сверх — апдейт отбрасывается
+  и считается в dropped), задачи чата выполняются строго по одной и по порядку;
+- чаты с задачами стоят в общей очереди готовых; parallelism воркеров берут
+  оттуда чат, выполняют ОДНУ его задачу и возвращают чат в конец очереди,
+  если у него есть ещё — болтливый чат не занимает воркер надолго;
+- задача — функция или корутинная функция: в sync-режиме воркеры — потоки
+  (корутину доводит до конца runtime.run_sync), в async — задачи event
+  loop'а, параллелизм ограничен семафором.
+
+Фильтр состояний telebot тоже выполняется внутри задачи: апдейт целиком
+(выбор хендлера + хендлер) видит результат предыдущего апдейта своего чата.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Hashable, List, Optional
+
+from . import runtime
+
+log = logging.getLogger("kp-bot-actors")
+
+
+class ChatDispatcher:
+    def __init__(self, parallelism: int = 8, max_per_chat: int = 20, name: str = "chats",
+                 observer: Optional[Callable[[float], None]] = None):
+        self.name = name
+        self.observer = observer            # observer(сек. от submit до конца задачи), например LoadShedder.observe
+        self.parallelism = max(1, int(parallelism))
+        self.max_per_chat = max(1, int(max_per_chat))
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._queues: Dict[Hashable, Deque[tuple]] = {}   # чаты, у которых есть задачи (в т.ч. выполняемая)
+        self._ready: Deque[Hashable] = deque()            # чаты, ждущие воркера
+        self._threads: List[threading.Thread] = []
+        self._sem: Optional[asyncio.Semaphore] = None
+        self._stop = False
+        self._wait = deque(maxlen=2000)     # ожидание в очереди, сек
+        self._run = deque(maxlen=2000)      # выполнение, сек
+
+        self.running = 0
+        self.backlog = 0                    # задач в очередях чатов (с выполняемыми)
+        self.submitted = 0
+        self.dropped = 0
+        self.done = 0
+        self.failed = 0
+        self.max_depth = 0                  # самая длинная очередь одного чата за всё время
+
+    def submit(self, key: Hashable, fn: Callable, *args) -> bool:
+        """Поставить fn(*args) в очередь чата key. False — очередь чата заполнена."""
+        in_loop = runtime.MODE == "async" and runtime.LOOP is not None
+        with self._lock:
+            q = self._queues.get(key)
+            if q is None:
+                q = self._queues[key] = deque()
+                schedule = True
+            else:
+                schedule = False
+                if len(q) >= self.max_per_chat:
+                    self.dropped += 1
+                    log.warning(f"{self.name}: chat {key} queue full ({self.max_per_chat}), update dropped")
+                    return False
+            q.append((time.monotonic(), fn, args))
+            self.submitted += 1
+            self.backlog += 1
+            self.max_depth = max(self.max_depth, len(q))
+            if schedule and not in_loop:
+                self._ready.append(key)
+                self._cond.notify()
+        if not schedule:
+            return True                     # чат уже ведёт воркер/задача — дойдёт и до этой
+        if in_loop:
+            runtime.LOOP.call_soon_threadsafe(lambda: asyncio.ensure_future(self._drain(key)))
+        elif not self._threads:
+            self._ensure_started()
+        return True
+
+    def pending(self) -> int:
+        """Чатов с невыполненными задачами."""
+        with self._lock:
+            return len(self._queues)
+
+    def depth(self, key: Hashable) -> int:
+        with self._lock:
+            q = self._queues.get(key)
+            return len(q) if q else 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            wait, run = sorted(self._wait), sorted(self._run)
+            pending = self.backlog
+            chats = len(self._queues)
+
+        def pct(xs, p):
+            return round(xs[min(len(xs) - 1, int(p * len(xs)))] * 1000, 1) if xs else 0.0
+
+        return {
+            "parallelism": self.parallelism, "chats": chats, "pending": pending, "running": self.running,
+            "submitted": self.submitted, "dropped": self.dropped, "done": self.done, "failed": self.failed,
+            "max_chat_depth": self.max_depth,
+            "wait_p50_ms": pct(wait, .5), "wait_p95_ms": pct(wait, .95),
+            "run_p50_ms": pct(run, .5), "run_p95_ms": pct(run, .95),
+        }
+
+    def close(self, timeout: float = 30.0) -> None:
+        """Дождаться уже поставленных задач (не дольше timeout) и остановить воркеров."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._queues and time.monotonic() < deadline:
+                self._cond.wait(0.05)
+            self._stop = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join(timeout=max(0.0, deadline - time.monotonic()))
+        self._threads = []
+
+    # ---------- внутреннее ----------
+    def _take(self, key: Hashable) -> tuple:
+        with self._lock:
+            item = self._queues[key][0]     # остаётся в очереди, пока выполняется: чат «занят»
+            self.running += 1
+        return item
+
+    def _finish(self, key: Hashable, queued_at: float, started: float, ok: bool, requeue: bool) -> bool:
+        """Отметить выполненную задачу чата; True — у чата есть ещё задачи (requeue — вернуть его в _ready)."""
+        finished = time.monotonic()
+        if self.observer is not None:
+            self.observer(finished - queued_at)
+        with self._cond:
+            self.running -= 1
+            self.backlog -= 1
+            self.done += ok
+            self.failed += not ok
+            self._wait.append(started - queued_at)
+            self._run.append(finished - started)
+            q = self._queues[key]
+            q.popleft()
+            if not q:
+                del self._queues[key]
+                self._cond.notify_all()     # close() ждёт опустевания
+                return False
+            if requeue:
+                self._ready.append(key)
+                self._cond.notify()
+            return True
+
+    # sync: потоки
+    def _ensure_started(self) -> None:
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.parallelism):
+                t = threading.Thread(target=self._worker, name=f"{self.name}-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def _worker(self) -> None:
+        while True:
+            with self._cond:
+                while not self._ready and not self._stop:
+                    self._cond.wait()
+                if not self._ready:
+                    return
+                key = self._ready.popleft()
+            queued_at, fn, args = self._take(key)
+            started = time.monotonic()
+            ok = True
+            try:
+                res = fn(*args)
+                if asyncio.iscoroutine(res):
+                    runtime.run_sync(res)
+            except Exception:
+                ok = False
+                log.exception(f"{self.name}: update for chat {key} failed")
+            self._finish(key, queued_at, started, ok, requeue=True)
+
+    # async: задачи event loop'а (по одной на чат с задачами)
+    async def _drain(self, key: Hashable) -> None:
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.parallelism)
+        more = True
+        while more:
+            async with self._sem:
+                queued_at, fn, args = self._take(key)
+                started = time.monotonic()
+                ok = True
+                try:
+                    res = fn(*args)
+                    if asyncio.iscoroutine(res):
+                        await res
+                except Exception:
+                    ok = False
+                    log.exception(f"{self.name}: update for chat {key} failed")
+            more = self._finish(key, queued_at, started, ok, requeue=False)
@@ -0,0 +1,329 @@
+# kp_bot/compact.py
+"""
+Компактная сессия чата (вместо вложенных dict'ов в USER[ch]).
+
+Раньше сессия была dict'ом с копией списка маршрута, dict'ом ответов и
+dict'ом multiselect_ctx с set'ом выбранных ключей — несколько КБ даже у
+тех, кто только нажал /start. Теперь:
+
+- ChatSession — объект со __slots__; маршрут — имя из FLOW (одна общая
+  строка на все сессии, по ней — общий кортеж шагов) плюс индекс; список
+  шагов из старой записи при загрузке заменяется именем (register_flows);
+- выбор мультивыбора — целое число-битовая маска по таблице опций шага
+  (OptionIndex); ключи, которых в таблице нет (старые кнопки), не теряются;
+- Answers — ответы анкеты: текстовые поля в слотах, мультивыбор — Choice
+  (маска + «свой вариант»).
+
+Оба класса поддерживают dict-доступ, которым пользуется остальной код
+(`sess["idx"]`, `sess.get("screen")`, `d.get("name", "—")`, `d["A1_blocks"]`),
+а dump()/load() дают тот же JSON, что и прежний dict: старые записи в
+SQLite и журнале читаются без миграции, ключи выбора в JSON хранятся
+списком, поэтому таблицы опций можно переупорядочивать.
+"""
+from __future__ import annotations
+
+import sys
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+
+_MISSING = object()
+
+
+# =========================
+# ТАБЛИЦЫ ОПЦИЙ
+# =========================
+class OptionIndex:
+    """Шаг -> порядок ключей опций; ключ -> бит в маске."""
+
+    def __init__(self, tables: Mapping[str, Iterable[str]] = ()):
+        self._keys: Dict[str, Tuple[str, ...]] = {}
+        self._bits: Dict[str, Dict[str, int]] = {}
+        for step, keys in dict(tables).items():
+            seq = tuple(dict.fromkeys(sys.intern(k) for k in keys))   # без повторов, порядок сохраняем
+            self._keys[step] = seq
+            self._bits[step] = {k: 1 << i for i, k in enumerate(seq)}
+
+    def bit(self, step: str, key: str) -> int:
+        """Бит опции; 0 — такой опции в таблице шага нет."""
+        return self._bits.get(step, {}).get(key, 0)
+
+    def mask(self, step: str, keys: Iterable[str]) -> Tuple[int, Tuple[str, ...]]:
+        """(маска, ключи вне таблицы)."""
+        bits = self._bits.get(step, {})
+        m, extra = 0, []
+        for k in keys:
+            b = bits.get(k)
+            if b:
+                m |= b
+            elif k not in extra:
+                extra.append(k)
+        return m, tuple(extra)
+
+    def keys(self, step: str, mask: int, extra: Tuple[str, ...] = ()) -> List[str]:
+        out = [k for i, k in enumerate(self._keys.get(step, ())) if mask >> i & 1]
+        out.extend(extra)
+        return out
+
+
+OPTIONS = OptionIndex()
+
+
+def register_options(tables: Mapping[str, Iterable[str]]) -> OptionIndex:
+    """Таблицы опций мультивыбора (main.py вызывает один раз при импорте)."""
+    global OPTIONS
+    OPTIONS = OptionIndex(tables)
+    return OPTIONS
+
+
+FLOW_NAMES: Dict[Tuple[str, ...], str] = {}
+
+
+def register_flows(flows: Mapping[str, Iterable[str]]) -> None:
+    """Имена маршрутов: старые сессии хранили сам список шагов — при загрузке меняем его на имя."""
+    FLOW_NAMES.clear()
+    for name, seq in flows.items():
+        FLOW_NAMES.setdefault(tuple(seq), sys.intern(name))
+
+
+def _intern(v):
+    return sys.intern(v) if type(v) is str else v
+
+
+# =========================
+# ОТВЕТЫ
+# =========================
+class Choice:
+    """Ответ мультивыбора: маска по OPTIONS, ключи вне таблицы, «свой вариант»."""
+    __slots__ = ("mask", "extra", "other")
+
+    def __init__(self, mask: int = 0, extra: Tuple[str, ...] = (), other: Optional[str] = None):
+        self.mask = mask
+        self.extra = extra
+        self.other = other
+
+    def as_dict(self, step: str) -> dict:
+        return {"items": OPTIONS.keys(step, self.mask, self.extra), "other": self.other}
+
+
+TEXT_FIELDS = ("name", "org_name", "org_category", "has_site", "has_site_comment",
+               "biz_goal", "user_action", "product", "audience", "contacts")
+_TEXT = frozenset(TEXT_FIELDS)
+
+
+class Answers:
+    """
+    Ответы анкеты. Текстовые поля — слоты (незаполненный слот = ключа нет),
+    мультивыбор — {шаг: Choice}, всё прочее — в _extra.
+    Чтение d[step] для мультивыбора отдаёт {"items": [...], "other": ...}.
+    """
+    __slots__ = TEXT_FIELDS + ("_choices", "_extra")
+
+    def __init__(self):
+        self._choices: Optional[Dict[str, Choice]] = None
+        self._extra: Optional[dict] = None
+
+    # ---------- мультивыбор ----------
+    def choice(self, step: str) -> Optional[Choice]:
+        return self._choices.get(step) if self._choices else None
+
+    def set_choice(self, step: str, mask: int, extra: Tuple[str, ...] = (), other=_MISSING) -> Choice:
+        """Сохранить выбор шага; other не передан — «свой вариант» остаётся прежним."""
+        if self._choices is None:
+            self._choices = {}
+        c = self._choices.get(step)
+        if c is None:
+            c = self._choices[sys.intern(step)] = Choice()
+        c.mask, c.extra = mask, extra
+        if other is not _MISSING:
+            c.other = other
+        return c
+
+    def set_other(self, step: str, text: Optional[str]) -> None:
+        c = self.choice(step) or self.set_choice(step, 0)
+        c.other = text
+
+    # ---------- dict-протокол ----------
+    def __getitem__(self, key: str):
+        v = self.get(key, _MISSING)
+        if v is _MISSING:
+            raise KeyError(key)
+        return v
+
+    def get(self, key: str, default=None):
+        if key in _TEXT:
+            return getattr(self, key, default)
+        c = self.choice(key)
+        if c is not None:
+            return c.as_dict(key)
+        return self._extra.get(key, default) if self._extra else default
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __setitem__(self, key: str, value) -> None:
+        if key in _TEXT:
+            setattr(self, key, value)
+        elif isinstance(value, dict) and "items" in value:
+            m, extra = OPTIONS.mask(key, value.get("items") or ())
+            self.set_choice(key, m, extra, value.get("other"))
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def update(self, other=(), **kw) -> None:
+        for k, v in dict(other, **kw).items():
+            self[k] = v
+
+    def dump(self) -> dict:
+        out = {f: getattr(self, f) for f in TEXT_FIELDS if hasattr(self, f)}
+        if self._choices:
+            out.update((step, c.as_dict(step)) for step, c in self._choices.items())
+        if self._extra:
+            out.update(self._extra)
+        return out
+
+    @classmethod
+    def load(cls, d: Optional[dict]) -> "Answers":
+        a = cls()
+        for k, v in (d or {}).items():
+            a[k] = v
+        return a
+
+
+# =========================
+# СЕССИЯ
+# =========================
+class ChatSession:
+    """
+    Сессия чата. Поля (как ключи прежнего dict): flow, idx, branch, solution,
+    last_mid, screen, state, state_data, data (Answers, создаётся при первом
+    обращении). Контекст мультивыбора — ms_step/ms_mask/ms_extra/ms_single/ms_page.
+    """
+    __slots__ = ("flow", "idx", "branch", "solution", "last_mid", "screen", "state", "state_data",
+                 "_data", "ms_step", "ms_mask", "ms_extra", "ms_single", "ms_page", "_extra")
+
+    FIELDS = ("flow", "idx", "branch", "solution", "last_mid", "screen", "state", "state_data")
+    _FIELDS = frozenset(FIELDS)
+
+    def __init__(self, flow: str = "base"):
+        self.flow = _intern(flow)
+        self.idx = 0
+        self.branch = None
+        self.solution = None
+        self.last_mid = None
+        self.screen = None
+        self.state = None
+        self.state_data = None
+        self._data: Optional[Answers] = None
+        self._extra: Optional[dict] = None
+        self.reset_multiselect()
+
+    @property
+    def data(self) -> Answers:
+        if self._data is None:
+            self._data = Answers()
+        return self._data
+
+    # ---------- мультивыбор ----------
+    def reset_multiselect(self, step: Optional[str] = None, mask: int = 0,
+                          extra: Tuple[str, ...] = (), single: bool = False) -> None:
+        self.ms_step = _intern(step)
+        self.ms_mask = mask
+        self.ms_extra = extra
+        self.ms_single = single
+        self.ms_page = 0
+
+    def start_multiselect(self, step: str, seed: Iterable[str] = (), single: bool = False) -> None:
+        mask, extra = OPTIONS.mask(step, seed)
+        self.reset_multiselect(step, mask, extra, single)
+
+    def is_selected(self, key: str) -> bool:
+        b = OPTIONS.bit(self.ms_step, key)
+        return bool(self.ms_mask & b) if b else key in self.ms_extra
+
+    def toggle(self, key: str) -> None:
+        b = OPTIONS.bit(self.ms_step, key)
+        if self.ms_single:
+            self.ms_mask, self.ms_extra = (b, ()) if b else (0, (key,))
+        elif b:
+            self.ms_mask ^= b
+        elif key in self.ms_extra:
+            self.ms_extra = tuple(k for k in self.ms_extra if k != key)
+        else:
+            self.ms_extra += (key,)
+
+    def selected(self) -> List[str]:
+        return OPTIONS.keys(self.ms_step, self.ms_mask, self.ms_extra)
+
+    # ---------- dict-протокол ----------
+    def __getitem__(self, key: str):
+        v = self.get(key, _MISSING)
+        if v is _MISSING:
+            raise KeyError(key)
+        return v
+
+    def get(self, key: str, default=None):
+        if key in self._FIELDS:
+            return getattr(self, key)
+        if key == "data":
+            return self.data
+        return self._extra.get(key, default) if self._extra else default
+
+    def __setitem__(self, key: str, value) -> None:
+        if key in self._FIELDS:
+            setattr(self, key, _intern(value))
+        elif key == "data":
+            self._data = value if isinstance(value, Answers) else Answers.load(value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def setdefault(self, key: str, default=None):
+        v = self.get(key)
+        if v is None:
+            self[key] = v = default
+        return v
+
+    def pop(self, key: str, default=None):
+        if key in self._FIELDS:
+            v = getattr(self, key)
+            setattr(self, key, None)
+            return v
+        return self._extra.pop(key, default) if self._extra else default
+
+    def update(self, other=(), **kw) -> None:
+        for k, v in dict(other, **kw).items():
+            self[k] = v
+
+    # ---------- (де)сериализация: тот же JSON, что у прежнего dict ----------
+    def dump(self) -> dict:
+        out = {f: getattr(self, f) for f in self.FIELDS}
+        out["data"] = self._data.dump() if self._data is not None else {}
+        out["multiselect_ctx"] = ({"step": self.ms_step, "selected": {"__set__": self.selected()},
+                                   "single": self.ms_single, "page": self.ms_page}
+                                  if self.ms_step is not None else {})
+        if self._extra:
+            out.update(self._extra)
+        return out
+
+    @classmethod
+    def load(cls, d: dict) -> "ChatSession":
+        if isinstance(d, ChatSession):
+            return d
+        s = cls()
+        for k, v in d.items():
+            if k == "multiselect_ctx":
+                ctx = v or {}
+                step = ctx.get("step")
+                m, extra = OPTIONS.mask(step, ctx.get("selected") or ()) if step else (0, ())
+                s.reset_multiselect(step, m, extra, bool(ctx.get("single")))
+                s.ms_page = int(ctx.get("page") or 0)
+            elif k == "flow" and isinstance(v, list):
+                s.flow = FLOW_NAMES.get(tuple(v), v)
+            else:
+                s[k] = v
+        return s
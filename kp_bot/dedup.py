@@ -0,0 +1,211 @@
+# kp_bot/dedup.py
+"""
+Защита от повторной обработки одного и того же.
+
+- UpdateIds — update_id уже принятых апдейтов. Telegram повторяет апдейт,
+  если не получил подтверждения (рестарт посреди пачки getUpdates, повтор
+  webhook после таймаута). Последние id держим в памяти, а в JSON периодически
+  пишем «пол» — наибольший id, до которого включительно все принятые апдейты
+  уже обработаны (done): после рестарта всё, что не новее его, — повтор, а
+  принятое, но не доделанное до падения, обработается заново.
+- RecentKeys — «это уже было за последние ttl секунд»: двойной тап по той же
+  кнопке того же сообщения, дважды отправленный текст.
+- InFlight — не больше одной задачи на ключ (одна генерация КП на чат).
+- RepeatMeter — счётчик дорогой работы, сделанной повторно (рендер и
+  загрузка того же КП в тот же чат): по нему видно, что повторы ещё проходят.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from typing import Hashable, Set
+
+log = logging.getLogger("kp-bot-dedup")
+
+# Telegram выдаёт update_id по порядку, но после недели без апдейтов начинает
+# со случайного — сохранённый «пол» старше этого не применяем
+FLOOR_MAX_AGE = 6 * 24 * 3600
+
+
+class RecentKeys:
+    """Множество ключей с временем жизни ttl (и пределом размера — старые вытесняются)."""
+
+    def __init__(self, ttl: float, max_size: int = 100_000):
+        self.ttl = ttl
+        self.max_size = max(1, int(max_size))
+        self._lock = threading.Lock()
+        self._keys: "OrderedDict[Hashable, float]" = OrderedDict()   # ключ -> когда истекает
+        self.hits = 0
+        self.misses = 0
+
+    def seen(self, key: Hashable) -> bool:
+        """True — ключ уже был в пределах ttl (повтор); иначе запоминает его и возвращает False."""
+        if self.ttl <= 0:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if key in self._keys:
+                self.hits += 1
+                return True
+            self._keys[key] = now + self.ttl
+            if len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+            self.misses += 1
+            return False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"keys": len(self._keys), "duplicates": self.hits, "unique": self.misses}
+
+    def _expire(self, now: float) -> None:
+        # ttl у всех один, поэтому порядок вставки = порядок истечения
+        keys = self._keys
+        while keys:
+            k, exp = next(iter(keys.items()))
+            if exp > now:
+                break
+            del keys[k]
+
+
+class UpdateIds:
+    """
+    Принятые update_id: последние window — в памяти, «пол» обработанных — в
+    JSON-файле (path; пусто — без файла). Каждый принятый id нужно отметить
+    done(), когда его обработка закончилась (или он отброшен).
+    """
+
+    def __init__(self, path: str = "", window: int = 10_000, save_every: float = 1.0):
+        self.path = path
+        self.save_every = save_every
+        self._lock = threading.Lock()
+        self._seen: Set[int] = set()
+        self._order: deque = deque()
+        self.window = max(1, int(window))
+        self.floor = 0              # всё, что не новее, — повтор из прошлого запуска
+        self.last = 0
+        self._pending: Set[int] = set()     # приняты, но ещё не обработаны
+        self._saved_last = 0
+        self._saved_at = 0.0
+        self.accepted = 0
+        self.duplicates = 0
+        self.redelivered = 0
+        if path:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    saved = json.load(f)
+                if time.time() - float(saved.get("ts", 0)) < FLOOR_MAX_AGE:
+                    self.floor = self.last = self._saved_last = int(saved.get("last_update_id", 0))
+            except FileNotFoundError:
+                pass
+            except Exception:
+                log.warning(f"update ids {path} unreadable, starting empty")
+
+    def accept(self, update_id: int) -> bool:
+        """True — апдейт новый (и теперь считается принятым); False — повтор."""
+        with self._lock:
+            if update_id <= self.floor:
+                self.redelivered += 1
+                return False
+            if update_id in self._seen:
+                self.duplicates += 1
+                return False
+            self._seen.add(update_id)
+            self._order.append(update_id)
+            if len(self._order) > self.window:
+                self._seen.discard(self._order.popleft())
+            self._pending.add(update_id)
+            self.accepted += 1
+            if update_id > self.last:
+                self.last = update_id
+        return True
+
+    def done(self, update_id: int) -> None:
+        """Обработка принятого апдейта закончилась: он может лечь под сохраняемый «пол»."""
+        with self._lock:
+            self._pending.discard(update_id)
+            if self.path and time.monotonic() - self._saved_at >= self.save_every:
+                self._save_locked()
+
+    def flush(self) -> None:
+        """Записать «пол», если он сменился (последняя пачка перед затишьем)."""
+        with self._lock:
+            self._save_locked()
+
+    close = flush
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"accepted": self.accepted, "duplicates": self.duplicates,
+                    "redelivered": self.redelivered, "last": self.last, "pending": len(self._pending)}
+
+    def _watermark(self) -> int:
+        # всё до первого недоделанного обработано; апдейты идут по возрастанию id
+        return min(self.last, min(self._pending) - 1) if self._pending else self.last
+
+    def _save_locked(self) -> None:
+        self._saved_at = time.monotonic()
+        mark = self._watermark()
+        if not self.path or mark == self._saved_last:
+            return
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"last_update_id": mark, "ts": time.time()}, f)
+            os.replace(tmp, self.path)
+            self._saved_last = mark
+        except OSError:
+            log.exception(f"update ids: cannot save {self.path}")
+
+
+class InFlight:
+    """Ключи, по которым сейчас идёт работа; acquire — False, если уже идёт."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys: Set[Hashable] = set()
+        self.started = 0
+        self.rejected = 0
+
+    def acquire(self, key: Hashable) -> bool:
+        with self._lock:
+            if key in self._keys:
+                self.rejected += 1
+                return False
+            self._keys.add(key)
+            self.started += 1
+            return True
+
+    def release(self, key: Hashable) -> None:
+        with self._lock:
+            self._keys.discard(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"running": len(self._keys), "started": self.started, "rejected": self.rejected}
+
+
+class RepeatMeter:
+    """Сколько раз дорогая работа (kind) повторилась над тем же ключом за ttl секунд — «лишняя»."""
+
+    def __init__(self, ttl: float, kinds=()):
+        self._recent = RecentKeys(ttl)
+        self._lock = threading.Lock()
+        self.wasted: Counter = Counter(dict.fromkeys(kinds, 0))
+
+    def note(self, kind: str, key: Hashable) -> bool:
+        """Отметить выполненную работу; True — это повтор (посчитан в wasted)."""
+        if not self._recent.seen((kind, key)):
+            return False
+        with self._lock:
+            self.wasted[kind] += 1
+        return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self.wasted)
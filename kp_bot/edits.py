@@ -0,0 +1,134 @@
+# kp_bot/edits.py
+"""
+Склейка правок одного сообщения (быстрые нажатия в мультивыборе).
+
+Каждое нажатие opt:: меняет состояние в памяти сразу, а экран — правкой
+сообщения. При серии быстрых нажатий промежуточные правки никому не нужны:
+пока одна правка (chat_id, message_id) в полёте, следующие не отправляются,
+а только запоминаются — «последняя побеждает». Когда правка в полёте
+завершилась, владелец выжидает min_interval (окно, в котором успевают
+накопиться нажатия) и отправляет самую свежую из накопившихся.
+
+Отпечаток экрана (screen_fingerprint) позволяет не отправлять правку, которая
+ничего не меняет: main.py хранит в сессии отпечаток последнего экрана
+сообщения и считает такие пропуски через note_skipped().
+
+Правки одного сообщения отправляет один «владелец» — корутина, которая
+застала сообщение свободным; поэтому более старый экран не может перезаписать
+более новый. Остальные вызовы возвращаются сразу.
+
+С submit (ChatDispatcher.submit) отправка встаёт отдельной задачей в очередь
+чата, и edit() возвращается сразу и у владельца. Это нужно, когда апдейты
+чата выполняются строго по одному: иначе хендлер ждал бы свою правку,
+следующее нажатие начиналось бы только после неё — и склеивать было бы
+нечего. Нажатия, успевшие встать в очередь раньше задачи правки, только
+заменяют её экран, а сама правка (и то, что send делает с сессией) идёт в
+свой ход чата, не одновременно с его хендлерами. Ошибка такой правки только
+пишется в лог: запасной вариант (новое сообщение) — забота send.
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import logging
+import threading
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+log = logging.getLogger("kp-bot-edits")
+
+Key = Tuple[int, int]
+
+
+def screen_fingerprint(text: str, markup=None) -> str:
+    """Короткий отпечаток экрана: текст + клавиатура (JSON-строка или InlineKeyboardMarkup)."""
+    if markup is None:
+        mk = ""
+    elif isinstance(markup, str):
+        mk = markup
+    else:
+        mk = markup.to_json()
+    return hashlib.blake2b(f"{text}\0{mk}".encode("utf-8"), digest_size=8).hexdigest()
+
+
+class _Slot:
+    __slots__ = ("pending",)
+
+    def __init__(self):
+        self.pending: Optional[tuple] = None    # (text, markup) — последний непосланный экран
+
+
+class EditCoalescer:
+    def __init__(self, send: Callable[..., Awaitable], min_interval: float = 0.25,
+                 submit: Optional[Callable[..., bool]] = None):
+        """
+        send(chat_id, message_id, text, markup) — сама правка (с обработкой «not modified» и т.п.);
+        submit(chat_id, coro_fn, *args) — поставить корутину в очередь чата (ChatDispatcher.submit),
+        False — очередь полна; None — владелец отправляет сам.
+        """
+        self._send = send
+        self._submit = submit
+        self.min_interval = max(0.0, float(min_interval))
+        self._lock = threading.Lock()
+        self._busy: Dict[Key, _Slot] = {}       # сообщения, у которых есть владелец
+
+        self.submitted = 0
+        self.sent = 0
+        self.coalesced = 0                      # правок, замещённых более свежими
+        self.skipped = 0                        # правок, совпавших с тем, что уже на экране
+
+    async def edit(self, chat_id: int, message_id: int, text: str, markup=None) -> None:
+        key = (chat_id, message_id)
+        with self._lock:
+            self.submitted += 1
+            slot = self._busy.get(key)
+            if slot is not None:
+                if slot.pending is not None:
+                    self.coalesced += 1
+                slot.pending = (text, markup)
+                return                          # отправит владелец
+            slot = self._busy[key] = _Slot()
+            slot.pending = (text, markup)
+
+        # мы — владелец: отправляем свою правку и всё, что накопится за время отправки
+        if self._submit is not None and self._submit(chat_id, self._own, key, slot, False):
+            return
+        await self._own(key, slot, True)        # без очереди чата (или она полна) — в своём ходе
+
+    async def _own(self, key: Key, slot: _Slot, raise_own: bool) -> None:
+        chat_id, message_id = key
+        own_error: Optional[Exception] = None
+        first = True
+        while True:
+            with self._lock:
+                item, slot.pending = slot.pending, None     # самый свежий экран
+            try:
+                await self._send(chat_id, message_id, *item)
+            except Exception as e:
+                if first and raise_own:
+                    own_error = e               # свою ошибку вернём вызывающему
+                else:
+                    log.warning(f"coalesced edit {key} failed: {e}")
+            first = False
+            with self._lock:
+                self.sent += 1
+                has_more = slot.pending is not None
+                if not has_more:
+                    del self._busy[key]
+                    break
+            # окно: пусть подтянутся ещё нажатия; с очередью чата их копит сама очередь,
+            # а сон только держал бы ход чата
+            if self.min_interval and self._submit is None:
+                await asyncio.sleep(self.min_interval)
+        if own_error is not None:
+            raise own_error
+
+    def note_skipped(self) -> None:
+        with self._lock:
+            self.skipped += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            saved = self.coalesced + self.skipped
+            ratio = round(saved / self.submitted, 3) if self.submitted else 0.0
+            return {"submitted": self.submitted, "api_calls": self.sent - self.skipped, "coalesced": self.coalesced,
+                    "skipped_same": self.skipped, "saved_ratio": ratio, "busy": len(self._busy)}
@@ -0,0 +1,148 @@
+# kp_bot/flow.py
+"""
+Шаги анкеты и маршруты между ними — декларативно, с компиляцией при импорте.
+
+- Step — описание шага: заголовок, FSM-состояние ввода, опции мультивыбора
+  или построитель клавиатуры/текста. Что показать на шаге, решает запись в
+  реестре, а не цепочка if в send_step.
+- FlowMachine компилирует именованные маршруты (кортежи ключей шагов) и
+  правила переходов (событие → новый маршрут + шаг) в таблицы:
+  позиция шага в маршруте, шаг по позиции, переход по (маршрут, событие) —
+  всё поиском в dict/кортеже, без list.index и пересборки списков.
+
+В сессии хранятся только имя маршрута и индекс (`flow`, `idx`). Машина не
+знает о Telegram и USER: её можно проверять отдельно (index, step_at, fire).
+"""
+from __future__ import annotations
+
+import hashlib
+import threading
+from typing import Callable, Dict, Iterable, Mapping, Optional, Sequence, Tuple
+
+KEEP = object()     # Step.state: не трогать FSM-состояние пользователя
+CUSTOM = "custom:"  # префикс имён маршрутов, зарегистрированных intern() по списку шагов
+
+
+class Step:
+    """
+    Шаг анкеты.
+
+    state    — FSM-состояние на время шага: State (ждём текст), None (сбросить), KEEP;
+    options  — опции мультивыбора: список (key, label) или fn(сессия) -> список;
+    keyboard — готовая разметка для шагов с обычными кнопками (собирается один раз);
+    body     — fn(ch, title) -> текст, если шаг выглядит не как «заголовок в рамке».
+    """
+    __slots__ = ("key", "title", "state", "options", "single", "other_text", "preset", "keyboard", "body")
+
+    def __init__(self, key: str, title: str, *, state=None, options=None, single: bool = False,
+                 other_text: Optional[str] = None, preset: bool = False,
+                 keyboard=None, body: Optional[Callable] = None):
+        self.key = key
+        self.title = title
+        self.state = state
+        self.options = options
+        self.single = single
+        self.other_text = other_text
+        self.preset = preset
+        self.keyboard = keyboard
+        self.body = body
+
+    @property
+    def multiselect(self) -> bool:
+        return self.options is not None
+
+
+class FlowMachine:
+    def __init__(self, steps: Iterable[Step], flows: Mapping[str, Sequence[str]],
+                 rules: Mapping[Tuple[str, str], Tuple[str, str]]):
+        """
+        flows — {имя маршрута: ключи шагов по порядку};
+        rules — {(маршрут или "*", событие): (новый маршрут, шаг в нём)}.
+        """
+        self.steps: Dict[str, Step] = {}
+        for s in steps:
+            if s.key in self.steps:
+                raise ValueError(f"duplicate step {s.key!r}")
+            self.steps[s.key] = s
+        self.flows: Dict[str, Tuple[str, ...]] = {}
+        self._pos: Dict[str, Dict[str, int]] = {}
+        self._by_seq: Dict[Tuple[str, ...], str] = {}
+        for name, seq in flows.items():
+            self._add_flow(name, tuple(seq))
+        self._rules = dict(rules)
+        self._lock = threading.Lock()
+        self._table: Dict[Tuple[str, str], Tuple[str, int]] = {}
+        self._compile()
+
+    # ---------- запросы ----------
+    def step_at(self, flow: str, idx: int) -> str:
+        seq = self.flows[flow]
+        return seq[min(max(idx, 0), len(seq) - 1)]
+
+    def index(self, flow: str, key: str) -> Optional[int]:
+        """Позиция шага в маршруте (0..), None — шага в маршруте нет."""
+        return self._pos[flow].get(key)
+
+    def length(self, flow: str) -> int:
+        return len(self.flows[flow])
+
+    def next_idx(self, flow: str, idx: int) -> int:
+        return min(idx + 1, len(self.flows[flow]) - 1)
+
+    def prev_idx(self, flow: str, idx: int) -> int:
+        return max(0, idx - 1)
+
+    def fire(self, flow: str, event: str) -> Tuple[str, int]:
+        """(новый маршрут, индекс) после события; KeyError — событие на этом маршруте не предусмотрено."""
+        return self._table[(flow, event)]
+
+    def intern(self, seq: Sequence[str]) -> str:
+        """
+        Имя маршрута для списка шагов (старые сессии хранили сам список); незнакомый — регистрируем.
+        Имя незнакомого выводится из самих шагов (custom:<хеш>) и одинаково во всех процессах,
+        но знают его только те, кто уже видел этот список: в сессии такой маршрут остаётся списком.
+        """
+        seq = tuple(seq)
+        name = self._by_seq.get(seq)
+        if name is not None:
+            return name
+        with self._lock:
+            name = self._by_seq.get(seq)
+            if name is None:
+                name = CUSTOM + hashlib.blake2b("\0".join(seq).encode("utf-8"), digest_size=6).hexdigest()
+                self._add_flow(name, seq)
+                self._compile()
+            return name
+
+    @staticmethod
+    def is_custom(flow: str) -> bool:
+        """Маршрут из intern(), а не из объявленных: по имени его другой процесс не найдёт."""
+        return flow.startswith(CUSTOM)
+
+    # ---------- компиляция ----------
+    def _add_flow(self, name: str, seq: Tuple[str, ...]) -> None:
+        unknown = [k for k in seq if k not in self.steps]
+        if unknown:
+            raise ValueError(f"flow {name!r}: unknown steps {unknown}")
+        if not seq:
+            raise ValueError(f"flow {name!r} is empty")
+        self.flows[name] = seq
+        self._pos[name] = {k: i for i, k in enumerate(seq)}
+        self._by_seq.setdefault(seq, name)
+
+    def _compile(self) -> None:
+        table: Dict[Tuple[str, str], Tuple[str, int]] = {}
+        for (src, event), (dst, key) in self._rules.items():
+            if src != "*" and src not in self.flows:
+                raise ValueError(f"rule {src}/{event}: unknown flow {src!r}")
+            if dst not in self.flows:
+                raise ValueError(f"rule {src}/{event}: unknown flow {dst!r}")
+            idx = self._pos[dst].get(key)
+            if idx is None:
+                raise ValueError(f"rule {src}/{event}: step {key!r} is not in flow {dst!r}")
+            for name in (self.flows if src == "*" else (src,)):
+                # явное правило маршрута важнее «*»
+                if src == "*" and (name, event) in self._rules:
+                    continue
+                table[(name, event)] = (dst, idx)
+        self._table = table
@@ -0,0 +1,121 @@
+# kp_bot/jobs.py
+"""
+Очередь тяжёлых задач (генерация и отправка КП) с фиксированным пулом воркеров.
+
+Хендлер только ставит задачу (`submit`) и сразу отвечает пользователю; рендер и
+загрузку документа выполняют воркеры. Глубина очереди ограничена: если она
+заполнена, submit возвращает False и хендлер сообщает «попробуйте позже»,
+вместо того чтобы копить работу без предела.
+
+Задача — корутина (`await api...`), воркер выполняет её до конца через
+runtime.run_coro: в sync-режиме на своём потоке, в async — в event loop бота.
+"""
+from __future__ import annotations
+
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from typing import Callable, List, Optional
+
+from . import runtime
+
+log = logging.getLogger("kp-bot-jobs")
+
+
+class JobQueue:
+    def __init__(self, name: str, workers: int = 2, max_depth: int = 50):
+        self.name = name
+        self.workers = max(1, int(workers))
+        self.max_depth = max(1, int(max_depth))
+        self._q: "queue.Queue[Optional[tuple]]" = queue.Queue(maxsize=self.max_depth)
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._wait = deque(maxlen=2000)     # ожидание в очереди, сек
+        self._run = deque(maxlen=2000)      # выполнение, сек
+
+        self.running = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.done = 0
+        self.failed = 0
+
+    def submit(self, fn: Callable, *args) -> bool:
+        """Поставить корутину fn(*args) в очередь. False — очередь заполнена (backpressure)."""
+        self._ensure_started()
+        try:
+            self._q.put_nowait((time.monotonic(), fn, args))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            log.warning(f"{self.name}: queue full ({self.max_depth}), job rejected")
+            return False
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    def depth(self) -> int:
+        return self._q.qsize()
+
+    def stats(self) -> dict:
+        with self._lock:
+            wait, run = sorted(self._wait), sorted(self._run)
+
+        def pct(xs, p):
+            return round(xs[min(len(xs) - 1, int(p * len(xs)))] * 1000, 1) if xs else 0.0
+
+        return {
+            "depth": self._q.qsize(), "max_depth": self.max_depth, "workers": self.workers,
+            "running": self.running, "submitted": self.submitted, "rejected": self.rejected,
+            "done": self.done, "failed": self.failed,
+            "wait_p50_ms": pct(wait, .5), "wait_p95_ms": pct(wait, .95),
+            "run_p50_ms": pct(run, .5), "run_p95_ms": pct(run, .95),
+        }
+
+    def close(self, timeout: float = 30.0) -> None:
+        """Дождаться уже поставленных задач (не дольше timeout) и остановить воркеров."""
+        for _ in self._threads:
+            try:
+                self._q.put(None, timeout=timeout)
+            except queue.Full:
+                break
+        deadline = time.monotonic() + timeout
+        for t in self._threads:
+            t.join(timeout=max(0.0, deadline - time.monotonic()))
+        self._threads = []
+
+    # ---------- внутреннее ----------
+    def _ensure_started(self) -> None:
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker, name=f"{self.name}-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def _worker(self) -> None:
+        while True:
+            item = self._q.get()
+            if item is None:
+                return
+            queued_at, fn, args = item
+            started = time.monotonic()
+            with self._lock:
+                self.running += 1
+            ok = True
+            try:
+                runtime.run_coro(fn(*args))
+            except Exception:
+                ok = False
+                log.exception(f"{self.name}: job failed")
+            finished = time.monotonic()
+            with self._lock:
+                self.running -= 1
+                self.done += ok
+                self.failed += not ok
+                self._wait.append(started - queued_at)
+                self._run.append(finished - started)
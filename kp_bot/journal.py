@@ -0,0 +1,83 @@
+# kp_bot/journal.py
+"""
+Журнал изменений сессий (append-only) для быстрого тёплого рестарта.
+
+Каждая запись — строка `<chat_id>\\t<json сессии>` (или `<chat_id>\\t-` для удаления).
+Снимок состояния — это SQLite-бэкенд SessionCache: при checkpoint'е журнал
+ротируется, грязные сессии сбрасываются в SQLite, старый журнал удаляется.
+При старте replay() возвращает последнюю версию каждой сессии из журнала.
+"""
+from __future__ import annotations
+
+import os
+import threading
+from typing import Dict, Optional
+
+DELETED = "-"
+
+
+class SessionJournal:
+    def __init__(self, path: str, fsync: bool = False):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.old_path = path + ".old"
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._f = open(path, "ab")
+        self.records = 0
+
+    def append(self, ch: int, raw: Optional[str]) -> None:
+        """Дописать версию сессии (raw=None — сессия удалена)."""
+        line = f"{ch}\t{DELETED if raw is None else raw}\n".encode("utf-8")
+        with self._lock:
+            self._f.write(line)
+            self._f.flush()
+            if self.fsync:
+                os.fsync(self._f.fileno())
+            self.records += 1
+
+    def replay(self) -> Dict[int, Optional[str]]:
+        """Последняя версия каждой сессии: сначала .old (незавершённый checkpoint), потом текущий."""
+        out: Dict[int, Optional[str]] = {}
+        with self._lock:
+            self._f.flush()
+            for p in (self.old_path, self.path):
+                if not os.path.exists(p):
+                    continue
+                with open(p, "rb") as f:
+                    data = f.read()
+                # последняя строка без '\n' — оборванная запись при падении, её пропускаем
+                for line in data.split(b"\n")[:-1]:
+                    ch_s, sep, raw = line.partition(b"\t")
+                    if not sep:
+                        continue
+                    try:
+                        ch = int(ch_s)
+                    except ValueError:
+                        continue
+                    out[ch] = None if raw == DELETED.encode() else raw.decode("utf-8")
+        return out
+
+    def rotate(self) -> None:
+        """Начать новый журнал; текущий уходит в .old до окончания checkpoint'а."""
+        with self._lock:
+            self._f.close()
+            if os.path.exists(self.old_path):
+                # предыдущий checkpoint не завершился — склеиваем, ничего не теряя
+                with open(self.old_path, "ab") as dst, open(self.path, "rb") as src:
+                    dst.write(src.read())
+                os.remove(self.path)
+            else:
+                os.replace(self.path, self.old_path)
+            self._f = open(self.path, "ab")
+            self.records = 0
+
+    def drop_rotated(self) -> None:
+        """Снимок записан — старый журнал больше не нужен."""
+        with self._lock:
+            if os.path.exists(self.old_path):
+                os.remove(self.old_path)
+
+    def close(self) -> None:
+        with self._lock:
+            self._f.close()
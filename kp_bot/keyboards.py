@@ -0,0 +1,62 @@
+# kp_bot/keyboards.py
+"""
+Кеш готовых inline-клавиатур.
+
+Экран мультивыбора полностью определяется ключом (шаг, страница, битовая маска
+отмеченных опций на странице, флаги single/preset/«свой вариант»). Для такого
+ключа клавиатура собирается один раз и хранится уже сериализованной в JSON —
+TeleBot/AsyncTeleBot принимают reply_markup строкой как есть, так что на
+повторном нажатии не создаётся ни одного объекта InlineKeyboardButton.
+
+Размер кеша ограничен (LRU), счётчики hits/misses — в stats().
+"""
+from __future__ import annotations
+
+import json
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable, Iterable, Sequence, Tuple
+
+Button = Tuple[str, str]     # (текст, callback_data)
+
+
+def markup_json(rows: Iterable[Sequence[Button]]) -> str:
+    """Ряды кнопок (text, callback_data) → JSON InlineKeyboardMarkup; пустые ряды пропускаются."""
+    return json.dumps({"inline_keyboard": [
+        [{"text": t, "callback_data": cd} for t, cd in row] for row in rows if row
+    ]}, ensure_ascii=False)
+
+
+class KeyboardCache:
+    def __init__(self, max_size: int = 4096):
+        self.max_size = max(1, int(max_size))
+        self._data: "OrderedDict[Hashable, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, build: Callable[[], str]) -> str:
+        """Готовый JSON клавиатуры по ключу; при промахе — build() и запомнить."""
+        with self._lock:
+            val = self._data.get(key)
+            if val is not None:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return val
+            self.misses += 1
+        val = build()   # собираем вне блокировки: два потока в худшем случае соберут одно и то же
+        with self._lock:
+            self._data[key] = val
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+        return val
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"size": len(self._data), "max": self.max_size, "hits": self.hits,
+                "misses": self.misses, "hit_rate": round(self.hits / total, 3) if total else 0.0}
@@ -0,0 +1,374 @@
+# kp_bot/kpfiles.py
+"""
+Имена файлов КП: KP_<телефон>_<ГГГГММДД>_<n>.html.
+
+Раньше номер n считался через glob по всей папке generated_kp и цикл
+os.path.exists — O(число файлов) на каждое КП и гонка между потоками.
+Теперь:
+
+- SeqAllocator хранит последний номер для каждого префикса (телефон+дата)
+  в маленькой SQLite-таблице и выдаёт следующий одним UPSERT'ом — O(1),
+  атомарно и между потоками, и между процессами;
+- create_kp_file пишет содержимое во временный файл и «публикует» его
+  os.link'ом под итоговым именем. link не перезаписывает существующий файл,
+  поэтому занять одно имя дважды нельзя, а админка никогда не видит
+  недописанный .html. Если имя всё же занято (например, файлы остались от
+  старой схемы нумерации), просто берём следующий номер.
+
+Раскладка папки (KP_STORAGE_LAYOUT, общая для бота и админки):
+
+- "flat" — все файлы в корне generated_kp (как раньше);
+- "date" — generated_kp/ГГГГ/ММ/ДД/ (дата берётся из имени файла; имена без
+  даты — в generated_kp/misc/, чтобы место файла не зависело от дня запуска);
+- "hash" — generated_kp/ab/cd/ по md5 имени: ≤ 65536 папок, файлы распределены равномерно.
+
+В БД админки KPFile.filename хранит путь относительно корня через "/",
+например "2025/09/09/KP_79061419500_20250909_1.html".
+
+KpDocument — КП, отрендеренное в память: бот отправляет его из буфера, а на
+диск (create_kp_file с номером, занятым reserve_kp_name) оно пишется уже
+после, в фоне. Пока содержимого нет, под именем лежит пустая заглушка.
+"""
+from __future__ import annotations
+
+import hashlib
+import io
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+LAYOUTS = ("flat", "date", "hash")
+LEAF_DEPTH = {"flat": 0, "date": 3, "hash": 2}   # на какой глубине лежат файлы
+MAX_DEPTH = max(LEAF_DEPTH.values())
+KP_EXTS = (".html", ".htm")
+
+_FN_DATE = re.compile(r"_(\d{4})(\d{2})(\d{2})_\d+\.[^.]+$")
+UNDATED = "misc"        # папка "date"-раскладки для имён без даты
+
+
+class SeqAllocator:
+    """Счётчик номеров по префиксу. path="" — только в памяти (номер проверяется при создании файла)."""
+
+    def __init__(self, path: str = ""):
+        self._lock = threading.Lock()
+        self._mem: Dict[str, int] = {}
+        self._conn = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS kp_seq (prefix TEXT PRIMARY KEY, last INTEGER NOT NULL)"
+            )
+
+    def next(self, prefix: str) -> int:
+        with self._lock:
+            if self._conn is None:
+                n = self._mem[prefix] = self._mem.get(prefix, 0) + 1
+                return n
+            row = self._conn.execute(
+                "INSERT INTO kp_seq(prefix, last) VALUES (?, 1) "
+                "ON CONFLICT(prefix) DO UPDATE SET last = last + 1 RETURNING last",
+                (prefix,),
+            ).fetchone()
+            return int(row[0])
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class KpIndex:
+    """
+    Уже выпущенные КП по хешу содержимого: hash -> (путь к файлу, file_id в Telegram).
+    Повторная генерация того же КП берёт файл отсюда: с file_id — без диска и
+    без загрузки, без него — загрузка готового файла без повторного рендера.
+    path="" — только в памяти.
+    """
+
+    def __init__(self, path: str = ""):
+        self._lock = threading.Lock()
+        self._mem: Dict[str, list] = {}
+        self._conn = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS kp_index ("
+                " hash TEXT PRIMARY KEY, path TEXT NOT NULL, file_id TEXT, created_at REAL NOT NULL)"
+            )
+        self.hits = 0
+        self.misses = 0
+        self.reused_ids = 0     # отправок по file_id: ни записи на диск, ни загрузки
+
+    def get(self, key: str) -> Optional[Tuple[str, Optional[str]]]:
+        with self._lock:
+            if self._conn is None:
+                row = self._mem.get(key)
+            else:
+                row = self._conn.execute("SELECT path, file_id FROM kp_index WHERE hash = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0], row[1]
+
+    def put(self, key: str, path: str, file_id: Optional[str] = None) -> None:
+        with self._lock:
+            if self._conn is None:
+                self._mem[key] = [path, file_id]
+                return
+            self._conn.execute(
+                "INSERT OR REPLACE INTO kp_index(hash, path, file_id, created_at) VALUES (?, ?, ?, ?)",
+                (key, path, file_id, time.time()),
+            )
+
+    def set_file_id(self, key: str, file_id: Optional[str]) -> None:
+        with self._lock:
+            if self._conn is None:
+                if key in self._mem:
+                    self._mem[key][1] = file_id
+                return
+            self._conn.execute("UPDATE kp_index SET file_id = ? WHERE hash = ?", (file_id, key))
+
+    def forget(self, key: str) -> None:
+        with self._lock:
+            if self._conn is None:
+                self._mem.pop(key, None)
+                return
+            self._conn.execute("DELETE FROM kp_index WHERE hash = ?", (key,))
+
+    def note_reused(self) -> None:
+        with self._lock:
+            self.reused_ids += 1
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "reused_file_ids": self.reused_ids}
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+# =========================
+# РАСКЛАДКА ПО ПАПКАМ
+# =========================
+def shard_of(name: str, layout: str) -> str:
+    """Подпапка (через "/") для файла name в раскладке layout; "" — корень."""
+    if layout == "date":
+        m = _FN_DATE.search(name)
+        return "/".join(m.groups()) if m else UNDATED
+    if layout == "hash":
+        h = hashlib.md5(name.encode("utf-8")).hexdigest()
+        return f"{h[:2]}/{h[2:4]}"
+    if layout == "flat":
+        return ""
+    raise ValueError(f"unknown KP storage layout: {layout!r} (expected one of {LAYOUTS})")
+
+
+def rel_path(name: str, layout: str) -> str:
+    """Относительный путь файла name (то, что хранится в KPFile.filename)."""
+    shard = shard_of(name, layout)
+    return f"{shard}/{name}" if shard else name
+
+
+def iter_kp_files(root: str, layout: str = "flat", since: float = 0.0) -> Iterator[str]:
+    """
+    Относительные пути всех КП под root (в любой из раскладок — важно при миграции).
+    Если задан since, «листовые» папки раскладки layout с mtime < since
+    пропускаются целиком: в них с прошлого скана ничего не появилось.
+    """
+    leaf = LEAF_DEPTH.get(layout, 0)
+
+    def walk(path: str, rel: str, depth: int) -> Iterator[str]:
+        try:
+            it = os.scandir(path)
+        except FileNotFoundError:
+            return
+        with it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False):
+                    if depth + 1 == leaf and since and e.stat().st_mtime < since:
+                        continue
+                    if depth < MAX_DEPTH:
+                        yield from walk(e.path, f"{rel}{e.name}/", depth + 1)
+                elif e.name.lower().endswith(KP_EXTS):
+                    yield rel + e.name
+
+    yield from walk(root, "", 0)
+
+
+# =========================
+# СОЗДАНИЕ ФАЙЛА
+# =========================
+def create_kp_file(out_dir: str, prefix: str, content: Union[str, bytes],
+                   alloc: SeqAllocator, ext: str = ".html", layout: str = "flat",
+                   seq: Optional[int] = None) -> str:
+    """
+    Создать <prefix>_<n><ext> с content в out_dir (в подпапке раскладки layout). Вернуть путь.
+    seq — номер, занятый заранее reserve_kp_name (KpDocument): пустой файл-заглушка
+    под этим именем наш, содержимое атомарно встаёт на его место.
+    """
+    data = content.encode("utf-8") if isinstance(content, str) else content
+    os.makedirs(out_dir, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=out_dir, prefix=f".{prefix}_", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        if seq is not None:
+            path = _target(out_dir, f"{prefix}_{seq}{ext}", layout)
+            os.replace(tmp, path)
+            return path
+        while True:
+            path = _target(out_dir, f"{prefix}_{alloc.next(prefix)}{ext}", layout)
+            try:
+                os.link(tmp, path)       # атомарно и без перезаписи
+                return path
+            except FileExistsError:
+                continue
+            except OSError:
+                # ФС без жёстких ссылок — занимаем имя через O_EXCL и пишем туда
+                return _create_excl(out_dir, prefix, data, alloc, ext, layout, first=path)
+    finally:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+
+def _target(out_dir: str, name: str, layout: str) -> str:
+    shard = shard_of(name, layout)
+    if not shard:
+        return os.path.join(out_dir, name)
+    d = os.path.join(out_dir, *shard.split("/"))
+    os.makedirs(d, exist_ok=True)
+    return os.path.join(d, name)
+
+
+def reserve_kp_name(out_dir: str, prefix: str, alloc: SeqAllocator,
+                    ext: str = ".html", layout: str = "flat") -> int:
+    """
+    Занять номер для <prefix>_<n><ext> до того, как имя уйдёт клиенту: пустая
+    заглушка через O_EXCL. Имя занято (файлы старой нумерации, счётчик в памяти
+    после рестарта, другой шард) — берём следующий номер. Вернуть n.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    while True:
+        n = alloc.next(prefix)
+        try:
+            fd = os.open(_target(out_dir, f"{prefix}_{n}{ext}", layout),
+                         os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o644)
+        except FileExistsError:
+            continue
+        os.close(fd)
+        return n
+
+
+def _create_excl(out_dir: str, prefix: str, data: bytes, alloc: SeqAllocator,
+                 ext: str, layout: str, first: str) -> str:
+    path = first
+    while True:
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o644)
+        except FileExistsError:
+            path = _target(out_dir, f"{prefix}_{alloc.next(prefix)}{ext}", layout)
+            continue
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        return path
+
+
+class KpDocument:
+    """
+    КП в памяти: HTML (его разбирает админка) и, если есть, PDF — то, что уходит
+    клиенту. Номер в имени занят заранее (seq от reserve_kp_name), поэтому имя
+    документа в Telegram совпадает с именем файла, который save() запишет позже.
+    """
+    __slots__ = ("out_dir", "prefix", "seq", "html", "pdf", "layout")
+
+    def __init__(self, out_dir: str, prefix: str, seq: int, html: Union[str, bytes],
+                 pdf: Optional[bytes] = None, layout: str = "flat"):
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.seq = seq
+        self.html = html.encode("utf-8") if isinstance(html, str) else html
+        self.pdf = pdf
+        self.layout = layout
+
+    @property
+    def name(self) -> str:
+        return f"{self.prefix}_{self.seq}{'.pdf' if self.pdf is not None else '.html'}"
+
+    @property
+    def data(self) -> bytes:
+        return self.pdf if self.pdf is not None else self.html
+
+    def buffer(self) -> io.BytesIO:
+        """Файлоподобный объект для send_document (загрузка без диска)."""
+        buf = io.BytesIO(self.data)
+        buf.name = self.name
+        return buf
+
+    def save(self, alloc: SeqAllocator) -> str:
+        """Записать HTML (и PDF рядом под тем же именем); вернуть путь к отправленному файлу."""
+        html_path = create_kp_file(self.out_dir, self.prefix, self.html, alloc,
+                                   layout=self.layout, seq=self.seq)
+        if self.pdf is None:
+            return html_path
+        pdf_path = os.path.splitext(html_path)[0] + ".pdf"
+        tmp = pdf_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.pdf)
+        os.replace(tmp, pdf_path)
+        return pdf_path
+
+
+# =========================
+# МИГРАЦИЯ
+# =========================
+def migrate_layout(root: str, layout: str, batch: int = 1000) -> Iterator[List[Tuple[str, str]]]:
+    """
+    Переложить все КП под root в раскладку layout. Отдаёт пачки по batch пар
+    (старый относительный путь, новый) — вызывающий обновляет по ним БД.
+    Файл, чьё новое место уже занято, не трогаем.
+    """
+    shard_of("", layout)    # проверка имени раскладки до того, как что-то двигать
+    moved: List[Tuple[str, str]] = []
+    for rel in iter_kp_files(root):
+        new = rel_path(rel.rsplit("/", 1)[-1], layout)
+        if new == rel:
+            continue
+        src = os.path.join(root, *rel.split("/"))
+        dst = os.path.join(root, *new.split("/"))
+        if os.path.exists(dst):
+            continue
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        os.rename(src, dst)
+        _prune_empty(os.path.dirname(src), root)
+        moved.append((rel, new))
+        if len(moved) >= batch:
+            yield moved
+            moved = []
+    if moved:
+        yield moved
+
+
+def _prune_empty(d: str, root: str) -> None:
+    """Убрать опустевшие папки старой раскладки (но не сам root)."""
+    root = os.path.normpath(root)
+    d = os.path.normpath(d)
+    while d != root and d.startswith(root):
+        try:
+            os.rmdir(d)
+        except OSError:
+            return
+        d = os.path.dirname(d)
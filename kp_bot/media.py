@@ -0,0 +1,110 @@
+# kp_bot/media.py
+"""
+Реестр file_id статических медиа (приветственное фото и т.п.).
+
+Первый раз файл загружается в Telegram как обычно, полученный file_id
+сохраняется (JSON-файл рядом с остальными runtime-данными) и дальше фото
+отправляется по id — без чтения диска и без загрузки сотен килобайт.
+
+Вместе с id хранится «подпись» файла (размер + mtime): заменили картинку —
+загрузим заново. Если Telegram отверг сохранённый id (400, например после
+смены бота), id забывается и файл загружается повторно.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+from typing import Awaitable, Callable, Dict, Optional
+
+log = logging.getLogger("kp-bot-media")
+
+_MEDIA_ATTRS = ("photo", "document", "video", "animation", "audio", "voice", "video_note", "sticker")
+
+
+def _signature(path: str) -> Optional[str]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+
+def file_id_of(msg) -> Optional[str]:
+    """file_id из ответа send_photo/send_document/...; у фото — самый крупный размер."""
+    for attr in _MEDIA_ATTRS:
+        obj = getattr(msg, attr, None)
+        if obj:
+            if isinstance(obj, list):
+                obj = obj[-1]
+            return getattr(obj, "file_id", None)
+    return None
+
+
+class MediaRegistry:
+    def __init__(self, path: str = ""):
+        self.path = path
+        self._lock = threading.Lock()
+        self._ids: Dict[str, dict] = {}
+        self.uploads = 0
+        self.by_id = 0
+        self.stale = 0
+        if path:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self._ids = json.load(f)
+            except FileNotFoundError:
+                pass
+            except Exception:
+                log.warning(f"media registry {path} unreadable, starting empty")
+
+    async def send(self, method: Callable[..., Awaitable], chat_id: int, key: str, local_path: str, **kwargs):
+        """
+        method(chat_id, <file_id или файл>, **kwargs), например api.send_photo.
+        key — имя ассета в реестре, local_path — откуда загружать при необходимости.
+        """
+        sig = _signature(local_path)
+        with self._lock:
+            entry = self._ids.get(key)
+        # файла на диске может и не быть (другая машина) — тогда достаточно id
+        if entry and (sig is None or entry.get("sig") == sig):
+            try:
+                msg = await method(chat_id, entry["file_id"], **kwargs)
+                with self._lock:
+                    self.by_id += 1
+                return msg
+            except Exception as e:
+                if getattr(e, "error_code", None) != 400:
+                    raise
+                log.warning(f"media {key}: file_id rejected ({e}), uploading again")
+                with self._lock:
+                    self.stale += 1
+                self.forget(key)
+
+        with open(local_path, "rb") as f:
+            msg = await method(chat_id, f, **kwargs)
+        fid = file_id_of(msg)
+        with self._lock:
+            self.uploads += 1
+            if fid:
+                self._ids[key] = {"file_id": fid, "sig": sig}
+                self._save_locked()
+        return msg
+
+    def forget(self, key: str) -> None:
+        with self._lock:
+            if self._ids.pop(key, None) is not None:
+                self._save_locked()
+
+    def stats(self) -> dict:
+        return {"assets": len(self._ids), "by_id": self.by_id, "uploads": self.uploads, "stale": self.stale}
+
+    def _save_locked(self) -> None:
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.tmp"   # реестр общий у процессов-шардов
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self._ids, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, self.path)
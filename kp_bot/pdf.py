@@ -0,0 +1,234 @@
+# kp_bot/pdf.py
+"""
+PDF из HTML КП: пул долгоживущих процессов xhtml2pdf + кеш по SHA-256 HTML.
+
+- Рендер идёт в отдельных процессах (ProcessPoolExecutor), xhtml2pdf/reportlab
+  импортируются в воркере один раз — каждый документ не платит за запуск
+  интерпретатора/конвертера и не держит GIL бота.
+- Один и тот же HTML (повторное «Создать КП», одинаковые анкеты) рендерится
+  один раз: результат лежит в памяти (LRU по байтам) и, если задан cache_dir,
+  на диске <cache_dir>/ab/<sha256>.pdf. Одновременные запросы одного HTML
+  ждут один общий рендер.
+- Внешние бинарники (wkhtmltopdf) не нужны. Для кириллицы воркер регистрирует
+  TTF-шрифт (font/font_bold); без него xhtml2pdf рисует квадраты.
+
+Процессы запускаются методом spawn (одинаково на Windows и Linux, безопасно при
+работающих потоках бота). Дочерний процесс импортирует модуль запуска, поэтому
+запуск бота в нём должен быть под `if __name__ == "__main__"` — как в main.py.
+"""
+from __future__ import annotations
+
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, Optional
+
+log = logging.getLogger("kp-bot-pdf")
+
+FONT_CANDIDATES = [   # (обычный, жирный) — первый существующий
+    ("C:/Windows/Fonts/arial.ttf", "C:/Windows/Fonts/arialbd.ttf"),
+    ("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"),
+    ("/usr/share/fonts/TTF/DejaVuSans.ttf", "/usr/share/fonts/TTF/DejaVuSans-Bold.ttf"),
+    ("/Library/Fonts/Arial Unicode.ttf", ""),
+]
+
+
+class PdfError(RuntimeError):
+    pass
+
+
+# ---------- код воркера (отдельный процесс) ----------
+FONT_FAMILY = "KPFont"
+FONT_CSS = "<style>\nbody, div, td, th, h1, span { font-family: KPFont; }\n</style>\n"
+
+
+def _init_worker(font: str = "", font_bold: str = "") -> None:
+    """Один раз на процесс: импорт xhtml2pdf и регистрация TTF-шрифта в reportlab."""
+    from xhtml2pdf import pisa  # noqa: F401
+    if not font:
+        return
+    # через @font-face нельзя: xhtml2pdf не читает файлы вне папки документа
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    from xhtml2pdf.default import DEFAULT_FONT
+
+    bold = f"{FONT_FAMILY}-Bold" if font_bold else FONT_FAMILY
+    pdfmetrics.registerFont(TTFont(FONT_FAMILY, font))
+    if font_bold:
+        pdfmetrics.registerFont(TTFont(bold, font_bold))
+    pdfmetrics.registerFontFamily(FONT_FAMILY, normal=FONT_FAMILY, bold=bold, italic=FONT_FAMILY, boldItalic=bold)
+    DEFAULT_FONT[FONT_FAMILY.lower()] = FONT_FAMILY
+
+
+def _ping() -> None:
+    pass
+
+
+def _render(html: str) -> bytes:
+    import io
+    from xhtml2pdf import pisa
+
+    out = io.BytesIO()
+    result = pisa.CreatePDF(io.StringIO(html), dest=out)
+    if result.err:
+        raise PdfError(f"xhtml2pdf: {result.err} error(s)")
+    return out.getvalue()
+
+
+def default_fonts() -> tuple:
+    for regular, bold in FONT_CANDIDATES:
+        if os.path.exists(regular):
+            return regular, (bold if bold and os.path.exists(bold) else "")
+    return "", ""
+
+
+# ---------- API ----------
+class PdfRenderer:
+    def __init__(self, workers: int = 2, cache_dir: str = "", mem_cache_mb: float = 32,
+                 font: Optional[str] = None, font_bold: Optional[str] = None,
+                 max_tasks_per_child: int = 200):
+        self.workers = max(1, int(workers))
+        self.cache_dir = cache_dir
+        self.mem_limit = int(mem_cache_mb * 1024 * 1024)
+        self.max_tasks_per_child = max_tasks_per_child or None
+        if font is None:
+            font, auto_bold = default_fonts()
+            font_bold = auto_bold if font_bold is None else font_bold
+        self.font, self.font_bold = font or "", font_bold or ""
+        self._font_css = FONT_CSS if font else ""
+        if not font:
+            log.warning("pdf: no TTF font found, Cyrillic text will not render (set KP_PDF_FONT)")
+
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._mem: "OrderedDict[str, bytes]" = OrderedDict()
+        self._mem_bytes = 0
+        self._inflight: Dict[str, Future] = {}
+
+        self.renders = 0
+        self.mem_hits = 0
+        self.disk_hits = 0
+        self.errors = 0
+        self.render_time = 0.0
+
+    # ----- публичное -----
+    def start(self) -> None:
+        """Поднять процессы заранее (иначе — при первом рендере)."""
+        pool = self._get_pool()
+        for f in [pool.submit(_ping) for _ in range(self.workers)]:
+            f.result()
+
+    def render(self, html: str, timeout: float = 120) -> bytes:
+        """PDF для html (из кеша или из пула). Ошибка рендера — PdfError."""
+        html = self._prepare(html)
+        key = hashlib.sha256(html.encode("utf-8")).hexdigest()
+        with self._lock:
+            data = self._mem.get(key)
+            if data is not None:
+                self._mem.move_to_end(key)
+                self.mem_hits += 1
+                return data
+            fut = self._inflight.get(key)
+            owner = fut is None
+            if owner:
+                fut = self._inflight[key] = Future()
+        if not owner:
+            return fut.result(timeout)
+
+        try:
+            data = self._disk_get(key)
+            if data is None:
+                t0 = time.perf_counter()
+                data = self._get_pool().submit(_render, html).result(timeout)
+                with self._lock:
+                    self.renders += 1
+                    self.render_time += time.perf_counter() - t0
+                self._disk_put(key, data)
+            else:
+                with self._lock:
+                    self.disk_hits += 1
+            self._remember(key, data)
+            fut.set_result(data)
+            return data
+        except Exception as e:
+            with self._lock:
+                self.errors += 1
+            err = e if isinstance(e, PdfError) else PdfError(f"pdf render failed: {e!r}")
+            fut.set_exception(err)
+            raise err from e
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers, "renders": self.renders, "mem_hits": self.mem_hits,
+                "disk_hits": self.disk_hits, "errors": self.errors, "inflight": len(self._inflight),
+                "mem_cache_kb": self._mem_bytes // 1024,
+                "avg_render_ms": round(self.render_time / self.renders * 1000, 1) if self.renders else 0.0,
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    # ----- внутреннее -----
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(self.font, self.font_bold),
+                    max_tasks_per_child=self.max_tasks_per_child,
+                )
+            return self._pool
+
+    def _prepare(self, html: str) -> str:
+        if not self._font_css:
+            return html
+        i = html.find("</head>")
+        return html[:i] + self._font_css + html[i:] if i >= 0 else self._font_css + html
+
+    def _remember(self, key: str, data: bytes) -> None:
+        if len(data) > self.mem_limit:
+            return
+        with self._lock:
+            if key in self._mem:
+                return
+            self._mem[key] = data
+            self._mem_bytes += len(data)
+            while self._mem_bytes > self.mem_limit:
+                _, old = self._mem.popitem(last=False)
+                self._mem_bytes -= len(old)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + ".pdf")
+
+    def _disk_get(self, key: str) -> Optional[bytes]:
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._disk_path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _disk_put(self, key: str, data: bytes) -> None:
+        if not self.cache_dir:
+            return
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
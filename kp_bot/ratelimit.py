@@ -0,0 +1,225 @@
+# kp_bot/ratelimit.py
+"""
+Ограничение исходящих вызовов Telegram Bot API (flood limits).
+
+Telegram режет бота ошибкой 429 примерно при >30 сообщений/сек на бота и
+частых сообщениях/правках в один чат. Раньше мы об этом узнавали только по
+«callback error» в логе и потерянным правкам. Теперь все send_*/edit_*/
+delete_message идут через RateLimiter:
+
+- два token bucket'а — общий на бота и отдельный на каждый чат; вызов ждёт,
+  пока токен есть в обоих;
+- полосы приоритета (lanes): HIGH (отправка КП) может выбрать бакет до дна,
+  NORMAL оставляет резерв для HIGH, LOW (косметические удаления, временные
+  уведомления) — ещё больший резерв. Под нагрузкой первыми ждут LOW;
+- 429 с retry_after: чат (или весь бот, если чат неизвестен) блокируется на
+  указанное время, вызов повторяется (не больше retries раз);
+- stats(): гистограммы ожидания по полосам, число 429 и задержанных вызовов.
+
+Ожидание — `await asyncio.sleep`: в async-режиме не держит event loop,
+в sync-режиме спит поток воркера, выполняющий хендлер (см. runtime.run_sync).
+"""
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+log = logging.getLogger("kp-bot-ratelimit")
+
+HIGH, NORMAL, LOW = 0, 1, 2
+LANE_NAMES = ("high", "normal", "low")
+RESERVE = (0.0, 0.2, 0.5)    # доля бакета, которую полоса не трогает (оставляет более важным)
+
+# верхние границы корзин гистограммы ожидания, сек
+HIST_BOUNDS = (0.0, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0)
+HIST_LABELS = tuple(f"<={int(b * 1000)}ms" for b in HIST_BOUNDS) + (">5000ms",)
+
+_lane: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("kp_rate_lane", default=None)
+
+
+@contextmanager
+def lane(level: int):
+    """Все вызовы API внутри блока идут в полосе level (например, доставка КП — HIGH)."""
+    token = _lane.set(level)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+class _Bucket:
+    __slots__ = ("tokens", "stamp", "blocked_until")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.stamp = now
+        self.blocked_until = 0.0
+
+
+class RateLimiter:
+    def __init__(self, rate: float = 30.0, burst: float = 30.0,
+                 chat_rate: float = 1.0, chat_burst: float = 5.0, max_chats: int = 10000):
+        self.rate, self.burst = float(rate), max(1.0, float(burst))
+        self.chat_rate, self.chat_burst = float(chat_rate), max(1.0, float(chat_burst))
+        self.max_chats = max(100, int(max_chats))
+        self._lock = threading.Lock()
+        now = time.monotonic()
+        self._global = _Bucket(self.burst, now)
+        self._chats: Dict[int, _Bucket] = {}
+
+        self.calls = 0
+        self.throttled = 0           # вызовов, которым пришлось ждать
+        self.flood_429 = 0
+        self._hist = [[0] * len(HIST_LABELS) for _ in LANE_NAMES]
+
+    async def acquire(self, chat_id: Optional[int], level: int = NORMAL) -> float:
+        """Дождаться токена в общем и чатовом бакете; вернуть, сколько ждали (сек)."""
+        started = time.monotonic()
+        waited = 0.0
+        while True:
+            delay = self._try_take(chat_id, level)
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+            waited = time.monotonic() - started
+        self._record(level, waited)
+        return waited
+
+    def penalize(self, chat_id: Optional[int], retry_after: float) -> None:
+        """Telegram ответил 429: не трогать чат (или всего бота) retry_after секунд."""
+        until = time.monotonic() + retry_after
+        with self._lock:
+            self.flood_429 += 1
+            b = self._chat(chat_id, time.monotonic()) if chat_id is not None else self._global
+            b.blocked_until = max(b.blocked_until, until)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "calls": self.calls, "throttled": self.throttled, "flood_429": self.flood_429,
+                "chats": len(self._chats),
+                "wait_hist": {name: dict(zip(HIST_LABELS, h)) for name, h in zip(LANE_NAMES, self._hist)},
+            }
+
+    # ---------- внутреннее ----------
+    def _try_take(self, chat_id: Optional[int], level: int) -> float:
+        """0 — токены взяты; иначе через сколько секунд пробовать снова."""
+        now = time.monotonic()
+        with self._lock:
+            g = self._refill(self._global, self.rate, self.burst, now)
+            need_g = 1.0 + RESERVE[level] * self.burst
+            delay = max(g.blocked_until - now, (need_g - g.tokens) / self.rate if g.tokens < need_g else 0.0)
+            c = None
+            if chat_id is not None and self.chat_rate > 0:
+                c = self._refill(self._chat(chat_id, now), self.chat_rate, self.chat_burst, now)
+                need_c = 1.0 + RESERVE[level] * (self.chat_burst - 1.0)
+                delay = max(delay, c.blocked_until - now,
+                            (need_c - c.tokens) / self.chat_rate if c.tokens < need_c else 0.0)
+            elif chat_id is not None:
+                delay = max(delay, self._chat(chat_id, now).blocked_until - now)
+            if delay > 0:
+                return delay
+            g.tokens -= 1.0
+            if c is not None:
+                c.tokens -= 1.0
+            return 0.0
+
+    @staticmethod
+    def _refill(b: _Bucket, rate: float, burst: float, now: float) -> _Bucket:
+        b.tokens = min(burst, b.tokens + (now - b.stamp) * rate)
+        b.stamp = now
+        return b
+
+    def _chat(self, chat_id: int, now: float) -> _Bucket:
+        b = self._chats.get(chat_id)
+        if b is None:
+            if len(self._chats) >= self.max_chats:
+                self._prune(now)
+            b = self._chats[chat_id] = _Bucket(self.chat_burst, now)
+        return b
+
+    def _prune(self, now: float) -> None:
+        """Забыть чаты, чей бакет уже снова полон: для них новый бакет ничем не отличается."""
+        full_after = self.chat_burst / self.chat_rate if self.chat_rate > 0 else 0.0
+        idle = [k for k, b in self._chats.items()
+                if now - b.stamp >= full_after and b.blocked_until <= now]
+        for k in idle:
+            del self._chats[k]
+
+    def _record(self, level: int, waited: float) -> None:
+        i = 0
+        while i < len(HIST_BOUNDS) and waited > HIST_BOUNDS[i]:
+            i += 1
+        with self._lock:
+            self.calls += 1
+            self.throttled += waited > 0
+            self._hist[level][i] += 1
+
+
+# =========================
+# ОБЁРТКА НАД API
+# =========================
+LIMITED_PREFIXES = ("send_", "edit_message", "delete_message", "forward_message", "copy_message")
+CHAT_ARG_POS = {"edit_message_text": 1, "edit_message_caption": 1}   # (text, chat_id, message_id)
+DEFAULT_LANE = {"send_document": HIGH, "delete_message": LOW, "delete_messages": LOW}
+
+
+def retry_after_of(exc: Exception) -> Optional[float]:
+    """retry_after из ApiTelegramException 429 (sync и async telebot), иначе None."""
+    if getattr(exc, "error_code", None) != 429:
+        return None
+    params = (getattr(exc, "result_json", None) or {}).get("parameters") or {}
+    try:
+        return float(params.get("retry_after", 1))
+    except (TypeError, ValueError):
+        return 1.0
+
+
+class LimitedApi:
+    """
+    `await api.x(...)` как у SyncApi/AsyncTeleBot, но отправка/правка/удаление
+    сообщений проходят через RateLimiter и переживают 429.
+    """
+
+    def __init__(self, api, limiter: RateLimiter, retries: int = 2, max_retry_wait: float = 30.0):
+        self._api = api
+        self._limiter = limiter
+        self._retries = retries
+        self._max_retry_wait = max_retry_wait
+
+    def __getattr__(self, name):
+        fn = getattr(self._api, name)
+        if not callable(fn) or not name.startswith(LIMITED_PREFIXES):
+            return fn
+        pos = CHAT_ARG_POS.get(name, 0)
+        default_lane = DEFAULT_LANE.get(name, NORMAL)
+        limiter = self._limiter
+
+        async def call(*args, **kwargs):
+            chat_id = kwargs.get("chat_id", args[pos] if len(args) > pos else None)
+            if not isinstance(chat_id, int):
+                chat_id = None
+            level = _lane.get()
+            if level is None:
+                level = default_lane
+            attempt = 0
+            while True:
+                await limiter.acquire(chat_id, level)
+                try:
+                    return await fn(*args, **kwargs)
+                except Exception as e:
+                    ra = retry_after_of(e)
+                    if ra is None or attempt >= self._retries or ra > self._max_retry_wait:
+                        raise
+                    attempt += 1
+                    log.warning(f"429 on {name} chat={chat_id}, retry in {ra:.1f}s")
+                    limiter.penalize(chat_id, ra)
+
+        call.__name__ = name
+        setattr(self, name, call)   # кешируем обёртку
+        return call
@@ -0,0 +1,156 @@
+# kp_bot/router.py
+"""
+Маршрутизация callback_data по таблице (вместо цепочки if/elif в on_cb).
+
+- `@router.exact("act_start", ...)` — точное совпадение, один поиск в dict;
+- `@router.prefix("cat_", ...)` — по префиксу: для каждой из (немногих)
+  длин зарегистрированных префиксов один срез и один поиск в dict, длинные
+  префиксы проверяются первыми; exact всегда важнее prefix;
+- `@router.op("o", legacy="opt::")` — действия мультивыбора в компактном
+  формате фиксированной ширины `<op>:<NN><arg>` (NN — номер шага в таблице
+  CallbackCodec), например "o:08seo" вместо "opt::D1_goals::seo". Такой
+  callback_data узнаётся по ":" во второй позиции и уходит к хендлеру по
+  одному символу op, без перебора префиксов. legacy —
+  старый формат "<prefix><step>::<arg>": кнопки в уже отправленных
+  сообщениях продолжают работать.
+
+Хендлеры: exact/prefix — `fn(ch, mid, arg)` (arg — остаток после префикса,
+для exact — вся строка), op — `fn(ch, mid, step, arg)`.
+"""
+from __future__ import annotations
+
+import logging
+import threading
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+log = logging.getLogger("kp-bot-router")
+
+OP_SEP = ":"
+CODE_WIDTH = 2          # номер шага — две цифры: до 100 шагов
+LEGACY_SEP = "::"
+
+
+class CallbackCodec:
+    """Компактный callback_data `<op>:<NN><arg>`; steps — список шагов, только дописывать в конец."""
+
+    def __init__(self, steps: Sequence[str]):
+        if len(set(steps)) != len(steps):
+            raise ValueError("duplicate step in callback codec table")
+        if len(steps) > 10 ** CODE_WIDTH:
+            raise ValueError(f"callback codec supports at most {10 ** CODE_WIDTH} steps")
+        self.steps = tuple(steps)
+        self._code = {s: f"{i:0{CODE_WIDTH}d}" for i, s in enumerate(self.steps)}
+        self._step = {c: s for s, c in self._code.items()}
+
+    def encode(self, op: str, step: str, arg: str = "") -> str:
+        data = f"{op}{OP_SEP}{self._code[step]}{arg}"
+        if len(data.encode("utf-8")) > 64:
+            raise ValueError(f"callback_data too long: {data!r}")
+        return data
+
+    def decode_rest(self, rest: str) -> Tuple[Optional[str], str]:
+        """Часть после "<op>:" → (шаг, arg); неизвестный номер — (None, arg)."""
+        return self._step.get(rest[:CODE_WIDTH]), rest[CODE_WIDTH:]
+
+
+class CallbackRouter:
+    def __init__(self, codec: Optional[CallbackCodec] = None):
+        self.codec = codec
+        self._exact: Dict[str, Callable] = {}
+        self._prefix: Dict[str, Callable] = {}
+        self._lengths: List[int] = []       # длины префиксов, по убыванию
+        self._ops: Dict[str, Callable] = {}  # компактный формат: один символ op → хендлер
+        self._lock = threading.Lock()
+        self.dispatched = 0
+        self.unrouted = 0
+
+    # ---------- регистрация ----------
+    def exact(self, *keys: str):
+        def deco(fn):
+            for k in keys:
+                self._add(self._exact, k, fn)
+            return fn
+        return deco
+
+    def prefix(self, *prefixes: str):
+        def deco(fn):
+            for p in prefixes:
+                self._add(self._prefix, p, fn)
+                if len(p) not in self._lengths:
+                    self._lengths.append(len(p))
+                    self._lengths.sort(reverse=True)
+            return fn
+        return deco
+
+    def op(self, code: str, legacy: Optional[str] = None):
+        """Действие мультивыбора: fn(ch, mid, step, arg) в компактном и (если задан) старом формате."""
+        if self.codec is None:
+            raise RuntimeError("router.op() needs a CallbackCodec")
+        if len(code) != 1:
+            raise ValueError(f"op code must be one character: {code!r}")
+        codec = self.codec
+
+        def deco(fn):
+            async def compact(ch, mid, rest):
+                step, arg = codec.decode_rest(rest)
+                if step is None:
+                    log.warning(f"unknown step code in callback {code}{OP_SEP}{rest!r}")
+                    return
+                await fn(ch, mid, step, arg)
+
+            async def old(ch, mid, rest):
+                step, _, arg = rest.partition(LEGACY_SEP)
+                await fn(ch, mid, step, arg)
+
+            self._add(self._ops, code, compact)
+            if legacy:
+                self.prefix(legacy)(old)
+            return fn
+        return deco
+
+    def data(self, code: str, step: str, arg: str = "") -> str:
+        """callback_data для кнопки действия code на шаге step."""
+        return self.codec.encode(code, step, arg)
+
+    # ---------- диспетчеризация ----------
+    def resolve(self, data: str) -> Tuple[Optional[Callable[..., Awaitable]], str]:
+        """(хендлер, arg) для callback_data; (None, data) — никто не обрабатывает."""
+        fn = self._exact.get(data)
+        if fn is not None:
+            return fn, data
+        if data[1:2] == OP_SEP:             # "<op>:..." — фиксированная ширина, без перебора префиксов
+            fn = self._ops.get(data[0])
+            if fn is not None:
+                return fn, data[2:]
+        for n in self._lengths:
+            if len(data) >= n:
+                fn = self._prefix.get(data[:n])
+                if fn is not None:
+                    return fn, data[n:]
+        return None, data
+
+    async def dispatch(self, ch: int, mid: int, data: str) -> bool:
+        fn, arg = self.resolve(data)
+        with self._lock:
+            if fn is None:
+                self.unrouted += 1
+            else:
+                self.dispatched += 1
+        if fn is None:
+            return False
+        await fn(ch, mid, arg)
+        return True
+
+    def vocabulary(self) -> List[str]:
+        """Зарегистрированные ключи и префиксы (для бенчмарка и отладки)."""
+        return list(self._exact) + [f"{op}{OP_SEP}" for op in self._ops] + list(self._prefix)
+
+    def stats(self) -> dict:
+        return {"exact": len(self._exact), "ops": len(self._ops), "prefixes": len(self._prefix),
+                "dispatched": self.dispatched, "unrouted": self.unrouted}
+
+    @staticmethod
+    def _add(table: Dict[str, Callable], key: str, fn: Callable) -> None:
+        if key in table:
+            raise ValueError(f"callback {key!r} already routed to {table[key].__name__}")
+        table[key] = fn
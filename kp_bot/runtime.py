@@ -0,0 +1,375 @@
+# kp_bot/runtime.py
+"""
+Режимы выполнения бота: "sync" (TeleBot + пул потоков) и "async" (AsyncTeleBot + asyncio).
+
+Хендлеры в main.py написаны один раз — как корутины, которые ходят в Telegram
+через `await api.<метод>(...)`:
+
+- sync:  api = SyncApi(TeleBot) — его «корутины» сразу делают блокирующий вызов,
+         хендлер прогоняется до конца на потоке воркера telebot (run_sync);
+- async: api = AsyncTeleBot — вызовы не блокируют, тысячи чатов обслуживаются
+         одним event loop'ом.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Hashable, List, Optional, Tuple
+
+import telebot
+
+from .scheduler import Scheduler
+
+log = logging.getLogger("kp-bot-runtime")
+
+MODES = ("sync", "async")
+
+MODE = "sync"
+LOOP: asyncio.AbstractEventLoop | None = None   # event loop async-режима
+
+_tls = threading.local()
+
+
+# =========================
+# SYNC-АДАПТЕР
+# =========================
+class SyncApi:
+    """Оборачивает методы TeleBot в корутины, чтобы хендлеры писали `await api.x(...)` в обоих режимах."""
+
+    def __init__(self, bot):
+        self._bot = bot
+
+    def __getattr__(self, name):
+        fn = getattr(self._bot, name)
+        if not callable(fn):
+            return fn
+
+        async def call(*args, **kwargs):
+            return fn(*args, **kwargs)
+
+        call.__name__ = name
+        setattr(self, name, call)   # кешируем обёртку
+        return call
+
+
+def run_sync(coro):
+    """Выполнить корутину до конца на текущем (не event loop) потоке."""
+    loop = getattr(_tls, "loop", None)
+    if loop is None:
+        loop = _tls.loop = asyncio.new_event_loop()
+    return loop.run_until_complete(coro)
+
+
+def run_coro(coro):
+    """Выполнить корутину хендлера до конца из рабочего потока: в async — в LOOP, в sync — на месте."""
+    if MODE == "async" and LOOP is not None:
+        return asyncio.run_coroutine_threadsafe(coro, LOOP).result()
+    return run_sync(coro)
+
+
+async def offload(fn: Callable, *args):
+    """Блокирующая работа (диск, рендер): в async-режиме — в пул потоков, в sync — на месте."""
+    if MODE == "async":
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+
+# =========================
+# ОТЛОЖЕННЫЕ ЗАДАЧИ
+# =========================
+JOB_WORKERS = 4         # sync-режим: сколько потоков выполняют сработавшие задачи
+_job_pool: Optional[ThreadPoolExecutor] = None
+
+
+def _dispatch(fn: Callable, args: tuple) -> None:
+    """Сработавшую задачу — в event loop (async) или в фиксированный пул потоков (sync)."""
+    global _job_pool
+    if MODE == "async" and LOOP is not None:
+        fut = asyncio.run_coroutine_threadsafe(fn(*args), LOOP)
+        fut.add_done_callback(_log_job_error)
+        return
+    if _job_pool is None:
+        _job_pool = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+    _job_pool.submit(run_sync, fn(*args)).add_done_callback(_log_job_error)
+
+
+def _log_job_error(fut) -> None:
+    if not fut.cancelled() and fut.exception() is not None:
+        log.error("delayed job failed", exc_info=fut.exception())
+
+
+SCHEDULER = Scheduler(_dispatch)
+
+
+def call_later(delay: float, fn: Callable, *args, key: Optional[Hashable] = None) -> None:
+    """Через delay секунд выполнить корутину fn(*args); задача с тем же key заменяет прежнюю."""
+    SCHEDULER.schedule(delay, fn, *args, key=key)
+
+
+def cancel_later(key: Hashable) -> bool:
+    """Снять отложенную задачу (например, пользователь уже ушёл с шага)."""
+    return SCHEDULER.cancel(key)
+
+
+# =========================
+# РЕГИСТРАЦИЯ ХЕНДЛЕРОВ
+# =========================
+class HandlerRegistry:
+    """
+    Хендлеры регистрируются на реестре (а не на конкретном боте) и ставятся
+    на TeleBot/AsyncTeleBot при запуске — в порядке объявления.
+    """
+
+    def __init__(self):
+        self._items: List[Tuple[str, dict, Callable]] = []
+
+    def message(self, **filters):
+        def deco(fn):
+            self._items.append(("message", filters, fn))
+            return fn
+        return deco
+
+    def callback(self, **filters):
+        def deco(fn):
+            self._items.append(("callback", filters, fn))
+            return fn
+        return deco
+
+    def install(self, bot, mode: str) -> None:
+        for kind, filters, fn in self._items:
+            h = fn if mode == "async" else _as_sync(fn)
+            reg = bot.message_handler if kind == "message" else bot.callback_query_handler
+            reg(**filters)(h)
+
+
+def _as_sync(fn: Callable) -> Callable:
+    def handler(*args, **kwargs):
+        return run_sync(fn(*args, **kwargs))
+    handler.__name__ = fn.__name__
+    return handler
+
+
+# =========================
+# СОЗДАНИЕ БОТА И ЗАПУСК
+# =========================
+def make_bot(token: str, mode: str, sessions, threaded: bool = True):
+    """
+    Вернуть (bot, api) для выбранного режима; FSM-состояния храним в сессиях.
+    threaded=False — sync-бот выполняет хендлеры прямо в вызывающем потоке
+    (webhook: параллелизм даёт пул воркеров WebhookServer).
+    """
+    global MODE
+    if mode not in MODES:
+        raise ValueError(f"unknown bot mode: {mode!r} (expected one of {MODES})")
+    MODE = mode
+    if mode == "async":
+        from telebot.async_telebot import AsyncTeleBot
+        from .states import AsyncSessionStateStorage
+        bot = AsyncTeleBot(token, parse_mode="HTML", state_storage=AsyncSessionStateStorage(sessions))
+        return bot, bot
+
+    from .states import SessionStateStorage
+    bot = telebot.TeleBot(token, parse_mode="HTML", threaded=threaded,
+                          state_storage=SessionStateStorage(sessions))
+    return bot, SyncApi(bot)
+
+
+def install(bot, handlers: HandlerRegistry) -> None:
+    """Поставить хендлеры и фильтр состояний на бота текущего режима."""
+    handlers.install(bot, MODE)
+    if MODE == "async":
+        from telebot import asyncio_filters
+        bot.add_custom_filter(asyncio_filters.StateFilter(bot))
+    else:
+        bot.add_custom_filter(telebot.custom_filters.StateFilter(bot))
+
+
+def update_chat_id(update) -> Optional[int]:
+    """Чат апдейта (для сообщений и нажатий); None — апдейт не привязан к чату."""
+    m = update.message or update.edited_message
+    if m is None and update.callback_query is not None:
+        cq = update.callback_query
+        if cq.message is not None:
+            return cq.message.chat.id
+        return cq.from_user.id
+    return m.chat.id if m is not None else None
+
+
+def serialize_by_chat(bot, chats, done: Optional[Callable[[object], None]] = None) -> None:
+    """
+    Пустить апдейты через ChatDispatcher: апдейты одного чата — строго по
+    одному и по порядку, разных чатов — параллельно. Бот должен выполнять
+    хендлеры на месте (make_bot(threaded=False)), иначе sync-TeleBot снова
+    раскидает их по своим потокам. done(update) — когда апдейт обработан
+    (или отброшен: очередь чата полна).
+    """
+    process = bot.process_new_updates
+
+    if MODE == "async":
+        async def process_one(u):
+            try:
+                await process([u])
+            finally:
+                if done is not None:
+                    done(u)
+
+        async def process_by_chat(updates):
+            for u in updates:
+                if not chats.submit(update_chat_id(u), process_one, u) and done is not None:
+                    done(u)
+    else:
+        def process_one(u):
+            try:
+                process([u])
+            finally:
+                if done is not None:
+                    done(u)
+
+        def process_by_chat(updates):
+            for u in updates:
+                if u.update_id > bot.last_update_id:    # offset для getUpdates двигает process_new_updates
+                    bot.last_update_id = u.update_id
+                if not chats.submit(update_chat_id(u), process_one, u) and done is not None:
+                    done(u)
+
+    bot.process_new_updates = process_by_chat
+
+
+def filter_updates(bot, accept: Callable[[object], bool], done: Optional[Callable[[object], None]] = None) -> None:
+    """
+    Пропускать к обработке только апдейты, для которых accept(update) — True
+    (повторы и т.п. — мимо). done(update) — после того как process вернулся
+    (у sync-TeleBot с потоками — апдейт уже передан его воркерам).
+    """
+    process = bot.process_new_updates
+
+    if MODE == "async":
+        async def process_accepted(updates):
+            updates = [u for u in updates if accept(u)]
+            if updates:
+                try:
+                    await process(updates)
+                finally:
+                    if done is not None:
+                        for u in updates:
+                            done(u)
+    else:
+        def process_accepted(updates):
+            for u in updates:
+                if u.update_id > bot.last_update_id:    # отброшенный апдейт тоже подтверждаем
+                    bot.last_update_id = u.update_id
+            updates = [u for u in updates if accept(u)]
+            if updates:
+                try:
+                    process(updates)
+                finally:
+                    if done is not None:
+                        for u in updates:
+                            done(u)
+
+    bot.process_new_updates = process_accepted
+
+
+def _wrap(bot, chats, accept, done=None) -> None:
+    if chats is not None:
+        serialize_by_chat(bot, chats, done)     # обработан — когда его задача в очереди чата закончилась
+        done = None
+    if accept is not None:
+        filter_updates(bot, accept, done)       # снаружи: повторы отсекаются при приёме, до очередей чатов
+
+
+def run_polling(bot, handlers: HandlerRegistry, chats=None, accept=None, done=None) -> None:
+    """
+    Поставить хендлеры и крутить long polling в текущем режиме
+    (chats — ChatDispatcher, accept/done — фильтр апдейтов и отметка об их обработке, см. filter_updates).
+    """
+    install(bot, handlers)
+    _wrap(bot, chats, accept, done)
+    if MODE == "async":
+        asyncio.run(_poll_async(bot))
+        return
+    bot.infinity_polling()
+
+
+async def _poll_async(bot) -> None:
+    global LOOP
+    LOOP = asyncio.get_running_loop()
+    await bot.infinity_polling()
+
+
+def update_processor(bot) -> Callable[[list], None]:
+    """Функция «обработать пачку апдейтов до конца» для вызова из потока воркера."""
+    if MODE == "async":
+        def process(updates):
+            run_coro(bot.process_new_updates(updates))
+        return process
+    return bot.process_new_updates
+
+
+def run_webhook(bot, handlers: HandlerRegistry, server, url: str = "", chats=None, accept=None,
+                done=None) -> None:
+    """
+    Поставить хендлеры, (пере)зарегистрировать webhook в Telegram, если задан
+    публичный url, и обслуживать апдейты через WebhookServer до Ctrl+C.
+    """
+    install(bot, handlers)
+    _wrap(bot, chats, accept, done)
+    server.process = update_processor(bot)
+    if MODE == "async":
+        asyncio.run(_webhook_async(bot, server, url))
+        return
+    if url:
+        bot.set_webhook(url=url, secret_token=server.secret, max_connections=server.workers * 10)
+    server.start()
+    try:
+        threading.Event().wait()
+    finally:
+        server.stop()
+
+
+def serve_queue(bot, handlers: HandlerRegistry, source, chats=None, accept=None) -> None:
+    """
+    Поставить хендлеры и обрабатывать апдейты из очереди source (процесс-шард,
+    kp_bot.shards): элемент — список апдейтов в JSON, None — доделать начатое и выйти.
+    """
+    install(bot, handlers)
+    _wrap(bot, chats, accept)
+    if MODE == "async":
+        asyncio.run(_serve_queue_async(bot, source, chats))
+        return
+    while True:
+        batch = source.get()
+        if batch is None:
+            return
+        bot.process_new_updates([telebot.types.Update.de_json(u) for u in batch])
+
+
+async def _serve_queue_async(bot, source, chats) -> None:
+    global LOOP
+    LOOP = asyncio.get_running_loop()
+    tasks = set()
+    while True:
+        batch = await asyncio.to_thread(source.get)
+        if batch is None:
+            break
+        task = asyncio.create_task(bot.process_new_updates([telebot.types.Update.de_json(u) for u in batch]))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+    while chats is not None and chats.pending():   # задачи чатов живут в этом же loop'е
+        await asyncio.sleep(0.05)
+
+
+async def _webhook_async(bot, server, url: str) -> None:
+    global LOOP
+    LOOP = asyncio.get_running_loop()
+    if url:
+        await bot.set_webhook(url=url, secret_token=server.secret, max_connections=server.workers * 10)
+    server.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        server.stop()
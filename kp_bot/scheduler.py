@@ -0,0 +1,124 @@
+# kp_bot/scheduler.py
+"""
+Единый планировщик отложенных задач (удаление временных сообщений, отложенный показ шага).
+
+Вместо threading.Timer на каждую задачу — одна куча (heap) по времени срабатывания
+и один поток, который спит до ближайшей задачи. Сам поток задачи не выполняет:
+он передаёт их в `dispatch` (пул потоков / event loop), поэтому медленный вызов
+Telegram не сдвигает остальные таймеры.
+
+Задачу можно снять по ключу (`key`): например, отложенный показ шага отменяется,
+если пользователь уже ушёл дальше.
+"""
+from __future__ import annotations
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Callable, Dict, Hashable, List, Optional
+
+log = logging.getLogger("kp-bot-scheduler")
+
+
+class Job:
+    __slots__ = ("when", "fn", "args", "key", "cancelled")
+
+    def __init__(self, when: float, fn: Callable, args: tuple, key: Optional[Hashable]):
+        self.when = when
+        self.fn = fn
+        self.args = args
+        self.key = key
+        self.cancelled = False
+
+
+class Scheduler:
+    def __init__(self, dispatch: Callable[[Callable, tuple], None]):
+        self._dispatch = dispatch
+        self._heap: List[tuple] = []
+        self._seq = itertools.count()              # порядок задач с одинаковым временем
+        self._by_key: Dict[Hashable, Job] = {}
+        self._pending = 0
+        self._cv = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+
+        self.fired = 0
+        self.cancelled = 0
+        self.max_lag = 0.0                          # худшее опоздание срабатывания, сек
+
+    # ---------- API ----------
+    def schedule(self, delay: float, fn: Callable, *args, key: Optional[Hashable] = None) -> Job:
+        """Выполнить fn(*args) через delay секунд. Задача с тем же key заменяет предыдущую."""
+        job = Job(time.monotonic() + max(0.0, delay), fn, args, key)
+        with self._cv:
+            if key is not None:
+                self._cancel_locked(self._by_key.get(key))
+                self._by_key[key] = job
+            heapq.heappush(self._heap, (job.when, next(self._seq), job))
+            self._pending += 1
+            self._ensure_thread()
+            self._cv.notify()
+        return job
+
+    def cancel(self, key: Hashable) -> bool:
+        """Снять задачу по ключу. True — если было что снимать."""
+        with self._cv:
+            return self._cancel_locked(self._by_key.get(key))
+
+    def depth(self) -> int:
+        """Сколько задач ждёт срабатывания (без отменённых)."""
+        return self._pending
+
+    def stats(self) -> dict:
+        return {"depth": self._pending, "fired": self.fired,
+                "cancelled": self.cancelled, "max_lag_ms": round(self.max_lag * 1000, 1)}
+
+    def stop(self) -> None:
+        with self._cv:
+            self._stopped = True
+            self._cv.notify()
+
+    # ---------- внутреннее ----------
+    def _cancel_locked(self, job: Optional[Job]) -> bool:
+        if job is None or job.cancelled:
+            return False
+        job.cancelled = True            # из кучи удалится лениво, когда дойдёт очередь
+        self._pending -= 1
+        self.cancelled += 1
+        if job.key is not None and self._by_key.get(job.key) is job:
+            del self._by_key[job.key]
+        return True
+
+    def _ensure_thread(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped = False
+            self._thread = threading.Thread(target=self._loop, name="scheduler", daemon=True)
+            self._thread.start()
+
+    def _loop(self) -> None:
+        while True:
+            with self._cv:
+                while not self._stopped:
+                    while self._heap and self._heap[0][2].cancelled:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._cv.wait()
+                        continue
+                    wait = self._heap[0][0] - time.monotonic()
+                    if wait <= 0:
+                        break
+                    self._cv.wait(wait)
+                if self._stopped:
+                    return
+                _, _, job = heapq.heappop(self._heap)
+                self._pending -= 1
+                if job.key is not None and self._by_key.get(job.key) is job:
+                    del self._by_key[job.key]
+                self.fired += 1
+                self.max_lag = max(self.max_lag, time.monotonic() - job.when)
+            try:
+                self._dispatch(job.fn, job.args)
+            except Exception:
+                log.exception("scheduler dispatch failed")
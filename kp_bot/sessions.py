@@ -0,0 +1,470 @@
+# kp_bot/sessions.py
+"""
+Хранилище пользовательских сессий бота (то, что раньше было `USER: Dict[int, dict]`).
+
+- SessionStore  — интерфейс бэкенда (MemoryStore / SQLiteStore);
+- SessionCache  — ограниченный LRU «горячих» чатов поверх бэкенда:
+  отложенная запись (write-behind) и выгрузка простаивающих сессий;
+  с журналом (kp_bot.journal) каждое commit() сразу попадает на диск.
+
+SessionCache ведёт себя как dict (`USER[ch]`, `ch in USER`, `USER.get(ch, {})`),
+поэтому код main.py работает с ним как раньше. Сами сессии — dict'ы или, с
+factory=ChatSession.load, компактные объекты kp_bot.compact (JSON тот же).
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from .compact import ChatSession
+from .journal import SessionJournal
+
+log = logging.getLogger("kp-bot-sessions")
+
+
+# =========================
+# СЕРИАЛИЗАЦИЯ
+# =========================
+def _default(o):
+    if isinstance(o, ChatSession):
+        return o.dump()
+    # multiselect_ctx["selected"] — это set; JSON его не умеет
+    if isinstance(o, (set, frozenset)):
+        return {"__set__": sorted(o, key=str)}
+    if isinstance(o, tuple):
+        return list(o)
+    raise TypeError(f"not JSON serializable: {type(o).__name__}")
+
+
+def _hook(d: dict):
+    if len(d) == 1 and "__set__" in d:
+        return set(d["__set__"])
+    return d
+
+
+def encode_session(s: dict) -> str:
+    return json.dumps(s, ensure_ascii=False, separators=(",", ":"), default=_default)
+
+
+def decode_session(raw: str) -> dict:
+    return json.loads(raw, object_hook=_hook)
+
+
+# =========================
+# БЭКЕНДЫ
+# =========================
+class SessionStore:
+    """Интерфейс бэкенда: хранит закодированные сессии по chat_id."""
+
+    def load(self, ch: int) -> Optional[dict]:
+        raise NotImplementedError
+
+    def save_many(self, items: Iterable[Tuple[int, str]]) -> None:
+        """Записать пачку (chat_id, encoded) одной транзакцией."""
+        raise NotImplementedError
+
+    def delete(self, ch: int) -> None:
+        raise NotImplementedError
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryStore(SessionStore):
+    """Бэкенд в памяти (для разработки и тестов — после рестарта всё теряется)."""
+
+    def __init__(self):
+        self._data: Dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def load(self, ch: int) -> Optional[dict]:
+        with self._lock:
+            raw = self._data.get(ch)
+        return decode_session(raw) if raw is not None else None
+
+    def save_many(self, items: Iterable[Tuple[int, str]]) -> None:
+        with self._lock:
+            for ch, raw in items:
+                self._data[ch] = raw
+
+    def delete(self, ch: int) -> None:
+        with self._lock:
+            self._data.pop(ch, None)
+
+    def count(self) -> int:
+        return len(self._data)
+
+
+class SQLiteStore(SessionStore):
+    """Сессии в SQLite (WAL): одна строка JSON на чат."""
+
+    def __init__(self, path: str):
+        d = os.path.dirname(os.path.abspath(path))
+        os.makedirs(d, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS bot_session ("
+            " chat_id INTEGER PRIMARY KEY,"
+            " data TEXT NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+
+    def load(self, ch: int) -> Optional[dict]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT data FROM bot_session WHERE chat_id = ?", (ch,)
+            ).fetchone()
+        return decode_session(row[0]) if row else None
+
+    def save_many(self, items: Iterable[Tuple[int, str]]) -> None:
+        now = time.time()
+        rows = [(ch, raw, now) for ch, raw in items]
+        if not rows:
+            return
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany(
+                    "INSERT INTO bot_session (chat_id, data, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(chat_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                    rows,
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def delete(self, ch: int) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM bot_session WHERE chat_id = ?", (ch,))
+
+    def count(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM bot_session").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+# =========================
+# LRU ГОРЯЧИХ ЧАТОВ
+# =========================
+class SessionCache:
+    """
+    dict-подобный фасад над SessionStore.
+
+    - в памяти держим не больше `max_hot` сессий (LRU), остальное — в бэкенде;
+    - вызывающий код меняет сессию на месте и фиксирует изменение commit(ch)
+      (или присваиванием `USER[ch] = ...`) — такая сессия «грязная», фоновый
+      поток раз в `flush_interval` секунд пишет грязные сессии в бэкенд;
+    - сессии, к которым не обращались дольше `idle_ttl`, выгружаются из памяти;
+      при выгрузке сессия пишется, если отличается от записанной версии (даже
+      без commit). Сессии, к которым обращались за последние `in_use_ttl`
+      секунд, не выгружаются и сверх `max_hot`: их может менять хендлер;
+    - записи в бэкенд идут строго в порядке кодирования (номерок на пачку):
+      пачка, закодированная раньше, не затрёт более новую версию;
+    - если задан `journal`, commit(ch) дописывает сессию в журнал, а раз в
+      `checkpoint_interval` секунд журнал сворачивается в бэкенд (checkpoint);
+    - `factory` превращает загруженный из бэкенда dict в объект сессии.
+    """
+
+    def __init__(self, store: SessionStore, max_hot: int = 5000,
+                 idle_ttl: float = 900.0, flush_interval: float = 2.0,
+                 journal: Optional[SessionJournal] = None, checkpoint_interval: float = 30.0,
+                 factory: Optional[Callable[[dict], object]] = None, in_use_ttl: float = 30.0):
+        self.store = store
+        self.factory = factory
+        self.journal = journal
+        self.checkpoint_interval = float(checkpoint_interval)
+        self.max_hot = max(1, int(max_hot))
+        self.idle_ttl = float(idle_ttl)
+        self.flush_interval = float(flush_interval)
+        self.in_use_ttl = float(in_use_ttl)
+
+        self._hot: "OrderedDict[int, dict]" = OrderedDict()
+        self._seen: Dict[int, float] = {}      # chat_id -> время последнего обращения
+        self._saved: Dict[int, int] = {}       # chat_id -> hash последней записанной версии
+        self._journaled: Dict[int, int] = {}   # chat_id -> hash последней версии в журнале
+        self._dirty: set = set()
+        self._lock = threading.RLock()
+        self._wturn = threading.Condition()     # очередь записей в бэкенд по номеркам
+        self._tickets = 0                       # выдано номерков (под _lock, вместе с кодированием)
+        self._turn = 0                          # чей номерок пишет сейчас
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # ---------- dict-протокол ----------
+    def __getitem__(self, ch: int) -> dict:
+        with self._lock:
+            s = self._hot.get(ch)
+            if s is not None:
+                self.hits += 1
+                self._touch(ch)
+                return s
+        s = self.store.load(ch)
+        if s is None:
+            raise KeyError(ch)
+        if self.factory is not None:
+            s = self.factory(s)
+        with self._lock:
+            self.misses += 1
+            # пока грузили, сессию мог положить другой поток
+            cur = self._hot.get(ch)
+            if cur is not None:
+                self._touch(ch)
+                return cur
+            self._hot[ch] = s
+            self._saved[ch] = hash(encode_session(s))
+            self._touch(ch)
+            evicted, ticket = self._shrink()
+        self._write(evicted, ticket)
+        return s
+
+    def __setitem__(self, ch: int, s: dict) -> None:
+        with self._lock:
+            self._hot[ch] = s
+            self._saved.pop(ch, None)
+            self._touch(ch)
+            self.commit(ch)
+            evicted, ticket = self._shrink()
+        self._write(evicted, ticket)
+
+    def __delitem__(self, ch: int) -> None:
+        with self._lock:
+            self._forget(ch)
+            if self.journal:
+                self.journal.append(ch, None)
+            ticket = self._ticket()
+        self._write([(ch, None)], ticket)
+
+    def __contains__(self, ch: int) -> bool:
+        try:
+            self[ch]
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self) -> int:
+        return len(self._hot)
+
+    def get(self, ch: int, default=None):
+        try:
+            return self[ch]
+        except KeyError:
+            return default
+
+    def pop(self, ch: int, default=None):
+        s = self.get(ch, default)
+        if ch in self._hot:
+            del self[ch]
+        return s
+
+    # ---------- внутреннее ----------
+    def _touch(self, ch: int) -> None:
+        self._hot.move_to_end(ch)
+        self._seen[ch] = time.monotonic()
+
+    def _forget(self, ch: int) -> Optional[dict]:
+        s = self._hot.pop(ch, None)
+        self._seen.pop(ch, None)
+        self._saved.pop(ch, None)
+        self._journaled.pop(ch, None)
+        self._dirty.discard(ch)
+        return s
+
+    def _encode_changed(self, ch: int, s: dict) -> Optional[str]:
+        raw = encode_session(s)
+        hsh = hash(raw)
+        if self._saved.get(ch) == hsh:
+            return None
+        self._saved[ch] = hsh
+        return raw
+
+    def _shrink(self) -> Tuple[list, Optional[int]]:
+        """Вытесняем LRU сверх лимита; вернуть то, что нужно дописать в бэкенд, и номерок записи."""
+        out = []
+        in_use = time.monotonic() - self.in_use_ttl
+        while len(self._hot) > self.max_hot:
+            ch, s = next(iter(self._hot.items()))
+            if self._seen.get(ch, 0.0) > in_use:
+                break                       # LRU и тот в работе — остальные тем более
+            out.extend(self._evict(ch, s))
+        return out, (self._ticket() if out else None)
+
+    def _evict(self, ch: int, s) -> list:
+        # сравниваем всю сессию, а не только грязные: изменение могло ещё не дойти до commit
+        raw = self._encode_changed(ch, s)
+        self._forget(ch)
+        self.evictions += 1
+        return [(ch, raw)] if raw is not None else []
+
+    def _ticket(self) -> int:
+        """Номерок на запись пачки; берётся под _lock вместе с кодированием — в том же порядке и пишем."""
+        t = self._tickets
+        self._tickets += 1
+        return t
+
+    def _write(self, items: list, ticket: Optional[int]) -> None:
+        """Записать пачку (chat_id, encoded; None — удалить) в свою очередь; ticket None — писать нечего."""
+        if ticket is None:
+            return
+        with self._wturn:
+            while self._turn != ticket:
+                self._wturn.wait()
+        try:
+            puts = [(ch, raw) for ch, raw in items if raw is not None]
+            if puts:
+                self.store.save_many(puts)
+            for ch, raw in items:
+                if raw is None:
+                    self.store.delete(ch)
+        finally:
+            with self._wturn:
+                self._turn += 1
+                self._wturn.notify_all()
+
+    # ---------- публичное API ----------
+    def commit(self, ch: int) -> None:
+        """Зафиксировать изменение сессии: пометить грязной и, если включён журнал, дописать в него."""
+        with self._lock:
+            s = self._hot.get(ch)
+        if s is None:
+            # выгрузили между обращением и commit: выгрузка записала сессию со всеми
+            # изменениями, сделанными до неё, — поднимаем её обратно и фиксируем
+            if self.get(ch) is None:
+                return
+        with self._lock:
+            s = self._hot.get(ch)
+            if s is None:
+                return
+            self._dirty.add(ch)
+            if not self.journal:
+                return
+            raw = encode_session(s)
+            hsh = hash(raw)
+            if self._journaled.get(ch) == hsh:
+                return
+            self._journaled[ch] = hsh
+            self.journal.append(ch, raw)
+
+    def checkpoint(self, everything: bool = False) -> int:
+        """Свернуть журнал: ротация → сброс грязных сессий в бэкенд → удаление старого журнала."""
+        if not self.journal:
+            return self.flush(everything)
+        self.journal.rotate()
+        n = self.flush(everything)
+        self.journal.drop_rotated()
+        return n
+
+    def recover(self) -> int:
+        """
+        Тёплый рестарт: накатить журнал на бэкенд одной транзакцией.
+        Сессии не грузятся в память — они подтянутся лениво при следующем апдейте.
+        """
+        if not self.journal:
+            return 0
+        last = self.journal.replay()
+        puts = [(ch, raw) for ch, raw in last.items() if raw is not None]
+        self.store.save_many(puts)
+        for ch, raw in last.items():
+            if raw is None:
+                self.store.delete(ch)
+        with self._lock:
+            for ch in last:                 # горячие копии могли устареть
+                self._forget(ch)
+        self.journal.rotate()
+        self.journal.drop_rotated()
+        return len(last)
+
+    def flush(self, everything: bool = False) -> int:
+        """
+        Записать изменившиеся сессии в бэкенд. Возвращает число записанных.
+        everything — проверить все горячие сессии, а не только грязные (остановка).
+        """
+        with self._lock:
+            items = []
+            for ch in (list(self._hot) if everything else self._dirty):
+                s = self._hot.get(ch)
+                if s is None:
+                    continue
+                raw = self._encode_changed(ch, s)
+                if raw is not None:
+                    items.append((ch, raw))
+            self._dirty.clear()
+            ticket = self._ticket() if items else None
+        self._write(items, ticket)
+        return len(items)
+
+    def evict_idle(self, now: float | None = None) -> int:
+        """Выгрузить из памяти сессии, простаивающие дольше idle_ttl."""
+        now = time.monotonic() if now is None else now
+        ttl = max(self.idle_ttl, self.in_use_ttl)
+        items, n = [], 0
+        with self._lock:
+            for ch in list(self._hot):              # порядок LRU: старые — первыми
+                if now - self._seen.get(ch, now) < ttl:
+                    break
+                items.extend(self._evict(ch, self._hot[ch]))
+                n += 1
+            ticket = self._ticket() if items else None
+        self._write(items, ticket)
+        return n
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hot": len(self._hot),
+                "dirty": len(self._dirty),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def start(self) -> None:
+        """Запустить фоновый поток write-behind + idle eviction."""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="session-flush", daemon=True)
+        self._thread.start()
+
+    def _loop(self) -> None:
+        last_cp = time.monotonic()
+        while not self._stop.wait(self.flush_interval):
+            try:
+                if self.journal and time.monotonic() - last_cp >= self.checkpoint_interval:
+                    self.checkpoint()
+                    last_cp = time.monotonic()
+                else:
+                    self.flush()
+                self.evict_idle()
+            except Exception:
+                log.exception("session flush failed")
+
+    def close(self) -> None:
+        """Остановить фоновый поток и сбросить всё на диск."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=self.flush_interval + 1)
+        self.checkpoint(everything=True)
+        if self.journal:
+            self.journal.close()
+        self.store.close()
@@ -0,0 +1,271 @@
+# kp_bot/shards.py
+"""
+Несколько процессов бота (шардов) за одним приёмником апдейтов.
+
+Хендлеры (клавиатуры, Jinja, разбор контактов) упираются в GIL одного
+процесса. В режиме шардов:
+
+- приёмник — один на бота (long polling или webhook): Telegram не даёт
+  нескольким процессам читать getUpdates одного токена;
+- ShardSupervisor запускает N процессов-шардов и отдаёт каждый апдейт
+  шарду, выбранному по consistent hash chat_id (HashRing): чат всегда
+  обслуживает один и тот же процесс, поэтому его сессия в памяти
+  (SessionCache) и порядок апдейтов остаются «своими»;
+- общее состояние — в постоянных хранилищах (SQLite сессий, номеров и
+  индекса КП); журнал сессий у каждого шарда свой;
+- упавший шард перезапускается (с паузой, растущей при частых падениях),
+  остальные шарды и приёмник продолжают работать; каждый новый процесс
+  шарда читает из новой очереди: процесс, убитый в ожидании апдейтов
+  (SIGKILL, OOM), умирает с захваченной блокировкой чтения своей очереди, и
+  из неё уже никто не прочитает. Что можно забрать из старой очереди,
+  переносится в новую, остальное считается в stranded;
+- если умер сам супервизор, шарды доделывают свою очередь и выходят.
+
+Шард запускается методом spawn, функция шарда передаётся по ссылке: если она
+объявлена в запускаемом скрипте, дочерний процесс импортирует его заново —
+запуск бота в нём должен быть под `if __name__ == "__main__"` (как в main.py).
+"""
+from __future__ import annotations
+
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from telebot import apihelper
+
+log = logging.getLogger("kp-bot-shards")
+
+SHARD_ENV = "KP_SHARD"      # номер шарда в окружении дочернего процесса
+_CHAT_KINDS = ("message", "edited_message", "channel_post", "edited_channel_post", "callback_query",
+               "my_chat_member", "chat_member", "chat_join_request")
+
+
+def chat_of(update: dict) -> Optional[int]:
+    """chat_id апдейта в JSON-виде (как пришёл от Telegram); None — апдейт без чата."""
+    for kind in _CHAT_KINDS:
+        obj = update.get(kind)
+        if obj is None:
+            continue
+        if kind == "callback_query":
+            msg = obj.get("message")
+            return msg["chat"]["id"] if msg else obj["from"]["id"]
+        return obj["chat"]["id"]
+    for obj in update.values():            # inline_query и прочие — по отправителю
+        if isinstance(obj, dict) and isinstance(obj.get("from"), dict):
+            return obj["from"]["id"]
+    return None
+
+
+def _point(s: str) -> int:
+    return int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Consistent hashing: у каждого шарда vnodes точек на кольце, ключ — к
+    ближайшей точке по часовой стрелке. При смене числа шардов переезжает
+    ~1/N чатов, а не почти все (как при chat_id % N).
+    """
+
+    def __init__(self, shards: int, vnodes: int = 128):
+        self.shards = max(1, int(shards))
+        ring = sorted((_point(f"shard-{i}#{v}"), i) for i in range(self.shards) for v in range(vnodes))
+        self._points = [p for p, _ in ring]
+        self._owners = [i for _, i in ring]
+
+    def shard(self, key) -> int:
+        if self.shards == 1:
+            return 0
+        i = bisect.bisect(self._points, _point(str(key)))
+        return self._owners[i % len(self._owners)]
+
+
+def _shard_main(target: Callable, index: int, updates) -> None:
+    """Точка входа процесса-шарда: target(index, updates) + выход вслед за супервизором."""
+    parent = multiprocessing.parent_process()
+
+    def watch_parent():
+        multiprocessing.connection.wait([parent.sentinel])
+        updates.put(None)           # после уже стоящих в очереди апдейтов
+
+    if parent is not None:
+        threading.Thread(target=watch_parent, name="shard-parent-watch", daemon=True).start()
+    target(index, updates)
+
+
+class ShardSupervisor:
+    """
+    N процессов target(index, updates): updates — очередь шарда, элемент —
+    список апдейтов в JSON (dict), None — остановиться.
+    """
+
+    def __init__(self, shards: int, target: Callable, queue_size: int = 1000, name: str = "kp-shard"):
+        self.ring = HashRing(shards)
+        self.shards = self.ring.shards
+        self.target = target
+        self.name = name
+        self.queue_size = max(1, int(queue_size))
+        self._ctx = multiprocessing.get_context("spawn")
+        self._queues = [self._ctx.Queue(maxsize=self.queue_size) for _ in range(self.shards)]
+        self._procs: List[Optional[multiprocessing.process.BaseProcess]] = [None] * self.shards
+        self._lock = threading.Lock()
+        self._qlock = threading.Lock()       # route() против замены очереди шарда
+        self._stop = threading.Event()
+        self._monitor: Optional[threading.Thread] = None
+        self._crashes: Dict[int, List[float]] = {i: [] for i in range(self.shards)}
+        self._next_start = [0.0] * self.shards
+
+        self.routed = [0] * self.shards
+        self.dropped = [0] * self.shards     # очередь шарда полна
+        self.restarts = [0] * self.shards
+        self.stranded = [0] * self.shards    # пачек, оставшихся в очереди умершего процесса
+
+    # ---------- маршрутизация ----------
+    def route(self, updates: List[dict]) -> int:
+        """Разложить апдейты по шардам (порядок внутри чата сохраняется); вернуть, сколько отброшено."""
+        batches: Dict[int, List[dict]] = {}
+        for u in updates:
+            batches.setdefault(self.ring.shard(chat_of(u)), []).append(u)
+        lost = 0
+        with self._qlock:
+            for i, batch in batches.items():
+                try:
+                    self._queues[i].put_nowait(batch)
+                except queue.Full:
+                    lost += len(batch)
+                    with self._lock:
+                        self.dropped[i] += len(batch)
+                    log.warning(f"shard {i}: queue full, {len(batch)} updates dropped")
+                    continue
+                with self._lock:
+                    self.routed[i] += len(batch)
+        return lost
+
+    # ---------- процессы ----------
+    def start(self) -> None:
+        for i in range(self.shards):
+            self._spawn(i)
+        self._monitor = threading.Thread(target=self._watch, name=f"{self.name}-watch", daemon=True)
+        self._monitor.start()
+
+    def _spawn(self, i: int) -> None:
+        p = self._ctx.Process(target=_shard_main, args=(self.target, i, self._queues[i]), name=f"{self.name}-{i}")
+        with self._lock:
+            prev = os.environ.get(SHARD_ENV)
+            os.environ[SHARD_ENV] = str(i)          # дочерний процесс читает его при импорте настроек
+            try:
+                p.start()
+            finally:
+                if prev is None:
+                    os.environ.pop(SHARD_ENV, None)
+                else:
+                    os.environ[SHARD_ENV] = prev
+            self._procs[i] = p
+        log.info(f"shard {i}: started pid={p.pid}")
+
+    def _replace_queue(self, i: int) -> None:
+        """Новая очередь для следующего процесса шарда i; забираемое из старой — туда же, по порядку."""
+        with self._qlock:
+            old, new = self._queues[i], self._ctx.Queue(maxsize=self.queue_size)
+            moved = 0
+            while True:
+                try:
+                    # блокировку чтения держит умерший процесс — get не дождётся её и вернёт Empty
+                    new.put_nowait(old.get(timeout=0.2))
+                except queue.Empty:
+                    break
+                moved += 1
+            try:
+                left = old.qsize()
+            except NotImplementedError:     # macOS
+                left = 0
+            old.cancel_join_thread()        # недоставленное в старую очередь больше никому не нужно
+            old.close()
+            self._queues[i] = new
+            with self._lock:
+                self.stranded[i] += left
+        if left:
+            log.error(f"shard {i}: {left} update batches lost with the dead process' queue ({moved} moved)")
+        elif moved:
+            log.info(f"shard {i}: {moved} update batches moved to the new queue")
+
+    def _watch(self) -> None:
+        while not self._stop.is_set():
+            now = time.monotonic()
+            for i, p in enumerate(self._procs):
+                if p is None or p.is_alive() or self._stop.is_set():
+                    continue
+                if not self._next_start[i]:
+                    recent = [t for t in self._crashes[i] if now - t < 300] + [now]
+                    self._crashes[i] = recent
+                    delay = min(60.0, 2.0 ** (len(recent) - 1)) if len(recent) > 1 else 0.0
+                    self._next_start[i] = now + delay
+                    log.error(f"shard {i}: exited with code {p.exitcode}, restart in {delay:.0f}s")
+                    self._replace_queue(i)      # апдейты, пришедшие за паузу, ждут новый процесс в новой очереди
+                if now >= self._next_start[i]:
+                    self._next_start[i] = 0.0
+                    with self._lock:
+                        self.restarts[i] += 1
+                    self._spawn(i)
+            # просыпаемся сразу по смерти шарда: чем раньше замена очереди, тем меньше апдейтов в старой
+            live = [p.sentinel for i, p in enumerate(self._procs) if p is not None and not self._next_start[i]]
+            timeout = min([1.0] + [max(0.0, t - time.monotonic()) for t in self._next_start if t])
+            if live:
+                multiprocessing.connection.wait(live, timeout)
+            else:
+                self._stop.wait(timeout)
+
+    def close(self, timeout: float = 30.0) -> None:
+        """Попросить шарды доделать очередь и выйти; не успевшие за timeout — завершить."""
+        self._stop.set()
+        with self._qlock:
+            for q in self._queues:
+                try:
+                    q.put(None, timeout=1.0)
+                except queue.Full:
+                    pass
+        deadline = time.monotonic() + timeout
+        for i, p in enumerate(self._procs):
+            if p is None:
+                continue
+            p.join(max(0.0, deadline - time.monotonic()))
+            if p.is_alive():
+                log.warning(f"shard {i}: did not stop in time, terminating")
+                p.terminate()
+                p.join(5)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "shards": self.shards,
+                "alive": sum(1 for p in self._procs if p is not None and p.is_alive()),
+                "pids": [p.pid if p is not None else None for p in self._procs],
+                "routed": list(self.routed), "dropped": list(self.dropped), "restarts": list(self.restarts),
+                "stranded": list(self.stranded),
+            }
+
+
+def poll_updates(token: str, handle: Callable[[List[dict]], None], stop: Optional[threading.Event] = None,
+                 timeout: int = 20) -> None:
+    """Long polling без разбора апдейтов: handle(список JSON) на каждую непустую пачку, до stop."""
+    stop = stop or threading.Event()
+    offset, pause = None, 0.25
+    while not stop.is_set():
+        try:
+            updates = apihelper.get_updates(token, offset=offset, timeout=timeout, long_polling_timeout=timeout)
+        except Exception as e:
+            log.warning(f"getUpdates failed: {e}; retry in {pause:.1f}s")
+            stop.wait(pause)
+            pause = min(pause * 2, 30.0)
+            continue
+        pause = 0.25
+        if updates:
+            offset = updates[-1]["update_id"] + 1
+            handle(updates)
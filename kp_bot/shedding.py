@@ -0,0 +1,125 @@
+# kp_bot/shedding.py
+"""
+Сброс второстепенной работы под нагрузкой.
+
+Когда апдейты копятся (Telegram ограничивает исходящие вызовы, медленный
+диск, всплеск заявок), каждый апдейт всё равно обслуживался полностью:
+фото на /start, временные «✅ …», удаление сообщений пользователя. Эти
+вызовы стоят в той же очереди к Bot API, что и анкета с КП.
+
+LoadShedder следит за «давлением» — max(глубина очереди / порог, задержка
+«апдейт принят → обработан» (p90 за window сек.) / порог) — и держит уровень:
+
+    0 normal   — всё как обычно;
+    1 cosmetic — давление ≥ 1: без приветственного фото и временных уведомлений;
+    2 minimal  — давление ≥ 2: ещё и без удаления сообщений.
+
+Анкета (экраны шагов) и доставка КП не сбрасываются никогда. Уровень
+поднимается сразу, опускается на ступень, только когда давление hold секунд
+держится ниже порога текущего уровня с запасом (без «дребезга»).
+"""
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from collections import Counter, deque
+from typing import Callable, Dict, List, Tuple
+
+log = logging.getLogger("kp-bot-shed")
+
+LEVELS = ("normal", "cosmetic", "minimal")
+SHED_AT = {"photo": 1, "temp": 1, "delete": 2}    # вид работы -> с какого уровня она сбрасывается
+DOWN_MARGIN = 0.8                                  # опуститься с уровня L — при давлении < L * DOWN_MARGIN
+
+
+class LoadShedder:
+    def __init__(self, latency_high: float, window: float = 5.0, hold: float = 10.0,
+                 interval: float = 0.5, enabled: bool = True):
+        self.latency_high = latency_high    # сек.; 0 — задержку не учитываем
+        self.window = window
+        self.hold = hold
+        self.interval = interval
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._gauges: List[Tuple[str, Callable[[], float], float]] = []
+        self._lat: deque = deque(maxlen=2000)    # (когда, задержка сек.)
+        self._checked = 0.0
+        self._calm_since = 0.0                   # с какого момента давление ниже порога выхода
+        self._level = 0
+        self._pressure = 0.0
+        self._last: Dict[str, float] = {}
+
+        self.shed: Counter = Counter(dict.fromkeys(SHED_AT, 0))
+        self.raised = 0
+
+    def add_gauge(self, name: str, fn: Callable[[], float], high: float) -> None:
+        """Очередь, глубина которой fn() == high означает давление 1."""
+        if high > 0:
+            self._gauges.append((name, fn, float(high)))
+
+    def observe(self, latency: float) -> None:
+        """Задержка обработки одного апдейта (от приёма до конца хендлера), сек."""
+        self._lat.append((time.monotonic(), latency))
+
+    def level(self) -> int:
+        if not self.enabled:
+            return 0
+        now = time.monotonic()
+        if now - self._checked >= self.interval:
+            with self._lock:
+                if now - self._checked >= self.interval:
+                    self._checked = now
+                    self._update(now)
+        return self._level
+
+    def skip(self, kind: str) -> bool:
+        """True — работу вида kind (SHED_AT) сейчас не делаем; считается в shed."""
+        if self.level() < SHED_AT[kind]:
+            return False
+        with self._lock:
+            self.shed[kind] += 1
+        return True
+
+    def stats(self) -> dict:
+        level = self.level()
+        with self._lock:
+            return {"level": level, "mode": LEVELS[level], "pressure": round(self._pressure, 2),
+                    **self._last, "raised": self.raised, "shed": dict(self.shed)}
+
+    # ---------- внутреннее ----------
+    def _latency_p90(self, now: float) -> float:
+        recent = sorted(lat for t, lat in list(self._lat) if now - t <= self.window)
+        return recent[int(len(recent) * 0.9)] if recent else 0.0
+
+    def _update(self, now: float) -> None:
+        parts: Dict[str, float] = {}
+        pressure = 0.0
+        for name, fn, high in self._gauges:
+            try:
+                v = float(fn())
+            except Exception:
+                continue
+            parts[name] = v
+            pressure = max(pressure, v / high)
+        if self.latency_high > 0:
+            p90 = self._latency_p90(now)
+            parts["latency_p90_ms"] = round(p90 * 1000, 1)
+            pressure = max(pressure, p90 / self.latency_high)
+        self._pressure, self._last = pressure, parts
+
+        target = min(len(LEVELS) - 1, int(pressure))
+        if target > self._level:
+            self.raised += 1
+            log.warning(f"load shedding: {LEVELS[self._level]} -> {LEVELS[target]} (pressure {pressure:.2f}, {parts})")
+            self._level, self._calm_since = target, 0.0
+        elif self._level and pressure < self._level * DOWN_MARGIN:
+            if not self._calm_since:
+                self._calm_since = now
+            elif now - self._calm_since >= self.hold:
+                log.info(f"load shedding: {LEVELS[self._level]} -> {LEVELS[self._level - 1]} "
+                         f"(pressure {pressure:.2f})")
+                self._level -= 1
+                self._calm_since = now      # следующая ступень — ещё через hold
+        else:
+            self._calm_since = 0.0
@@ -0,0 +1,103 @@
+# kp_bot/states.py
+"""
+Хранилище FSM-состояний telebot прямо в сессии USER[ch].
+
+Штатный StateMemoryStorage живёт только в памяти процесса, поэтому после рестарта
+пользователь, застрявший на текстовом вводе (имя, контакты, «Свой вариант»),
+переставал получать ответы. Здесь состояние — это ключи "state"/"state_data"
+сессии, и они сохраняются/журналируются вместе с анкетой.
+"""
+from __future__ import annotations
+
+from telebot.storage import StateStorageBase
+
+from .sessions import SessionCache
+
+
+def _state_name(state) -> str:
+    return state.name if hasattr(state, "name") else str(state)
+
+
+class SessionStateStorage(StateStorageBase):
+    # user_id не используем: бот работает в личных чатах, где chat_id == user_id.
+    # *args/**kwargs — совместимость с новыми версиями telebot (business_connection_id и т.п.)
+
+    def __init__(self, sessions: SessionCache):
+        super().__init__()
+        self.sessions = sessions
+
+    def set_state(self, chat_id, user_id, state, *args, **kwargs) -> bool:
+        s = self.sessions.get(chat_id)
+        if s is None:
+            return False
+        s["state"] = _state_name(state)
+        self.sessions.commit(chat_id)
+        return True
+
+    def get_state(self, chat_id, user_id, *args, **kwargs):
+        return (self.sessions.get(chat_id) or {}).get("state")
+
+    def delete_state(self, chat_id, user_id, *args, **kwargs) -> bool:
+        s = self.sessions.get(chat_id)
+        if not s or s.get("state") is None:
+            return False
+        s["state"] = None
+        s.pop("state_data", None)
+        self.sessions.commit(chat_id)
+        return True
+
+    def get_data(self, chat_id, user_id, *args, **kwargs) -> dict:
+        s = self.sessions.get(chat_id)
+        return s.setdefault("state_data", {}) if s is not None else {}
+
+    def set_data(self, chat_id, user_id, key, value, *args, **kwargs) -> bool:
+        s = self.sessions.get(chat_id)
+        if s is None:
+            return False
+        s.setdefault("state_data", {})[key] = value
+        self.sessions.commit(chat_id)
+        return True
+
+    def reset_data(self, chat_id, user_id, *args, **kwargs) -> bool:
+        s = self.sessions.get(chat_id)
+        if s is None:
+            return False
+        s["state_data"] = {}
+        self.sessions.commit(chat_id)
+        return True
+
+    def save(self, chat_id, user_id, data, *args, **kwargs) -> bool:
+        s = self.sessions.get(chat_id)
+        if s is None:
+            return False
+        s["state_data"] = dict(data or {})
+        self.sessions.commit(chat_id)
+        return True
+
+
+class AsyncSessionStateStorage:
+    """То же хранилище для AsyncTeleBot: те же операции, но корутинами."""
+
+    def __init__(self, sessions: SessionCache):
+        self._sync = SessionStateStorage(sessions)
+
+    async def set_state(self, *args, **kwargs):
+        return self._sync.set_state(*args, **kwargs)
+
+    async def get_state(self, *args, **kwargs):
+        return self._sync.get_state(*args, **kwargs)
+
+    async def delete_state(self, *args, **kwargs):
+        return self._sync.delete_state(*args, **kwargs)
+
+    async def get_data(self, *args, **kwargs):
+        return self._sync.get_data(*args, **kwargs)
+
+    async def set_data(self, *args, **kwargs):
+        return self._sync.set_data(*args, **kwargs)
+
+    async def reset_data(self, *args, **kwargs):
+        return self._sync.reset_data(*args, **kwargs)
+
+    async def save(self, *args, **kwargs):
+        return self._sync.save(*args, **kwargs)
@@ -0,0 +1,166 @@
+# kp_bot/webhook.py
+"""
+Приём апдейтов через webhook вместо long polling.
+
+Маленький HTTP-сервер (stdlib) принимает POST от Telegram, проверяет заголовок
+X-Telegram-Bot-Api-Secret-Token (secret обязателен: без него апдейты мог бы
+присылать любой, кто узнал URL) и кладёт тело в ограниченную очередь. Пул воркеров
+забирает апдейты пачками (до `batch` штук) и отдаёт их в `process(updates)` —
+обычно это bot.process_new_updates. Если очередь полна, отвечаем 503: Telegram
+повторит доставку позже, а процесс не раздувается.
+
+parse=False — process получает апдейты как JSON (dict), без разбора в
+telebot.types: так их пересылает по шардам приёмник kp_bot.shards.
+"""
+from __future__ import annotations
+
+import hmac
+import json
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List, Optional
+
+from telebot import types
+
+log = logging.getLogger("kp-bot-webhook")
+
+MAX_BODY = 1024 * 1024  # апдейт Telegram заведомо меньше
+
+
+class WebhookServer:
+    def __init__(self, process: Callable[[List[types.Update]], None], secret: str,
+                 host: str = "127.0.0.1", port: int = 8443, path: str = "/webhook",
+                 workers: int = 4, queue_size: int = 1000, batch: int = 16, parse: bool = True):
+        self.process = process
+        self.parse = parse
+        if not secret:
+            raise ValueError("webhook secret token is required")
+        self.secret = secret
+        self.host, self.port, self.path = host, port, path
+        self.workers = max(1, int(workers))
+        self.batch = max(1, int(batch))
+        self.queue: "queue.Queue[tuple]" = queue.Queue(maxsize=max(1, int(queue_size)))
+
+        self._httpd: Optional[ThreadingHTTPServer] = None
+        self._threads: List[threading.Thread] = []
+        self._stop = threading.Event()
+        self._lat = deque(maxlen=10000)      # задержка «принят → обработан», сек
+        self._lock = threading.Lock()
+
+        self.received = 0
+        self.rejected = 0       # очередь полна (503)
+        self.forbidden = 0      # неверный secret token (403)
+        self.processed = 0
+        self.failed = 0
+
+    # ---------- HTTP ----------
+    def _make_handler(self):
+        srv = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"   # keep-alive: Telegram шлёт апдейты по одному соединению
+
+            def log_message(self, fmt, *args):  # без access-лога на каждый апдейт
+                pass
+
+            def _reply(self, code: int):
+                self.send_response(code)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_POST(self):
+                if self.path != srv.path:
+                    return self._reply(404)
+                token = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+                if not hmac.compare_digest(token, srv.secret):
+                    srv._count("forbidden")
+                    return self._reply(403)
+                try:
+                    length = int(self.headers.get("Content-Length") or 0)
+                except ValueError:
+                    return self._reply(400)
+                if length <= 0 or length > MAX_BODY:
+                    return self._reply(400)
+                body = self.rfile.read(length)
+                try:
+                    srv.queue.put_nowait((time.monotonic(), body))
+                except queue.Full:
+                    srv._count("rejected")
+                    return self._reply(503)
+                srv._count("received")
+                self._reply(200)
+
+        return Handler
+
+    def _count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    # ---------- воркеры ----------
+    def _worker(self) -> None:
+        while not self._stop.is_set():
+            try:
+                first = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            items = [first]
+            while len(items) < self.batch:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            updates = []
+            for _, body in items:
+                try:
+                    raw = json.loads(body)
+                    updates.append(types.Update.de_json(raw) if self.parse else raw)
+                except Exception:
+                    self._count("failed")
+                    log.warning("bad update payload skipped")
+            try:
+                if updates:
+                    self.process(updates)
+            except Exception:
+                self._count("failed", len(updates))
+                log.exception("webhook batch failed")
+            now = time.monotonic()
+            with self._lock:
+                self.processed += len(updates)
+                self._lat.extend(now - t for t, _ in items)
+
+    # ---------- жизненный цикл ----------
+    def start(self) -> None:
+        self._stop.clear()
+        self._httpd = ThreadingHTTPServer((self.host, self.port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self.port = self._httpd.server_address[1]   # если просили порт 0
+        t = threading.Thread(target=self._httpd.serve_forever, name="webhook-http", daemon=True)
+        t.start()
+        self._threads = [t]
+        for i in range(self.workers):
+            w = threading.Thread(target=self._worker, name=f"webhook-worker-{i}", daemon=True)
+            w.start()
+            self._threads.append(w)
+        log.info(f"webhook: listening on {self.host}:{self.port}{self.path}, workers={self.workers}")
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._httpd:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+        for t in self._threads:
+            t.join(timeout=2)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lat = sorted(self._lat)
+        pct = (lambda p: round(lat[min(len(lat) - 1, int(p * len(lat)))] * 1000, 1)) if lat else (lambda p: 0.0)
+        return {
+            "queue": self.queue.qsize(), "received": self.received, "processed": self.processed,
+            "rejected": self.rejected, "forbidden": self.forbidden, "failed": self.failed,
+            "p50_ms": pct(0.50), "p95_ms": pct(0.95), "p99_ms": pct(0.99),
+        }
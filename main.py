@@ -1,20 +1,45 @@
 import os, re, logging
+import hashlib, json, secrets
 from datetime import datetime
-from typing import List, Dict
+from typing import List, Dict, Sequence
 
 import telebot
 from telebot import types
 import types as pytypes
 from telebot.handler_backends import StatesGroup, State
 
-from jinja2 import Template
-import pdfkit
+from jinja2 import DictLoader, Environment, FileSystemBytecodeCache
+from markupsafe import Markup
 import html
 import time
+import threading
+
+from kp_bot.sessions import SessionCache, SQLiteStore, MemoryStore
+from kp_bot.compact import ChatSession, register_flows, register_options
+from kp_bot.journal import SessionJournal
+from kp_bot import runtime
+from kp_bot.actors import ChatDispatcher
+from kp_bot.dedup import InFlight, RecentKeys, RepeatMeter, UpdateIds
+from kp_bot.shedding import LoadShedder
+from kp_bot.runtime import HandlerRegistry, offload
+from kp_bot.webhook import WebhookServer
+from kp_bot.shards import ShardSupervisor, poll_updates
+from kp_bot.keyboards import KeyboardCache, markup_json
+from kp_bot.jobs import JobQueue
+from kp_bot.kpfiles import LAYOUTS, KpDocument, KpIndex, SeqAllocator, reserve_kp_name
+from kp_bot.pdf import PdfError, PdfRenderer
+from kp_bot.media import MediaRegistry
+from kp_bot import ratelimit
+from kp_bot.ratelimit import LimitedApi, RateLimiter
+from kp_bot.edits import EditCoalescer, screen_fingerprint
+from kp_bot.router import CallbackCodec, CallbackRouter
+from kp_bot.flow import KEEP, FlowMachine, Step
 # =========================
 # ЛОГИ
 # =========================
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+SHARD = os.getenv("KP_SHARD", "")   # номер процесса-шарда (ставит ShardSupervisor); пусто — обычный запуск
+logging.basicConfig(level=logging.INFO,
+                    format=(f"[shard {SHARD}] " if SHARD else "") + "%(asctime)s - %(levelname)s - %(message)s")
 log = logging.getLogger("kp-bot-branch")
 
 # =========================
@@ -22,10 +47,97 @@ log = logging.getLogger("kp-bot-branch")
 # =========================
 TOKEN = os.getenv("TELEGRAM_TOKEN", '8068452070:AAFLDvT5HMKOQfhK5tcOD1zAJfmP84cmAvI')
 
-bot = telebot.TeleBot(TOKEN, parse_mode="HTML")
-path_wkhtmltopdf = r"C:/Program Files/wkhtmltopdf/bin/wkhtmltopdf.exe"
+# Сессии чатов: SQLite + LRU горячих чатов в памяти (пустой путь — только память)
+SESSION_DB = os.getenv("KP_SESSION_DB", os.path.join("instance", "bot_sessions.sqlite3"))
+SESSION_HOT_MAX = int(os.getenv("KP_SESSION_HOT_MAX", "5000"))      # сколько чатов держим в памяти
+SESSION_IDLE_TTL = int(os.getenv("KP_SESSION_IDLE_TTL", "900"))     # сек. простоя до выгрузки из памяти
+SESSION_FLUSH_SEC = float(os.getenv("KP_SESSION_FLUSH_SEC", "2"))   # период отложенной записи
+# Журнал изменений сессий (переживает падение между сбросами в SQLite); пустой путь — выключен
+SESSION_JOURNAL = os.getenv("KP_SESSION_JOURNAL", os.path.join("instance", "bot_sessions.journal"))
+SESSION_CHECKPOINT_SEC = float(os.getenv("KP_SESSION_CHECKPOINT_SEC", "30"))  # как часто сворачивать журнал
+if SHARD and SESSION_JOURNAL:
+    SESSION_JOURNAL = f"{SESSION_JOURNAL}.{SHARD}"     # журнал у каждого шарда свой, SQLite — общий
+
+# chat_id -> ChatSession (kp_bot.compact); ведёт себя как dict, но хранит сессии в SQLite,
+# а в памяти держит только SESSION_HOT_MAX недавно активных чатов
+USER: SessionCache = SessionCache(
+    SQLiteStore(SESSION_DB) if SESSION_DB else MemoryStore(),
+    max_hot=SESSION_HOT_MAX,
+    idle_ttl=SESSION_IDLE_TTL,
+    flush_interval=SESSION_FLUSH_SEC,
+    journal=SessionJournal(SESSION_JOURNAL) if (SESSION_DB and SESSION_JOURNAL) else None,
+    checkpoint_interval=SESSION_CHECKPOINT_SEC,
+    factory=ChatSession.load,
+)
 
-config = pdfkit.configuration(wkhtmltopdf=path_wkhtmltopdf)
+# Режим работы: "sync" — TeleBot + потоки (как раньше), "async" — AsyncTeleBot + asyncio
+BOT_MODE = os.getenv("KP_BOT_MODE", "sync")
+# Откуда берём апдейты: "polling" (infinity_polling) или "webhook" (встроенный HTTP-приёмник)
+BOT_INGEST = os.getenv("KP_BOT_INGEST", "polling")
+WEBHOOK_URL = os.getenv("KP_WEBHOOK_URL", "")              # публичный URL; пусто — webhook уже настроен снаружи
+WEBHOOK_SECRET = os.getenv("KP_WEBHOOK_SECRET", "")        # X-Telegram-Bot-Api-Secret-Token; пусто — см. ensure_webhook_secret
+WEBHOOK_HOST = os.getenv("KP_WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("KP_WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("KP_WEBHOOK_PATH", "/webhook")
+WEBHOOK_WORKERS = int(os.getenv("KP_WEBHOOK_WORKERS", "8"))     # воркеры, выполняющие хендлеры
+WEBHOOK_QUEUE = int(os.getenv("KP_WEBHOOK_QUEUE", "2000"))      # предел очереди; сверх — 503 и повтор от Telegram
+WEBHOOK_BATCH = int(os.getenv("KP_WEBHOOK_BATCH", "16"))        # сколько апдейтов воркер берёт за раз
+# Апдейты одного чата — строго по очереди, разных чатов — параллельно (ChatDispatcher); 0 — как раньше
+CHAT_WORKERS = int(os.getenv("KP_CHAT_WORKERS", "8"))
+CHAT_QUEUE = int(os.getenv("KP_CHAT_QUEUE", "20"))     # апдейтов в очереди одного чата; сверх — отбрасываем
+# Под нагрузкой сбрасываем косметику (фото /start, временные уведомления, удаления), анкета и КП — всегда
+SHED = os.getenv("KP_SHED", "1") != "0"
+SHED_DEPTH = int(os.getenv("KP_SHED_DEPTH", "200"))                # апдейтов в очередях чатов = «перегрузка»
+SHED_LATENCY_MS = float(os.getenv("KP_SHED_LATENCY_MS", "3000"))   # p90 «принят → обработан» = «перегрузка»
+# Шарды: N процессов бота, чат -> процесс по consistent hash chat_id, приёмник апдейтов один; 0/1 — один процесс
+SHARDS = int(os.getenv("KP_SHARDS", "0"))
+SHARD_QUEUE = int(os.getenv("KP_SHARD_QUEUE", "1000"))   # пачек апдейтов в очереди шарда; сверх — отбрасываем
+# Повторы: update_id (в т.ч. после рестарта), двойной тап/текст в окне TAP_TTL, одно КП на чат за раз
+UPDATE_IDS = os.getenv("KP_UPDATE_IDS", os.path.join("instance", "update_ids.json"))  # пусто — только в памяти
+TAP_TTL = float(os.getenv("KP_TAP_TTL", "1.0"))        # сек.; 0 — не отсекать повторные нажатия
+KP_REPEAT_SEC = float(os.getenv("KP_KP_REPEAT_SEC", "60"))  # окно учёта «лишних» рендеров/загрузок КП
+
+# Генерация КП — в отдельном пуле: хендлер сразу отвечает «готовим», воркеры рендерят и отправляют
+KP_WORKERS = int(os.getenv("KP_KP_WORKERS", "2"))
+KP_QUEUE_MAX = int(os.getenv("KP_KP_QUEUE", "50"))     # сверх — «попробуйте позже» вместо бесконечной очереди
+KP_STORE_WORKERS = int(os.getenv("KP_KP_STORE_WORKERS", "1"))   # запись КП на диск/в индекс после отправки
+KP_STORE_QUEUE = int(os.getenv("KP_KP_STORE_QUEUE", "200"))     # сверх — пишем сразу, в задаче отправки
+KP_SEQ_DB = os.getenv("KP_SEQ_DB", os.path.join("instance", "kp_seq.sqlite3"))  # счётчики номеров КП; пусто — в памяти
+KP_FORMAT = os.getenv("KP_FORMAT", "html")           # что отправляем клиенту: html | pdf (HTML для админки пишется всегда)
+PDF_WORKERS = int(os.getenv("KP_PDF_WORKERS", "2"))  # процессов xhtml2pdf
+PDF_CACHE_DIR = os.getenv("KP_PDF_CACHE", os.path.join("instance", "pdf_cache"))  # PDF по sha256 HTML; пусто — только память
+PDF_FONT = os.getenv("KP_PDF_FONT") or None          # TTF с кириллицей; по умолчанию Arial (Windows) / DejaVu Sans (Linux)
+KP_DEDUP = os.getenv("KP_DEDUP", "1") != "0"       # одинаковое КП повторно — по file_id, без рендера/записи/загрузки
+KP_STORAGE_LAYOUT = os.getenv("KP_STORAGE_LAYOUT", "flat")  # flat | date (ГГГГ/ММ/ДД) | hash (ab/cd); та же настройка у админки
+# Приветственное фото /start: загружается один раз, дальше отправляется по file_id из реестра
+WELCOME_PHOTO = os.getenv("KP_WELCOME_PHOTO", "C:/Users/Maksim/Documents/Платон/chat bot/бот КП/фото.jpg")
+MEDIA_IDS = os.getenv("KP_MEDIA_IDS", os.path.join("instance", "media_ids.json"))  # пусто — только в памяти
+# Лимиты исходящих вызовов Telegram (сообщения/правки/удаления в секунду); KP_RATE_GLOBAL=0 — без ограничения
+RATE_GLOBAL = float(os.getenv("KP_RATE_GLOBAL", "30"))
+RATE_GLOBAL_BURST = float(os.getenv("KP_RATE_GLOBAL_BURST", "30"))
+RATE_CHAT = float(os.getenv("KP_RATE_CHAT", "1"))             # на один чат; 0 — только общий лимит
+RATE_CHAT_BURST = float(os.getenv("KP_RATE_CHAT_BURST", "5"))
+EDIT_WINDOW = float(os.getenv("KP_EDIT_WINDOW", "0.25"))  # сек.: окно склейки быстрых правок одного сообщения
+SHOW_PROGRESS = os.getenv("KP_SHOW_PROGRESS", "0") == "1"  # «5/16» над заголовком шага (по умолчанию скрыто)
+STATS_SEC = float(os.getenv("KP_STATS_SEC", "60"))     # как часто писать в лог счётчики очередей/кешей; 0 — не писать
+
+# bot — TeleBot/AsyncTeleBot, api — то, через что хендлеры ходят в Telegram (`await api.x(...)`).
+# FSM-состояния храним в сессии, чтобы текстовые вводы переживали рестарт
+LOAD = LoadShedder(SHED_LATENCY_MS / 1000, enabled=SHED)
+# С ChatDispatcher хендлеры выполняются на его воркерах, поэтому TeleBot — без своего пула
+CHATS = ChatDispatcher(CHAT_WORKERS, CHAT_QUEUE, observer=LOAD.observe) if CHAT_WORKERS > 0 else None
+if CHATS:
+    LOAD.add_gauge("chat_backlog", lambda: CHATS.backlog, SHED_DEPTH)
+bot, api = runtime.make_bot(TOKEN, BOT_MODE, USER, threaded=(BOT_INGEST != "webhook" and CHATS is None))
+RATE = RateLimiter(RATE_GLOBAL, RATE_GLOBAL_BURST, RATE_CHAT, RATE_CHAT_BURST) if RATE_GLOBAL > 0 else None
+if RATE:
+    api = LimitedApi(api, RATE)    # send_*/edit_*/delete_message — через общий и чатовый token bucket
+handlers = HandlerRegistry()
+MEDIA = MediaRegistry(MEDIA_IDS)
+UPDATES = UpdateIds(UPDATE_IDS)
+TAPS = RecentKeys(TAP_TTL)
+KP_INFLIGHT = InFlight()                                       # чаты, для которых КП уже готовится
+KP_WASTE = RepeatMeter(KP_REPEAT_SEC, kinds=("renders", "uploads"))   # должно быть {0, 0}
 
 THEME = {"brand": "#2c5aa0", "muted": "#6b7280", "accent": "#10b981"}
 EMOJI = {"start": "📝", "about": "ℹ️", "back": "⬅️", "home": "🏠", "ok": "✅", "no": "❌", "edit": "✍️", "confirm": "✔️",
@@ -34,6 +146,7 @@ EMOJI = {"start": "📝", "about": "ℹ️", "back": "⬅️", "home": "🏠", "
 # Сколько опций показывать на одной «странице»
 
 PAGE_SIZE = 5
+KB_CACHE = KeyboardCache(int(os.getenv("KP_KB_CACHE_MAX", "4096")))  # готовые клавиатуры мультивыбора
 
 # =========================
 # SAFE EDIT
@@ -42,29 +155,70 @@ def h(s: str) -> str:
     # безопасное экранирование любого динамического текста
     return html.escape(s or "", quote=False)
 
-def safe_edit_text(chat_id: int, message_id: int, text: str, markup=None):
+async def safe_edit_text(chat_id: int, message_id: int, text: str, markup=None):
+    # правки одного сообщения идут через EDITS: пока одна в полёте, промежуточные экраны не отправляются
+    await EDITS.edit(chat_id, message_id, text, markup)
+
+async def _edit_message(chat_id: int, message_id: int, text: str, markup=None):
+    """
+    Правка для EDITS. С CHATS она выполняется отдельной задачей в очереди чата,
+    уже после хендлера, поэтому и запасной вариант здесь же: править нечего —
+    шлём экран новым сообщением, и оно становится last_mid чата.
+    """
+    # тот же экран, что уже стоит в этом сообщении (go_back, ui_home, повторное нажатие) — не ходим в API
+    sess = USER.get(chat_id)
+    screen = [message_id, screen_fingerprint(text, markup)]
+    if sess is not None and sess.get("screen") == screen:
+        EDITS.note_skipped()
+        return
     try:
-        bot.edit_message_text(text, chat_id, message_id, reply_markup=markup)
+        await api.edit_message_text(text, chat_id, message_id, reply_markup=markup)
     except Exception as e:
-        s = str(e).lower()
-        if "message is not modified" in s:
-            return
-        if "message to edit not found" in s or "can't be edited" in s:
-            bot.send_message(chat_id, text, reply_markup=markup)
+        if "message is not modified" in str(e).lower():
+            if sess is not None:
+                sess["screen"] = screen
             return
-        raise
-
-from threading import Timer
-
-def safe_delete(chat_id: int, message_id: int):
+        log.warning(f"edit {chat_id}/{message_id} failed, sending a new message: {e}")
+        m = await api.send_message(chat_id, text, reply_markup=markup)
+        if get_last_mid(chat_id) in (None, message_id):   # заменили главное сообщение чата
+            set_last_mid(chat_id, m.message_id)
+        screen[0] = m.message_id
+    if sess is not None:
+        sess["screen"] = screen
+
+# апдейты чата идут по одному (CHATS): хендлер только ставит правку, а отправляет её отдельная задача
+# в очереди того же чата — иначе следующее нажатие начиналось бы после правки и склеивать было бы нечего
+EDITS = EditCoalescer(_edit_message, min_interval=EDIT_WINDOW, submit=CHATS.submit if CHATS else None)
+
+async def safe_delete(chat_id: int, message_id: int):
+    if LOAD.skip("delete"):
+        return  # перегрузка: лишнее сообщение в чате лучше потерянной заявки
     try:
-        bot.delete_message(chat_id, message_id)
+        await api.delete_message(chat_id, message_id)
     except Exception:
         pass
 
-def send_temp(chat_id: int, text: str, ttl: int = 5, reply_markup=None):
-    msg = bot.send_message(chat_id, text, reply_markup=reply_markup)
-    Timer(ttl, lambda: safe_delete(chat_id, msg.message_id)).start()
+def chat_later(delay: float, ch: int, fn, *args, key=None):
+    """
+    Отложенная задача, которая читает/меняет сессию чата ch: по таймеру она
+    только встаёт в очередь чата (CHATS) и выполняется между его апдейтами,
+    а не одновременно с ними. fn(*args) — корутина (или функция, её возвращающая).
+    """
+    if CHATS:
+        runtime.call_later(delay, _submit_to_chat, ch, fn, args, key=key)
+    else:
+        runtime.call_later(delay, fn, *args, key=key)
+
+async def _submit_to_chat(ch: int, fn, args: tuple):
+    CHATS.submit(ch, fn, *args)
+
+async def send_temp(chat_id: int, text: str, ttl: int = 5, reply_markup=None, essential: bool = False):
+    """Сообщение, которое само удалится через ttl сек.; не essential — пропускается под нагрузкой."""
+    if not essential and reply_markup is None and LOAD.skip("temp"):
+        return None
+    with ratelimit.lane(ratelimit.LOW):    # временное уведомление — уступает анкете и КП
+        msg = await api.send_message(chat_id, text, reply_markup=reply_markup)
+    runtime.call_later(ttl, safe_delete, chat_id, msg.message_id)
     return msg
 
 
@@ -136,7 +290,7 @@ def yn_kb_all_horizontal():
 # =========================
 # ДАННЫЕ ПОЛЬЗОВАТЕЛЯ
 # =========================
-USER: Dict[int, dict] = {}  # chat_id -> dict
+# USER (chat_id -> dict) объявлен в НАСТРОЙКАХ: SessionCache поверх SQLite + журнал
 
 # Базовые шаги до выбора ветки
 BASE_ORDER = [
@@ -156,35 +310,45 @@ BRANCH_FLOW = {
     # Маркетинг — 3 шага
     "D": ["D1_goals", "D2_channels", "D4_budget"],
 }
+# Маршруты анкеты по именам (в сессии — имя маршрута и индекс шага, см. FLOW):
+# base — до ответа «есть сайт?», site — короткий (сайт есть), nosite — полный,
+# <base|nosite>+<ветка> — полный маршрут после выбора решения
+SITE_ORDER = ["name", "org_name", "has_site", "has_site_comment", "contacts", "confirm"]
+NOSITE_ORDER = ["name", "org_name", "has_site", "biz_goal", "user_action", "product", "solution"]
+FLOWS = {"base": BASE_ORDER, "site": SITE_ORDER, "nosite": NOSITE_ORDER}
+for _root in ("base", "nosite"):
+    for _b, _steps in BRANCH_FLOW.items():
+        FLOWS[f"{_root}+{_b}"] = FLOWS[_root] + _steps + COMMON_ORDER
+# (маршрут или "*", событие) -> (новый маршрут, шаг)
+FLOW_RULES = {
+    ("*", "has_site:yes"): ("site", "has_site_comment"),
+    ("*", "has_site:no"): ("nosite", "biz_goal"),
+    ("*", "site_comment"): ("site", "contacts"),
+}
+for _name in list(FLOWS):
+    if "solution" in FLOWS[_name]:
+        for _b in BRANCH_FLOW:
+            # решение (в т.ч. повторный выбор после «Назад») — ветка к корню маршрута, стоим на «solution»
+            FLOW_RULES[(_name, f"branch:{_b}")] = (f"{_name.split('+')[0]}+{_b}", "solution")
+
 BASE_FLOW   = BASE_ORDER.copy()
 COMMON_FLOW = COMMON_ORDER.copy()
 
-BASE_LEN    = len(BASE_ORDER)
-BRANCH_MAX  = max(len(v) for v in BRANCH_FLOW.values())  # убедись, что BRANCH_FLOW объявлен выше
-COMMON_LEN  = len(COMMON_ORDER)
-STABLE_TOTAL= BASE_LEN + BRANCH_MAX + COMMON_LEN
-
 BASE_LEN = len(BASE_ORDER)                              # 8
 BRANCH_MAX = max(len(v) for v in BRANCH_FLOW.values()) # 3
 COMMON_LEN = len(COMMON_ORDER)                          # 5
 STABLE_TOTAL = BASE_LEN + BRANCH_MAX + COMMON_LEN       # 8 + 3 + 5 = 16
 
-def clear_state(ch: int):
+async def clear_state(ch: int):
     try:
-        bot.delete_state(ch)  # сброс активного state у пользователя
+        await api.delete_state(ch)  # сброс активного state у пользователя
     except Exception:
         pass
 
 def init_user(ch: int):
-    USER[ch] = {
-        "idx": 0,
-        "flow": BASE_ORDER.copy(),
-        "data": {},
-        "branch": None,
-        "solution": None,
-        "multiselect_ctx": {},
-        "last_mid": None,                 # 👈 сюда будем класть id последнего сообщения бота
-    }
+    # idx/flow (имя маршрута в FLOW.flows)/data/branch/solution, last_mid — id последнего
+    # сообщения бота, screen — [message_id, отпечаток] последней правки, state — FSM telebot
+    USER[ch] = ChatSession("base")
 
 def get_last_mid(ch: int):
     return USER.get(ch, {}).get("last_mid")
@@ -192,27 +356,46 @@ def get_last_mid(ch: int):
 def set_last_mid(ch: int, mid: int | None):
     if ch in USER:
         USER[ch]["last_mid"] = mid
+        USER.commit(ch)
 
-def get_flow(ch: int) -> List[str]:
-    return USER[ch]['flow']
+def flow_name(ch: int) -> str:
+    """Имя маршрута чата; старые сессии хранили сам список шагов — переводим в имя."""
+    f = USER[ch]['flow']
+    if not isinstance(f, str):
+        f = FLOW.intern(f)
+        if not FLOW.is_custom(f):
+            USER[ch]['flow'] = f    # незнакомый список оставляем в сессии: его имя знает только этот процесс
+    return f
+
+def get_flow(ch: int) -> tuple:
+    return FLOW.flows[flow_name(ch)]
 
 
 def cur_step(ch: int) -> str:
-    return get_flow(ch)[USER[ch]['idx']]
+    return FLOW.step_at(flow_name(ch), USER[ch]['idx'])
 
 
 def set_step(ch: int, key: str):
-    USER[ch]['idx'] = get_flow(ch).index(key)
+    USER[ch]['idx'] = FLOW.index(flow_name(ch), key)
+    USER.commit(ch)
 
 
 def next_step(ch: int):
-    USER[ch]['idx'] = min(USER[ch]['idx'] + 1, len(get_flow(ch)) - 1)
+    USER[ch]['idx'] = FLOW.next_idx(flow_name(ch), USER[ch]['idx'])
+    USER.commit(ch)
+
+
+def fire(ch: int, event: str) -> str:
+    """Переход по правилу FLOW_RULES: сменить маршрут и шаг; вернуть новый шаг."""
+    USER[ch]['flow'], USER[ch]['idx'] = FLOW.fire(flow_name(ch), event)
+    USER.commit(ch)
+    return cur_step(ch)
 
 
 def total_steps(ch: int) -> int:
-    return len(get_flow(ch))
+    return FLOW.length(flow_name(ch))
 
-def go_back(ch: int, mid: int | None):
+async def go_back(ch: int, mid: int | None):
     """
     Единый корректный 'Назад':
     - если пользователь в текстовом режиме текущего шага (biz_goal/user_action/other_input),
@@ -220,7 +403,7 @@ def go_back(ch: int, mid: int | None):
     - иначе: очищаем state и уходим на предыдущий шаг по flow.
     """
     try:
-        st = bot.get_state(ch, ch)  # например 'St:biz_goal', 'St:other_input', ...
+        st = await api.get_state(ch, ch)  # например 'St:biz_goal', 'St:other_input', ...
     except Exception:
         st = None
 
@@ -228,78 +411,78 @@ def go_back(ch: int, mid: int | None):
 
     # 1) Кастомный ввод по кнопке "Свой вариант" для конкретного шага (мультивыбор)
     if st.endswith(":other_input"):
-        step = multiselect_state(ch).get("step") or cur_step(ch)
-        clear_state(ch)
-        send_step(ch, step, mid=mid, edit=True)
+        step = USER[ch].ms_step or cur_step(ch)
+        await clear_state(ch)
+        await send_step(ch, step, mid=mid, edit=True)
         return
 
     # 2) Кастомный ввод для "Какую задачу решить" (biz_goal)
     if st.endswith(":biz_goal"):
-        clear_state(ch)
-        send_step(ch, "biz_goal", mid=mid, edit=True)
+        await clear_state(ch)
+        await send_step(ch, "biz_goal", mid=mid, edit=True)
         return
 
     # 3) Кастомный ввод для "Целевое действие" (user_action)
     if st.endswith(":user_action"):
-        clear_state(ch)
-        send_step(ch, "user_action", mid=mid, edit=True)
+        await clear_state(ch)
+        await send_step(ch, "user_action", mid=mid, edit=True)
         return
 
     # 4) Остальные текстовые состояния (включая has_site_comment, contacts и т.п.) — идём на предыдущий шаг
-    clear_state(ch)
-    USER[ch]["idx"] = max(0, USER[ch]["idx"] - 1)
-    send_step(ch, cur_step(ch), mid=mid, edit=True)
+    await clear_state(ch)
+    USER[ch]["idx"] = FLOW.prev_idx(flow_name(ch), USER[ch]["idx"])
+    USER.commit(ch)
+    await send_step(ch, cur_step(ch), mid=mid, edit=True)
 
 # =========================
 # СТАБИЛЬНЫЙ ТОТАЛ И КАРТА ИНДЕКСОВ ДЛЯ ПРОГРЕССА
 # =========================
 def _planned_total_const() -> int:
-    base_len = len(BASE_FLOW)
-    b_max = max(len(v) for v in BRANCH_FLOW.values())
-    comm_len = len(COMMON_FLOW)
-    return base_len + b_max + comm_len
-
-def progress_for_step(ch: int, step_key: str):
-    base_len = len(BASE_FLOW)
-    b_max = max(len(v) for v in BRANCH_FLOW.values())
-    total = base_len + b_max + len(COMMON_FLOW)
+    return STABLE_TOTAL
 
-    branch = USER.get(ch, {}).get("branch")
+def _progress_row(branch, flow: Sequence[str]) -> dict:
+    """Шаг -> (позиция, тотал) для ветки branch на маршруте flow; считается один раз."""
+    row = {k: (i + 1, STABLE_TOTAL) for i, k in enumerate(BASE_FLOW)}
     if not branch:
-        # ещё не выбрана ветка — позиция в BASE
-        if step_key in BASE_FLOW:
-            idx_in_base = BASE_FLOW.index(step_key) + 1
-        else:
-            # если вызывают для шага за пределами BASE до выбора ветки — безопасный фолбек
-            idx_in_base = min(base_len, USER.get(ch, {}).get("idx", 0) + 1)
-        return idx_in_base, total
-
-    if step_key in BASE_FLOW:
-        return BASE_FLOW.index(step_key) + 1, total
-
-    if step_key in BRANCH_FLOW[branch]:
-        i = BRANCH_FLOW[branch].index(step_key) + 1
-        sel_len = len(BRANCH_FLOW[branch])
-        # хотим: i=1 -> scaled=1 (всегда 9/total), i=sel_len -> scaled=b_max
-        if sel_len <= 1:
-            scaled = 1
-        else:
-            scaled = 1 + round((i - 1) * (b_max - 1) / (sel_len - 1))
-        return base_len + scaled, total
+        return row              # до выбора ветки прочие шаги считаются по текущему idx (см. progress_for_step)
+    sel = BRANCH_FLOW[branch]
+    for j, key in enumerate(sel, start=1):
+        # хотим: j=1 -> scaled=1 (всегда 9/total), j=len(sel) -> scaled=BRANCH_MAX
+        scaled = 1 if len(sel) <= 1 else 1 + round((j - 1) * (BRANCH_MAX - 1) / (len(sel) - 1))
+        row.setdefault(key, (BASE_LEN + scaled, STABLE_TOTAL))
+    for j, key in enumerate(COMMON_FLOW, start=1):
+        row.setdefault(key, (BASE_LEN + BRANCH_MAX + j, STABLE_TOTAL))
+    for i, key in enumerate(flow):
+        row.setdefault(key, (min(len(flow), i + 1), STABLE_TOTAL))
+    return row
 
-    if step_key in COMMON_FLOW:
-        i = COMMON_FLOW.index(step_key) + 1
-        return base_len + b_max + i, total
+# (ветка | None, маршрут) -> {шаг: (позиция, тотал)}; маршрут задаёт путь по «есть сайт?»
+PROGRESS = {(b, name): _progress_row(b, seq)
+            for b in (None, *BRANCH_FLOW) for name, seq in FLOWS.items()}
 
-    # fallback — по текущему положению
-    return min(len(get_flow(ch)), get_flow(ch).index(step_key) + 1 if step_key in get_flow(ch) else USER[ch]['idx'] + 1), total
+def progress_for_step(ch: int, step_key: str):
+    sess = USER.get(ch) or {}
+    flow = sess.get("flow", "base")
+    if not isinstance(flow, str):
+        flow = flow_name(ch)
+    branch = sess.get("branch") or None
+    row = PROGRESS.get((branch, flow))
+    if row is None:
+        # маршрут, появившийся после старта (FLOW.intern): строим строку один раз
+        row = PROGRESS.setdefault((branch, flow), _progress_row(branch, FLOW.flows[flow]))
+    hit = row.get(step_key)
+    if hit is not None:
+        return hit
+    # шага нет в маршруте — по текущему положению
+    idx = sess.get("idx", 0) + 1
+    return (min(BASE_LEN, idx) if not branch else min(len(FLOW.flows[flow]), idx)), STABLE_TOTAL
 
 
 def step_no(ch: int, step_key: str) -> int:
     """Позиция шага в ТЕКУЩЕМ пользовательском маршруте (1..len(flow))."""
-    flow = get_flow(ch) if ch in USER else []
-    if step_key in flow:
-        return flow.index(step_key) + 1
+    i = FLOW.index(flow_name(ch), step_key) if ch in USER else None
+    if i is not None:
+        return i + 1
     return USER.get(ch, {}).get("idx", 0) + 1  # безопасный фолбэк
 
 def numbered_title(ch: int, step_key: str, text_html: str) -> str:
@@ -322,7 +505,10 @@ STEP_ORDER = [
 STEP_INDEX = {k: i+1 for i, k in enumerate(STEP_ORDER)}
 TOTAL_STEPS = len(STEP_ORDER)
 def render_for_step(ch: int, step_key: str) -> str:
-    return ""  # отключено по требованию: скрыть 1/16 и т.п.
+    if not SHOW_PROGRESS:
+        return ""  # отключено по требованию: скрыть 1/16 и т.п.
+    pos, total = progress_for_step(ch, step_key)
+    return f"<i>{pos}/{total}</i>\n"
 
 # =========================
 # ОПЦИИ ПО ТЗ
@@ -509,7 +695,8 @@ def humanize_dict(step: str, dct: dict | None) -> str:
     items = humanize_list(step, dct.get("items", []))
     if dct.get("other"):
         items.append(f"Другое: {dct['other']}")
-    return "<br>• " + "<br>• ".join(items) if items else ""
+    # подписи/ввод пользователя экранируются, разметка — нет
+    return Markup("<br>• ") + Markup("<br>• ").join(items) if items else ""
 
 
 
@@ -517,27 +704,10 @@ def humanize_dict(step: str, dct: dict | None) -> str:
 # =========================
 # МУЛЬТИВЫБОР с пагинацией
 # =========================
-def multiselect_state(ch: int):
-    """Гарантированно вернуть словарь контекста мультивыбора."""
-    ctx = USER[ch].get("multiselect_ctx")
-    if not isinstance(ctx, dict):
-        ctx = {"step": None, "selected": set(), "single": False, "preset": None, "page": 0}
-        USER[ch]["multiselect_ctx"] = ctx
-    ctx.setdefault("step", None)
-    ctx.setdefault("selected", set())
-    ctx.setdefault("single", False)
-    ctx.setdefault("preset", None)
-    ctx.setdefault("page", 0)
-    return ctx
-
-
-def start_multiselect(ch: int, step: str, single: bool = False, preset: List[str] = None, seed: List[str] = None):
-    ctx = multiselect_state(ch)
-    ctx["step"] = step
-    ctx["single"] = single
-    ctx["preset"] = preset or []
-    ctx["selected"] = set(seed or [])
-    ctx["page"] = 0  # всегда начинаем с первой страницы
+# контекст мультивыбора — поля ms_* сессии (kp_bot.compact): шаг, маска выбранного, режим, страница
+def start_multiselect(ch: int, step: str, single: bool = False, seed: List[str] = None):
+    USER[ch].start_multiselect(step, seed or (), single)   # всегда начинаем с первой страницы
+    USER.commit(ch)
 
 
 def ensure_multiselect(ch: int, step: str, single: bool = False):
@@ -545,86 +715,81 @@ def ensure_multiselect(ch: int, step: str, single: bool = False):
     Инициализируем контекст ТОЛЬКО при первом входе в шаг.
     Если выбор ранее сохранён — подхватываем его, не сбрасывая галочки.
     """
-    ctx = multiselect_state(ch)
-    if ctx["step"] != step:
-        prev_items = USER[ch]["data"].get(step, {}).get("items", [])
-        start_multiselect(ch, step, single=single, seed=prev_items)
+    sess = USER[ch]
+    if sess.ms_step != step:
+        prev = sess.data.choice(step)
+        if prev is not None:
+            sess.reset_multiselect(step, prev.mask, prev.extra, single)
+        else:
+            sess.reset_multiselect(step, single=single)
+        USER.commit(ch)
     else:
-        ctx["single"] = single  # синхронизируем режим
+        sess.ms_single = single  # синхронизируем режим
 
-from telebot import types
+def step_is_single(step: str) -> bool:
+    s = FLOW.steps.get(step)
+    return bool(s is not None and s.single)
 
-def bottom_row_for_step(step: str, add_back=True, add_other=False, add_done=False):
-    row = []
-    if add_back:
-        row.append(types.InlineKeyboardButton(f"{EMOJI['back']} Назад", callback_data="ui_back"))
-    if add_other:
-        row.append(types.InlineKeyboardButton("📝 Свой вариант", callback_data=f"other::{step}"))
-    if add_done:
-        row.append(types.InlineKeyboardButton("✅ Готово", callback_data=f"done::{step}"))
-    return row
+from telebot import types
 
 def toggle_select(ch: int, key: str):
-    ctx = multiselect_state(ch)
-    if ctx["single"]:
-        ctx["selected"] = set([key])
-    else:
-        if key in ctx["selected"]:
-            ctx["selected"].remove(key)
-        else:
-            ctx["selected"].add(key)
+    USER[ch].toggle(key)
+    USER.commit(ch)
 
 
 def set_other_value(ch: int, text: str):
-    d = USER[ch]["data"]
-    step = multiselect_state(ch)["step"]
-    d.setdefault(step, {"items": [], "other": None})
-    d[step]["other"] = text
+    sess = USER[ch]
+    sess.data.set_other(sess.ms_step, text)
+    USER.commit(ch)
 
 
 def save_multiselect(ch: int):
-    ctx = multiselect_state(ch)
-    d = USER[ch]["data"]
-    d[ctx["step"]] = {"items": list(ctx["selected"]), "other": d.get(ctx["step"], {}).get("other")}
-    return d[ctx["step"]]
+    sess = USER[ch]
+    sess.data.set_choice(sess.ms_step, sess.ms_mask, sess.ms_extra)
+    USER.commit(ch)
+    return sess.data[sess.ms_step]
 
 
-def selected_marker(ch: int, key: str) -> str:
-    return EMOJI['check'] if key in multiselect_state(ch)["selected"] else EMOJI['empty']
+# callback-кнопки (см. on_cb). Номера шагов в компактном callback_data мультивыбора
+# ("o:08seo" вместо "opt::D1_goals::seo"): только дописывать в конец — на них
+# ссылаются кнопки уже отправленных сообщений
+CB_STEPS = (
+    "A1_blocks", "A2_functions",
+    "B1_sections", "B2_assort", "B3_functions",
+    "C1_tasks", "C2_platforms", "C3_integrations",
+    "D1_goals", "D2_channels", "D4_budget",
+    "design", "content", "timeline",
+)
+CB = CallbackRouter(CallbackCodec(CB_STEPS))
 
 
-def build_paginated_rows(ch: int, step: str, options, page: int,
+def build_paginated_rows(step: str, page_opts, page: int, has_next: bool, mask: int,
                          add_other_text: str = None, add_preset: bool = False):
-    rows = []
-    start = page * PAGE_SIZE
-    end = min(len(options), start + PAGE_SIZE)
-
+    """
+    Ряды кнопок (text, callback_data) экрана мультивыбора в итоговом порядке:
+    опции страницы, пагинация, пресет и нижний ряд «Назад | Свой вариант | Готово».
+    mask — биты отмеченных опций среди page_opts.
+    """
     # Основные опции — всегда в столбик
-    for key, label in options[start:end]:
-        btn = types.InlineKeyboardButton(
-            f"{selected_marker(ch, key)} {label}",
-            callback_data=f"opt::{step}::{key}"
-        )
-        rows.append([btn])
+    rows = [[(f"{EMOJI['check'] if mask >> i & 1 else EMOJI['empty']} {label}", CB.data("o", step, key))]
+            for i, (key, label) in enumerate(page_opts)]
 
     # Пагинация
     if page > 0:
-        rows.append([types.InlineKeyboardButton("◀️ Предыдущие варианты", callback_data=f"page::{step}::{page-1}")])
-    if end < len(options):
-        rows.append([types.InlineKeyboardButton("Еще варианты ▶️", callback_data=f"page::{step}::{page+1}")])
+        rows.append([("◀️ Предыдущие варианты", CB.data("g", step, str(page - 1)))])
+    if has_next:
+        rows.append([("Еще варианты ▶️", CB.data("g", step, str(page + 1)))])
 
     # Пресет — отдельной строкой
     if add_preset:
-        rows.append([types.InlineKeyboardButton("Предложите стандартный набор",
-                                                callback_data=f"preset::{step}")])
-    # «Свой вариант» + «Готово» — в одну строку
-    if add_other_text:
-        other_btn = types.InlineKeyboardButton(add_other_text, callback_data=f"other::{step}")
-        done_btn  = types.InlineKeyboardButton("Готово", callback_data=f"done::{step}")
-        rows.append([other_btn, done_btn])
-    else:
-        rows.append([types.InlineKeyboardButton("Готово", callback_data=f"done::{step}")])
+        rows.append([("Предложите стандартный набор", CB.data("p", step))])
 
+    # нижний общий ряд (⬅ Назад | 📝 Свой вариант | ✅ Готово)
+    bottom = [(f"{EMOJI['back']} Назад", "ui_back")]
+    if add_other_text:
+        bottom.append((add_other_text, CB.data("t", step)))
+    bottom.append(("Готово", CB.data("d", step)))
+    rows.append(bottom)
     return rows
 
 def kb_with_bottom(rows, back=False, other_cd=None, done_cd=None, other_text="📝 Свой вариант", done_text="✅ Готово"):
@@ -656,50 +821,26 @@ def pretty_human(step: str, entry) -> str:
 
 def multiselect_screen(ch: int, step: str, title_html: str, options,
                        single: bool = False, add_other_text: str = None, add_preset: bool = False):
+    """Текст экрана и JSON клавиатуры (из KB_CACHE — на повторных нажатиях ничего не собирается)."""
     ensure_multiselect(ch, step, single=single)
-    page = multiselect_state(ch)["page"]
-
-    rows = build_paginated_rows(
-        ch, step, options, page,
-        add_other_text=add_other_text, add_preset=add_preset
-    )
+    sess = USER[ch]
+    page = sess.ms_page
 
-    # достанем из rows «Свой вариант» и «Готово», чтобы собрать их вместе с «Назад»
-    other_btn = None
-    done_btn = None
-    for r in rows:
-        for btn in list(r):
-            cd = getattr(btn, "callback_data", "") or ""
-            if cd.startswith("other::") and other_btn is None:
-                other_btn = btn
-                r.remove(btn)
-            elif cd.startswith("done::") and done_btn is None:
-                done_btn = btn
-                r.remove(btn)
-
-    # нижний общий ряд (⬅ Назад | 📝 Свой вариант | ✅ Готово)
-    bottom = bottom_row_for_step(
-        step,
-        add_back=True,
-        add_other=(other_btn is not None),
-        add_done=(done_btn is not None),
+    start = page * PAGE_SIZE
+    page_opts = tuple(options[start:start + PAGE_SIZE])
+    has_next = start + PAGE_SIZE < len(options)
+    mask = 0
+    for i, (key, _) in enumerate(page_opts):
+        if sess.is_selected(key):
+            mask |= 1 << i
+
+    markup = KB_CACHE.get(
+        (step, page, page_opts, has_next, mask, single, add_other_text, add_preset),
+        lambda: markup_json(build_paginated_rows(step, page_opts, page, has_next, mask,
+                                                 add_other_text=add_other_text, add_preset=add_preset)),
     )
-
-    # (кнопки «Назад» у нас фиксированные, «Свой вариант/Готово» мог быть кастомным по стилю)
-    if other_btn is not None:
-        bottom[1] = other_btn  # на месте «Свой вариант»
-    if done_btn is not None:
-        bottom[-1] = done_btn  # на месте «Готово»
-
-    rows.append(bottom)
-
-    m = types.InlineKeyboardMarkup()
-    for r in rows:
-        if r:
-            m.row(*r)
-
     text = f"{render_for_step(ch, step)}{framed(f'<b>{title_html}</b>')}"
-    return text, m
+    return text, markup
 
 # =========================
 # ТЕКСТ ПОМОЩИ/ОПИСАНИЯ
@@ -715,326 +856,212 @@ SERVICES_INFO = (
 
 
 # =========================
-# РЕНДЕР ШАГОВ (со стилем «в рамке») — ВСЕ КНОПКИ В СТОЛБИК + ПАГИНАЦИЯ
+# РЕЕСТР ШАГОВ (со стилем «в рамке») — ВСЕ КНОПКИ В СТОЛБИК + ПАГИНАЦИЯ
 # =========================
-def send_step(ch: int, step_key: str, mid: int = None, edit: bool = False):
-    flow = get_flow(ch)
+# Каждый шаг описан записью Step: заголовок, FSM-состояние, опции мультивыбора
+# или клавиатура. FLOW (kp_bot.flow) собирает их с маршрутами FLOWS/FLOW_RULES
+# в таблицы при импорте; send_step только берёт шаг из реестра и рисует его.
+MULTI_OTHER = "📝 Свой вариант"
+
+def _a1_options(sess: dict):
+    return A1_LANDING if sess.get("solution") == "Лендинг" else A1_CORP
+
+def _timeline_options(sess: dict):
+    sol = sess.get("solution")
+    if sol in ("Лендинг", "Чат-бот", "Маркетинг (SEO/контекст)"):
+        return [("1-2w", "1–2 недели"), ("2-4w", "2–4 недели")]
+    if sol == "Корпоративный сайт":
+        return [("2-4w", "2–4 недели"), ("1-2m", "1–2 месяца")]
+    if sol == "Интернет-магазин":
+        return [("1-2m", "1–2 месяца"), ("2-4m", "2–4 месяца")]
+    return []
+
+def _name_body(ch: int, title: str) -> str:
+    return f"{render_for_step(ch, 'name')}{framed(title)}\n"
+
+def _site_comment_body(ch: int, title: str) -> str:
+    return (f"{render_for_step(ch, 'has_site_comment')}"
+            f"{framed(title + chr(10) + '<i>Например: «нравится дизайн, но нет корзины».</i>')}")
+
+def _audience_body(ch: int, title: str) -> str:
+    return (f"{render_for_step(ch, 'audience')}{framed_bottom(title)}\n"
+            "Напишите пол, возраст, род деятельности или интересы.\n\n"
+            "<i>Например: «женщины; 25–40 лет; интересующиеся модой».</i>\n")
 
-    # локальный алиас нумерации: всегда подставляет ch
-    def NT(step: str, text_html: str) -> str:
-        return numbered_title(ch, step, text_html)
+SOLUTION_INFO = (
+    "───────────────────────\n"
+    "<b>Описание услуг:</b>\n\n"
+    "• <b>Маркетинг</b> — SEO и контекстная реклама.\n"
+    "• <b>Корпоративный сайт</b> — разделы о компании, услугах, кейсах.\n"
+    "• <b>Интернет-магазин</b> — каталог, корзина, оплата и доставка.\n"
+    "• <b>Лендинг</b> — одностраничный сайт для быстрых продаж и заявок.\n"
+    "• <b>Чат-бот</b> — автоматизация ответов/заявок."
+)
 
-    def _send(text, markup=None):
-        if edit and mid:
-            try:
-                safe_edit_text(ch, mid, text, markup)
-                set_last_mid(ch, mid)
-                return
-            except Exception:
-                pass
-        m = bot.send_message(ch, text, reply_markup=markup)
-        set_last_mid(ch, m.message_id)
+def _solution_body(ch: int, title: str) -> str:
+    return f"{render_for_step(ch, 'solution')}{framed(title)}\n{SOLUTION_INFO}"
+
+def _contacts_body(ch: int, title: str) -> str:
+    frame = "───────────────────────"
+    return (
+        f"{render_for_step(ch, 'contacts')}"
+        f"{frame}\n{title}\n{frame}\n"
+        "• 📧 Почта\n"
+        "• 📱 Телефон\n"
+        "• 💬 @username\n\n"
+        "<i>Можете ввести любые контактные данные текстом.</i>"
+    )
 
+def _confirm_body(ch: int, title: str) -> str:
+    d = USER[ch]["data"]
+    tl_items = (d.get("timeline") or {}).get("items") or []
+    tl_code = tl_items[0] if tl_items else None
+    tl_label = LABELS["timeline"].get(tl_code, "—")
+    design_text = ", ".join(humanize_list("design", (d.get("design") or {}).get("items", []))) or "—"
+    content_text = ", ".join(humanize_list("content", (d.get("content") or {}).get("items", []))) or "—"
+    budget_items = (d.get("D4_budget") or {}).get("items") or []
+    budget_code = budget_items[0] if budget_items else None
+    budget_text = LABELS["D4_budget"].get(budget_code, "—")
+
+    name = d.get("name", "—")
+    s = [
+        f"<b>Имя:</b> {name}",
+        f"<b>Организация:</b> {d.get('org_name', '—')}",
+        f"<b>Есть сайт:</b> {d.get('has_site', '—')}",
+    ]
+    if d.get("has_site_comment"):
+        s.append(f"<b>Комментарий к сайту:</b> {d.get('has_site_comment')}")
+    s += [
+        f"<b>Продукт/услуга:</b> {d.get('product', '—')}",
+        f"<b>Бизнес-задача:</b> {d.get('biz_goal', '—')}",
+        f"<b>ЦА:</b> {d.get('audience', '—')}",
+        f"<b>Целевое действие:</b> {d.get('user_action', '—')}",
+        f"<b>Тип решения:</b> {USER[ch].get('solution','—')}",
+        f"<b>Дизайн:</b> {design_text}",
+        f"<b>Контент:</b> {content_text}",
+        f"<b>Бюджет:</b> {budget_text}",
+        f"<b>Сроки:</b> {tl_label}",
+        f"<b>Контакты:</b> {d.get('contacts', '—')}",
+    ]
+    return f"{render_for_step(ch, 'confirm')}{framed(title)}\n" + "\n".join(s)
+
+STEPS = [
     # ===== БАЗОВЫЕ =====
-    if step_key == 'name':
-        bot.set_state(ch, St.name, ch)
-        title = NT('name', '<b>Представьтесь пожалуйста, как Вас зовут?</b>')
-        _send(f"{render_for_step(ch, 'name')}{framed(title)}\n")
-        return
-
-    if step_key == 'org_name':
-        bot.set_state(ch, St.org_name, ch)
-        title = NT('org_name', '<b>Как называется ваша организация?</b>')
-        _send(f"{render_for_step(ch, 'org_name')}{framed(title)}", kb(add_back=True, add_home=True))
-        return
-
-    if step_key == 'org_category':
-        bot.set_state(ch, St.org_category, ch)
-        title = NT('org_category', '<b>Выберите категорию вашей организации:</b>')
-        _send(
-            f"{render_for_step(ch, 'org_category')}{framed(title)}",
-            kb(
-                [types.InlineKeyboardButton("Юридическое лицо", callback_data="cat_ul")],
-                [types.InlineKeyboardButton("Физическое лицо", callback_data="cat_fl")],
-                [types.InlineKeyboardButton("ИП", callback_data="cat_ip")],
-                add_back=True, add_home=True
-            )
-        )
-        return
-
-    if step_key == 'has_site':
-        clear_state(ch)
-        bot.set_state(ch, St.has_site, ch)
-        title = NT('has_site', '<b>У вас уже есть сайт?</b>')
-        _send(f"{render_for_step(ch, 'has_site')}{framed(title)}", yn_kb_all_horizontal())
-        return
+    Step('name', '<b>Представьтесь пожалуйста, как Вас зовут?</b>', state=St.name, body=_name_body),
+    Step('org_name', '<b>Как называется ваша организация?</b>', state=St.org_name,
+         keyboard=kb(add_back=True, add_home=True)),
+    Step('org_category', '<b>Выберите категорию вашей организации:</b>', state=St.org_category,
+         keyboard=kb(
+             [types.InlineKeyboardButton("Юридическое лицо", callback_data="cat_ul")],
+             [types.InlineKeyboardButton("Физическое лицо", callback_data="cat_fl")],
+             [types.InlineKeyboardButton("ИП", callback_data="cat_ip")],
+             add_back=True, add_home=True
+         )),
+    Step('has_site', '<b>У вас уже есть сайт?</b>', state=St.has_site, keyboard=yn_kb_all_horizontal()),
+    Step('has_site_comment', '<b>Что вам нравится в вашем сайте, и что бы вы хотели изменить?</b>',
+         state=St.has_site_comment, body=_site_comment_body,
+         keyboard=kb([types.InlineKeyboardButton(f"{EMOJI['back']} Назад", callback_data='ui_back')])),
+    Step('product', '<b>Какой продукт или услугу Вы планируете продвигать?</b>', state=St.product,
+         keyboard=kb(add_back=True, add_home=True)),
+    Step('biz_goal', '<b>Какую главную задачу должен решить сайт?</b>',
+         keyboard=kb_with_bottom(
+             rows=[
+                 [types.InlineKeyboardButton("Информировать о товарах, услугах", callback_data="goal_info2")],
+                 [types.InlineKeyboardButton("Информировать о деятельности", callback_data="goal_info")],
+                 [types.InlineKeyboardButton("Повышать узнаваемость бренда", callback_data="goal_brand")],
+                 [types.InlineKeyboardButton("Продавать товары или услуги", callback_data="goal_sell")],
+                 [types.InlineKeyboardButton("Собирать заявки", callback_data="goal_leads")],
+             ],
+             back=True,
+             other_cd="goal_custom"
+         )),
+    Step('audience', '<b>Кто Ваши потенциальные клиенты?</b>', state=St.audience,
+         body=_audience_body, keyboard=kb(add_back=True)),
+    Step('user_action', '<b>Какое целевое действие должен совершить пользователь на сайте?</b>',
+         keyboard=kb_with_bottom(
+             rows=[
+                 [types.InlineKeyboardButton("Оставить заявку", callback_data="act_lead")],
+                 [types.InlineKeyboardButton("Подписаться", callback_data="act_sub")],
+                 [types.InlineKeyboardButton("Позвонить", callback_data="act_call")],
+                 [types.InlineKeyboardButton("Купить", callback_data="act_buy")],
+             ],
+             back=True,
+             other_cd="act_custom"
+         )),
+    Step('solution', '<b>Какое решение вам нужно?</b>', body=_solution_body,
+         keyboard=kb(
+             [types.InlineKeyboardButton("Маркетинг (SEO/контекст)", callback_data="sol_mkt")],
+             [types.InlineKeyboardButton("Корпоративный сайт", callback_data="sol_corp")],
+             [types.InlineKeyboardButton("Интернет-магазин", callback_data="sol_shop")],
+             [types.InlineKeyboardButton("Лендинг", callback_data="sol_land")],
+             [types.InlineKeyboardButton("Чат-бот", callback_data="sol_bot")],
+             add_back=True
+         )),
+
+    # ===== ВЕТКИ/ОБЩИЕ (мультивыбор) =====
+    Step('A1_blocks', '<b>Выберите ключевые блоки/разделы:</b>', options=_a1_options,
+         other_text=MULTI_OTHER, preset=True),
+    Step('A2_functions', '<b>Планируете ли Вы функционал на сайте?</b>', options=A2_FUNCTIONS,
+         other_text=MULTI_OTHER),
+    Step('B1_sections', '<b>Разделы интернет-магазина:</b>', options=B1_SECTIONS,
+         other_text=MULTI_OTHER, preset=True),
+    Step('B2_assort', '<b>Сколько примерно товаров планируете?</b>', options=B2_ASSORT, single=True),
+    Step('B3_functions', '<b>Какой функционал нужен в магазине, кроме корзины?</b>', options=B3_FUNCTIONS),
+    Step('C1_tasks', '<b>Где чат-бот принесёт максимальную пользу?</b>', options=C1_TASKS,
+         other_text=MULTI_OTHER, preset=True),
+    Step('C2_platforms', '<b>В каких мессенджерах/платформах должен работать чат-бот?</b>', options=C2_PLATFORMS,
+         other_text=MULTI_OTHER),
+    Step('C3_integrations', '<b>Нужны ли Вам интеграции с внешними сервисами?</b>', options=C3_INTEGR),
+    Step('D1_goals', '<b>Какую задачу хотите решить маркетингом?</b>', options=D1_GOALS,
+         other_text=MULTI_OTHER, preset=True),
+    Step('D2_channels', '<b>Какие каналы продвижения хотите использовать?</b>', options=D2_CHANNELS),
+    Step('D4_budget', '<b>Какой примерный бюджет на маркетинг планируете ежемесячно?</b>', options=D4_BUDGET,
+         single=True),
+    Step('design', '<b>Какой дизайн Вы хотите?</b>', options=DESIGN, single=True),
+    Step('content', '<b>Кто предоставляет контент материалы?</b>', options=CONTENT, single=True),
+    Step('timeline', '<b>Как быстро нужно выполнить работу?</b>', options=_timeline_options, single=True),
+
+    Step('contacts', '<b>Благодарю Вас за ответы. Оставьте контактные данные:</b>', state=St.contacts,
+         body=_contacts_body,
+         keyboard=kb([types.InlineKeyboardButton("📱 Поделиться контактом", callback_data="share_contact")],
+                     add_back=True, add_home=True)),
+    Step('confirm', '<b>Проверьте данные:</b>', state=KEEP, body=_confirm_body,
+         keyboard=kb([types.InlineKeyboardButton(f"{EMOJI['confirm']} Создать КП", callback_data="go_pdf")],
+                     add_home=True)),
+]
 
-    if step_key == 'product':
-        bot.set_state(ch, St.product, ch)
-        title = NT('product', '<b>Какой продукт или услугу Вы планируете продвигать?</b>')
-        _send(f"{render_for_step(ch, 'product')}{framed(title)}", kb(add_back=True, add_home=True))
-        return
+FLOW = FlowMachine(STEPS, FLOWS, FLOW_RULES)
+register_flows(FLOW.flows)     # старые сессии со списком шагов загружаются уже с именем маршрута
 
-    if step_key == 'biz_goal':
-        clear_state(ch)
-        title = NT('biz_goal', '<b>Какую главную задачу должен решить сайт?</b>')
-        _send(
-            f"{render_for_step(ch, 'biz_goal')}{framed(title)}",
-            kb_with_bottom(
-                rows=[
-                    [types.InlineKeyboardButton("Информировать о товарах, услугах", callback_data="goal_info2")],
-                    [types.InlineKeyboardButton("Информировать о деятельности", callback_data="goal_info")],
-                    [types.InlineKeyboardButton("Повышать узнаваемость бренда", callback_data="goal_brand")],
-                    [types.InlineKeyboardButton("Продавать товары или услуги", callback_data="goal_sell")],
-                    [types.InlineKeyboardButton("Собирать заявки", callback_data="goal_leads")],
-                ],
-                back=True,
-                other_cd="goal_custom"
-            )
-        )
-        return
 
-    if step_key == 'audience':
-        bot.set_state(ch, St.audience, ch)
-        title = NT('audience', '<b>Кто Ваши потенциальные клиенты?</b>')
-        _send(
-            f"{render_for_step(ch, 'audience')}{framed_bottom(title)}\n"
-            "Напишите пол, возраст, род деятельности или интересы.\n\n"
-            "<i>Например: «женщины; 25–40 лет; интересующиеся модой».</i>\n",
-            kb(add_back=True)
-        )
-        return
+def render_step(ch: int, step: Step):
+    """(текст, клавиатура) шага — без обращения к Telegram."""
+    title = numbered_title(ch, step.key, step.title)
+    if step.multiselect:
+        opts = step.options(USER[ch]) if callable(step.options) else step.options
+        return multiselect_screen(ch, step.key, title, opts, single=step.single,
+                                  add_other_text=step.other_text, add_preset=step.preset)
+    text = step.body(ch, title) if step.body else f"{render_for_step(ch, step.key)}{framed(title)}"
+    return text, step.keyboard
 
-    if step_key == 'user_action':
-        clear_state(ch)
-        title = NT('user_action', '<b>Какое целевое действие должен совершить пользователь на сайте?</b>')
-        _send(
-            f"{render_for_step(ch, 'user_action')}{framed(title)}",
-            kb_with_bottom(
-                rows=[
-                    [types.InlineKeyboardButton("Оставить заявку", callback_data="act_lead")],
-                    [types.InlineKeyboardButton("Подписаться", callback_data="act_sub")],
-                    [types.InlineKeyboardButton("Позвонить", callback_data="act_call")],
-                    [types.InlineKeyboardButton("Купить", callback_data="act_buy")],
-                ],
-                back=True,
-                other_cd="act_custom"
-            )
-        )
-        return
 
-    if step_key == 'solution':
-        clear_state(ch)
-        info = (
-            "───────────────────────\n"
-            "<b>Описание услуг:</b>\n\n"
-            "• <b>Маркетинг</b> — SEO и контекстная реклама.\n"
-            "• <b>Корпоративный сайт</b> — разделы о компании, услугах, кейсах.\n"
-            "• <b>Интернет-магазин</b> — каталог, корзина, оплата и доставка.\n"
-            "• <b>Лендинг</b> — одностраничный сайт для быстрых продаж и заявок.\n"
-            "• <b>Чат-бот</b> — автоматизация ответов/заявок."
-        )
-        title = NT('solution', '<b>Какое решение вам нужно?</b>')
-        text = f"{render_for_step(ch, 'solution')}{framed(title)}\n{info}"
-        _send(
-            text,
-            kb(
-                [types.InlineKeyboardButton("Маркетинг (SEO/контекст)", callback_data="sol_mkt")],
-                [types.InlineKeyboardButton("Корпоративный сайт", callback_data="sol_corp")],
-                [types.InlineKeyboardButton("Интернет-магазин", callback_data="sol_shop")],
-                [types.InlineKeyboardButton("Лендинг", callback_data="sol_land")],
-                [types.InlineKeyboardButton("Чат-бот", callback_data="sol_bot")],
-                add_back=True
-            )
-        )
+async def send_step(ch: int, step_key: str, mid: int = None, edit: bool = False):
+    runtime.cancel_later(("step", ch))  # отложенный показ шага (in_name) больше не нужен
+    step = FLOW.steps.get(step_key)
+    if step is None:
         return
 
-    # ===== ВЕТКИ/ОБЩИЕ =====
-    if step_key == 'A1_blocks':
-        clear_state(ch)
-        sol = USER[ch]["solution"]
-        opts = A1_LANDING if sol == "Лендинг" else A1_CORP
-        t_html = NT('A1_blocks', '<b>Выберите ключевые блоки/разделы:</b>')
-        text, markup = multiselect_screen(
-            ch, 'A1_blocks', t_html,
-            opts, single=False, add_other_text="📝 Свой вариант", add_preset=True
-        )
-        _send(text, markup); return
-
-    if step_key == 'A2_functions':
-        clear_state(ch)
-        t_html = NT('A2_functions', '<b>Планируете ли Вы функционал на сайте?</b>')
-        text, markup = multiselect_screen(
-            ch, 'A2_functions', t_html,
-            A2_FUNCTIONS, single=False, add_other_text="📝 Свой вариант"
-        )
-        _send(text, markup); return
-
-    if step_key == 'B1_sections':
-        clear_state(ch)
-        t_html = NT('B1_sections', '<b>Разделы интернет-магазина:</b>')
-        text, markup = multiselect_screen(
-            ch, 'B1_sections', t_html,
-            B1_SECTIONS, single=False, add_other_text="📝 Свой вариант", add_preset=True
-        )
-        _send(text, markup); return
-
-    if step_key == 'B2_assort':
-        clear_state(ch)
-        t_html = NT('B2_assort', '<b>Сколько примерно товаров планируете?</b>')
-        text, markup = multiselect_screen(
-            ch, 'B2_assort', t_html,
-            B2_ASSORT, single=True
-        )
-        _send(text, markup); return
-
-    if step_key == 'B3_functions':
-        clear_state(ch)
-        t_html = NT('B3_functions', '<b>Какой функционал нужен в магазине, кроме корзины?</b>')
-        text, markup = multiselect_screen(
-            ch, 'B3_functions', t_html,
-            B3_FUNCTIONS, single=False
-        )
-        _send(text, markup); return
-
-    if step_key == 'C1_tasks':
-        clear_state(ch)
-        t_html = NT('C1_tasks', '<b>Где чат-бот принесёт максимальную пользу?</b>')
-        text, markup = multiselect_screen(
-            ch, 'C1_tasks', t_html,
-            C1_TASKS, single=False, add_other_text="📝 Свой вариант", add_preset=True
-        )
-        _send(text, markup); return
-
-    if step_key == 'C2_platforms':
-        clear_state(ch)
-        t_html = NT('C2_platforms', '<b>В каких мессенджерах/платформах должен работать чат-бот?</b>')
-        text, markup = multiselect_screen(
-            ch, 'C2_platforms', t_html,
-            C2_PLATFORMS, single=False, add_other_text="📝 Свой вариант"
-        )
-        _send(text, markup); return
-
-    if step_key == 'C3_integrations':
-        clear_state(ch)
-        t_html = NT('C3_integrations', '<b>Нужны ли Вам интеграции с внешними сервисами?</b>')
-        text, markup = multiselect_screen(
-            ch, 'C3_integrations', t_html,
-            C3_INTEGR, single=False
-        )
-        _send(text, markup); return
-
-    if step_key == 'D1_goals':
-        clear_state(ch)
-        t_html = NT('D1_goals', '<b>Какую задачу хотите решить маркетингом?</b>')
-        text, markup = multiselect_screen(
-            ch, 'D1_goals', t_html,
-            D1_GOALS, single=False, add_other_text="📝 Свой вариант", add_preset=True
-        )
-        _send(text, markup); return
-
-    if step_key == 'D2_channels':
-        clear_state(ch)
-        t_html = NT('D2_channels', '<b>Какие каналы продвижения хотите использовать?</b>')
-        text, markup = multiselect_screen(
-            ch, 'D2_channels', t_html,
-            D2_CHANNELS, single=False
-        )
-        _send(text, markup); return
-
-    if step_key == 'D4_budget':
-        clear_state(ch)
-        t_html = NT('D4_budget', '<b>Какой примерный бюджет на маркетинг планируете ежемесячно?</b>')
-        text, markup = multiselect_screen(
-            ch, 'D4_budget', t_html,
-            D4_BUDGET, single=True
-        )
-        _send(text, markup); return
-
-    if step_key == 'design':
-        clear_state(ch)
-        t_html = NT('design', '<b>Какой дизайн Вы хотите?</b>')
-        text, markup = multiselect_screen(ch, 'design', t_html, DESIGN, single=True)
-        _send(text, markup); return
-
-    if step_key == 'content':
-        clear_state(ch)
-        t_html = NT('content', '<b>Кто предоставляет контент материалы?</b>')
-        text, markup = multiselect_screen(ch, 'content', t_html, CONTENT, single=True)
-        _send(text, markup); return
-
-    if step_key == 'timeline':
-        clear_state(ch)
-        sol = USER[ch]["solution"]
-        if sol in ("Лендинг", "Чат-бот", "Маркетинг (SEO/контекст)"):
-            opts = [("1-2w", "1–2 недели"), ("2-4w", "2–4 недели")]
-        elif sol == "Корпоративный сайт":
-            opts = [("2-4w", "2–4 недели"), ("1-2m", "1–2 месяца")]
-        elif sol == "Интернет-магазин":
-            opts = [("1-2m", "1–2 месяца"), ("2-4m", "2–4 месяца")]
-        else:
-            opts = []
-        t_html = NT('timeline', '<b>Как быстро нужно выполнить работу?</b>')
-        text, markup = multiselect_screen(ch, 'timeline', t_html, opts, single=True)
-        _send(text, markup); return
-
-    if step_key == 'contacts':
-        clear_state(ch)
-        bot.set_state(ch, St.contacts, ch)
-        frame = "───────────────────────"
-        head = NT('contacts', '<b>Благодарю Вас за ответы. Оставьте контактные данные:</b>')
-        body_html = (
-            f"{frame}\n{head}\n{frame}\n"
-            "• 📧 Почта\n"
-            "• 📱 Телефон\n"
-            "• 💬 @username\n\n"
-            "<i>Можете ввести любые контактные данные текстом.</i>"
-        )
-        _send(
-            f"{render_for_step(ch, 'contacts')}{body_html}",
-            kb([types.InlineKeyboardButton("📱 Поделиться контактом", callback_data="share_contact")],
-               add_back=True, add_home=True)
-        )
-        return
+    if step.state is None:
+        await clear_state(ch)
+    elif step.state is not KEEP:
+        await api.set_state(ch, step.state, ch)
+    text, markup = render_step(ch, step)
 
-    if step_key == 'confirm':
-        d = USER[ch]["data"]
-        tl_items = (d.get("timeline") or {}).get("items") or []
-        tl_code = tl_items[0] if tl_items else None
-        tl_label = LABELS["timeline"].get(tl_code, "—")
-        design_text = ", ".join(humanize_list("design", (d.get("design") or {}).get("items", []))) or "—"
-        content_text = ", ".join(humanize_list("content", (d.get("content") or {}).get("items", []))) or "—"
-        budget_items = (d.get("D4_budget") or {}).get("items") or []
-        budget_code = budget_items[0] if budget_items else None
-        budget_text = LABELS["D4_budget"].get(budget_code, "—")
-
-        name = d.get("name", "—")
-        s = [
-            f"<b>Имя:</b> {name}",
-            f"<b>Организация:</b> {d.get('org_name', '—')}",
-            f"<b>Есть сайт:</b> {d.get('has_site', '—')}",
-        ]
-        if d.get("has_site_comment"):
-            s.append(f"<b>Комментарий к сайту:</b> {d.get('has_site_comment')}")
-        s += [
-            f"<b>Продукт/услуга:</b> {d.get('product', '—')}",
-            f"<b>Бизнес-задача:</b> {d.get('biz_goal', '—')}",
-            f"<b>ЦА:</b> {d.get('audience', '—')}",
-            f"<b>Целевое действие:</b> {d.get('user_action', '—')}",
-            f"<b>Тип решения:</b> {USER[ch].get('solution','—')}",
-            f"<b>Дизайн:</b> {design_text}",
-            f"<b>Контент:</b> {content_text}",
-            f"<b>Бюджет:</b> {budget_text}",
-            f"<b>Сроки:</b> {tl_label}",
-            f"<b>Контакты:</b> {d.get('contacts', '—')}",
-        ]
-        title = NT('confirm', '<b>Проверьте данные:</b>')
-        _send(
-            f"{render_for_step(ch, 'confirm')}{framed(title)}\n" + "\n".join(s),
-            kb([types.InlineKeyboardButton(f"{EMOJI['confirm']} Создать КП", callback_data="go_pdf")],
-               add_home=True)
-        )
+    if edit and mid:
+        await safe_edit_text(ch, mid, text, markup)     # не вышло — новое сообщение шлёт _edit_message
         return
+    m = await api.send_message(ch, text, reply_markup=markup)
+    set_last_mid(ch, m.message_id)
 
 # =========================
 # ХЭЛПЕР ДЛЯ ВЫВОДА
@@ -1152,6 +1179,21 @@ KP_TEMPLATE = r"""
 </body></html>
 """
 
+# Шаблон КП компилируется один раз при импорте. Автоэкранирование включено:
+# пользовательский ввод (название, цели, контакты) попадает в HTML как текст,
+# а заранее собранные блоки (selections_text) помечены как Markup.
+# KP_TEMPLATE_CACHE — каталог для байткода Jinja, чтобы холодный старт не компилировал заново.
+KP_TEMPLATE_CACHE = os.getenv("KP_TEMPLATE_CACHE", os.path.join("instance", "jinja_cache"))
+if KP_TEMPLATE_CACHE:
+    os.makedirs(KP_TEMPLATE_CACHE, exist_ok=True)
+KP_ENV = Environment(
+    loader=DictLoader({"kp.html": KP_TEMPLATE}),
+    autoescape=True,
+    auto_reload=False,
+    bytecode_cache=FileSystemBytecodeCache(KP_TEMPLATE_CACHE) if KP_TEMPLATE_CACHE else None,
+)
+KP_TPL = KP_ENV.get_template("kp.html")
+
 
 
 
@@ -1245,7 +1287,7 @@ def build_kp_context(ch: int):
                 selections_text_parts.append(
                     f"<div class='subsection'><div class='subsection-title'>{title}</div>{lines}</div>"
                 )
-    selections_text = "".join(selections_text_parts)
+    selections_text = Markup("".join(selections_text_parts))  # части уже экранированы в humanize_dict
 
     # базовая цена
     base_price = BASE_PRICES.get(site_type, 0)
@@ -1338,14 +1380,26 @@ def render_branch_for_pdf(d: dict, solution: str):
     if 'D4_budget' in d: out["Бюджет"] = pretty_items(d['D4_budget'])
     return out
 
-def make_kp_html(ch: int) -> str:
-    from glob import glob
+if KP_STORAGE_LAYOUT not in LAYOUTS:
+    raise ValueError(f"KP_STORAGE_LAYOUT={KP_STORAGE_LAYOUT!r}: expected one of {LAYOUTS}")
+KP_SEQ = SeqAllocator(KP_SEQ_DB)
+KP_INDEX = KpIndex(KP_SEQ_DB)   # хеш содержимого КП -> файл и file_id (та же маленькая БД)
+KP_TEMPLATE_SHA = hashlib.sha256(KP_TEMPLATE.encode("utf-8")).hexdigest()
 
-    ctx = build_kp_context(ch)
-    html_text = Template(KP_TEMPLATE).render(**ctx)
+
+def render_kp_html(ch: int, ctx: dict | None = None) -> str:
+    return KP_TPL.render(**(ctx or build_kp_context(ch)))
+
+PDF = PdfRenderer(workers=PDF_WORKERS, cache_dir=PDF_CACHE_DIR, font=PDF_FONT)
+
+def render_kp(ch: int, ctx: dict | None = None) -> KpDocument:
+    """
+    КП в память: HTML (его разбирает админка) + PDF, если KP_FORMAT=pdf.
+    Номер файла занимаем сразу, сам файл запишет store_kp уже после отправки.
+    """
+    html_text = render_kp_html(ch, ctx)
 
     out_dir = os.path.join(os.getcwd(), "generated_kp")
-    os.makedirs(out_dir, exist_ok=True)
 
     # телефон из контактов (только цифры)
     raw_contacts = USER[ch]["data"].get("contacts", "")
@@ -1354,30 +1408,144 @@ def make_kp_html(ch: int) -> str:
     # дата как ГГГГММДД
     date_str = datetime.now().strftime("%Y%m%d")
 
-    # считаем, сколько уже создано файлов этим пользователем за сегодня
-    pattern = os.path.join(out_dir, f"KP_{phone}_{date_str}_*.html")
-    seq = len(glob(pattern)) + 1  # следующий номер
+    # номер за сегодня — из счётчика KP_SEQ (без glob по папке); имя занимаем
+    # заглушкой сразу, до отправки: занято чужим файлом — берём следующий номер
+    prefix = f"KP_{phone}_{date_str}"
+    pdf = None
+    if KP_FORMAT == "pdf":
+        try:
+            pdf = PDF.render(html_text)
+        except PdfError:
+            log.exception(f"pdf render failed, sending HTML instead: {prefix}")
+    seq = reserve_kp_name(out_dir, prefix, KP_SEQ, layout=KP_STORAGE_LAYOUT)
+    return KpDocument(out_dir, prefix, seq, html_text, pdf, layout=KP_STORAGE_LAYOUT)
+
+def make_kp_file(ch: int, ctx: dict | None = None) -> str:
+    """Отрендерить и сразу записать (без отправки); вернуть путь к файлу для клиента."""
+    return render_kp(ch, ctx).save(KP_SEQ)
+
+def kp_content_key(ctx: dict) -> str:
+    """Хеш содержимого КП: формат + шаблон + контекст. Один ключ — один и тот же документ."""
+    raw = json.dumps(ctx, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(f"{KP_FORMAT}\n{KP_TEMPLATE_SHA}\n{raw}".encode("utf-8")).hexdigest()
+
+def prepare_kp(ch: int) -> tuple:
+    """
+    (ключ, документ, путь, file_id) для отправки. Если такое же КП уже выпускали —
+    берём его из KP_INDEX (file_id или готовый файл), иначе рендерим в память:
+    документ уходит из буфера, на диск его пишет store_kp.
+    """
+    ctx = build_kp_context(ch)
+    key = kp_content_key(ctx)      # и без KP_DEDUP: по нему KP_WASTE считает повторы
+    if not KP_DEDUP:
+        return key, render_kp(ch, ctx), None, None
+    hit = KP_INDEX.get(key)
+    if hit:
+        path, file_id = hit
+        if file_id or os.path.exists(path):
+            return key, None, path, file_id
+    return key, render_kp(ch, ctx), None, None
+
+def _save_kp(key: str | None, doc: KpDocument, file_id: str | None) -> str:
+    path = doc.save(KP_SEQ)
+    if key and KP_DEDUP:
+        KP_INDEX.put(key, path, file_id)
+    return path
+
+async def persist_kp(key: str | None, doc: KpDocument, file_id: str | None):
+    """Задача пула KP_STORE: записать КП на диск и в индекс (клиент его уже получил)."""
+    path = await offload(_save_kp, key, doc, file_id)
+    log.info(f"kp stored: {path}")
+
+async def store_kp(key: str | None, doc: KpDocument, file_id: str | None):
+    # медленный диск не задерживает доставку; очередь полна — пишем здесь же, но не теряем файл
+    if not KP_STORE.submit(persist_kp, key, doc, file_id):
+        await persist_kp(key, doc, file_id)
+
+def _document_file_id(msg) -> str | None:
+    doc = getattr(msg, "document", None)
+    return getattr(doc, "file_id", None)
+
+async def deliver_kp(ch: int, wait_mid: int | None = None):
+    """Задача пула KP_JOBS: сформировать КП, отправить документ и убрать «готовим…»."""
+    try:
+        with ratelimit.lane(ratelimit.HIGH):   # документ и сообщение менеджера — вперёд косметики
+            await _deliver_kp(ch, wait_mid)
+    finally:
+        KP_INFLIGHT.release(ch)
 
-    # на всякий случай — если файл вдруг существует, ищем следующий свободный номер
-    out_path = os.path.join(out_dir, f"KP_{phone}_{date_str}_{seq}.html")
-    while os.path.exists(out_path):
-        seq += 1
-        out_path = os.path.join(out_dir, f"KP_{phone}_{date_str}_{seq}.html")
+async def _deliver_kp(ch: int, wait_mid: int | None):
+    try:
+        caption = "✅ Ваше коммерческое предложение готово!"
+        key, doc, path, file_id = await offload(prepare_kp, ch)  # рендер (в память) не держит event loop
+        if doc is not None and key:
+            KP_WASTE.note("renders", (ch, key))
+        if file_id:
+            try:
+                await api.send_document(ch, file_id, caption=caption)  # то же КП уже загружали
+                KP_INDEX.note_reused()
+            except Exception as e:
+                log.warning(f"kp: cached file_id rejected, uploading again: {e}")
+                KP_INDEX.set_file_id(key, None)
+                file_id = None
+                if not os.path.exists(path):
+                    key, doc, path, _ = await offload(prepare_kp, ch)
+        if not file_id and key:
+            KP_WASTE.note("uploads", (ch, key))
+        if not file_id and doc is not None:
+            # свежий документ — из буфера; запись на диск и в KP_INDEX — после, в фоне
+            try:
+                msg = await api.send_document(ch, doc.buffer(), visible_file_name=doc.name, caption=caption)
+                file_id = _document_file_id(msg)
+            finally:
+                await store_kp(key, doc, file_id)
+        elif not file_id:
+            with open(path, "rb") as f:
+                msg = await api.send_document(
+                    ch, f,
+                    visible_file_name=os.path.basename(path),
+                    caption=caption
+                )
+            if key and _document_file_id(msg):
+                KP_INDEX.set_file_id(key, _document_file_id(msg))
+        # 👇 Добавляем сообщение про менеджера
+        mgr_kb = types.InlineKeyboardMarkup()
+        mgr_kb.add(types.InlineKeyboardButton("📞 Связаться с менеджером", url="https://t.me/PlaBarov"))
+        await api.send_message(
+            ch,
+            "Если остались вопросы — напишите менеджеру:",
+            reply_markup=mgr_kb
+        )
+    except Exception as e:
+        log.error(f"kp delivery failed: {e}")
+        await api.send_message(ch, "Не удалось сформировать файл. Сообщите менеджеру, пожалуйста.")
+    finally:
+        if wait_mid:
+            await safe_delete(ch, wait_mid)
+
+
+KP_JOBS = JobQueue("kp", workers=KP_WORKERS, max_depth=KP_QUEUE_MAX)
+LOAD.add_gauge("kp_queue", KP_JOBS.depth, KP_QUEUE_MAX)
+KP_STORE = JobQueue("kp-store", workers=KP_STORE_WORKERS, max_depth=KP_STORE_QUEUE)
 
-    with open(out_path, "w", encoding="utf-8") as f:
-        f.write(html_text)
-    return out_path
 
-def make_pdf(ch: int) -> str:
-    # теперь PDF не генерим, возвращаем путь к HTML
-    return make_kp_html(ch)
+async def log_stats():
+    """Периодическая строка в лог: по ней подбираем размеры пулов и кешей."""
+    log.info(f"load: {LOAD.stats()}")
+    log.info(f"stats: kp_jobs={KP_JOBS.stats()} kp_store={KP_STORE.stats()} kb_cache={KB_CACHE.stats()} "
+             f"scheduler={runtime.SCHEDULER.stats()} sessions={USER.stats()} pdf={PDF.stats()} "
+             f"kp_dedup={KP_INDEX.stats()} media={MEDIA.stats()} "
+             f"rate={RATE.stats() if RATE else None} edits={EDITS.stats()} callbacks={CB.stats()} "
+             f"chats={CHATS.stats() if CHATS else None} updates={UPDATES.stats()} taps={TAPS.stats()} "
+             f"kp_inflight={KP_INFLIGHT.stats()} kp_wasted={KP_WASTE.stats()}")
+    runtime.call_later(STATS_SEC, log_stats, key="stats")
 
 # =========================
 # ПОТОК/ВЕТКИ
 # =========================
 def apply_branch_flow(ch: int, solution_label: str):
     USER[ch]["solution"] = solution_label
-    USER[ch]["multiselect_ctx"] = {}
+    USER[ch].reset_multiselect()
 
     if solution_label in ("Лендинг", "Корпоративный сайт"):
         b = 'A'
@@ -1389,27 +1557,20 @@ def apply_branch_flow(ch: int, solution_label: str):
         b = 'D'
     USER[ch]["branch"] = b
 
-    # добираем ветку к ТЕКУЩЕМУ маршруту (в котором «has_site_comment» уже
-    # есть или его нет – в зависимости от ответа пользователя)
-    flow = USER[ch]["flow"]
-    if "solution" in flow:
-        prefix = flow[:flow.index("solution") + 1]
-    else:
-        prefix = flow[:]
-    USER[ch]["flow"] = prefix + BRANCH_FLOW[b] + COMMON_ORDER
-    USER[ch]["idx"] = USER[ch]["flow"].index("solution")
+    # добираем ветку к ТЕКУЩЕМУ маршруту (base или nosite) — готовый маршрут из FLOWS
+    fire(ch, f"branch:{b}")
 # =========================
 # CALLBACK-и
 # =========================
-@bot.callback_query_handler(func=lambda c: c.data == "share_contact")
-def on_share_contact(c):
+@handlers.callback(func=lambda c: c.data == "share_contact")
+async def on_share_contact(c):
     ch = c.message.chat.id
-    bot.answer_callback_query(c.id)
+    await api.answer_callback_query(c.id)
 
     share_kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
     share_kb.add(types.KeyboardButton("📱 Отправить мой номер", request_contact=True))
 
-    send_temp(
+    await send_temp(
         ch,
         "👇 Нажмите кнопку «📱 Отправить мой номер» ниже.\n"
         "Я автоматически добавлю ваш номер телефона и Telegram-ник в контакты КП.",
@@ -1417,217 +1578,257 @@ def on_share_contact(c):
         reply_markup=share_kb
     )
 
-@bot.message_handler(content_types=['contact'], state=St.contacts)
-def in_contact_obj(m):
+@handlers.message(content_types=['contact'], state=St.contacts)
+async def in_contact_obj(m):
     ch = m.chat.id
     parsed = parse_contacts("", tg_username=m.from_user.username,
                             phone_from_share=(m.contact.phone_number if m.contact else None))
     USER[ch]["data"]["contacts"] = format_contacts(parsed)
-    safe_delete(ch, m.message_id)          # 🗑️ удалить сообщение с «поделиться контактом»
-    send_temp(ch, "✅ Контакт добавлен!", ttl=3, reply_markup=types.ReplyKeyboardRemove())
+    await safe_delete(ch, m.message_id)          # 🗑️ удалить сообщение с «поделиться контактом»
+    await send_temp(ch, "✅ Контакт добавлен!", ttl=3, reply_markup=types.ReplyKeyboardRemove())
     next_step(ch)
-    send_step(ch, cur_step(ch), mid=get_last_mid(ch), edit=True)
+    await send_step(ch, cur_step(ch), mid=get_last_mid(ch), edit=True)
+
+# --- callback-кнопки: хендлеры регистрируются в CB (kp_bot.router), on_cb только диспетчеризует ---
+@CB.exact("ui_back")
+async def cb_back(ch: int, mid: int, _):
+    await go_back(ch, mid)
+
+@CB.exact("act_start")
+async def cb_start(ch: int, mid: int, _):
+    init_user(ch)
+    await send_step(ch, 'name', mid, edit=True)
+
+@CB.exact("act_about")
+async def cb_about(ch: int, mid: int, _):
+    about_text = (
+        "ℹ️ <b>О боте</b>\n\n"
+        "1) Отвечаете на вопросы (≈3–5 минут).\n"
+        "2) Выбираете решение и нужные опции.\n"
+        "3) Получаете готовое КП в PDF.\n\n"
+        "<b>Конфиденциальность</b>\n"
+        "Ответы используются только для формирования КП и связи с вами.\n\n"
+        "Если возникнут вопросы — нажмите «Связаться с менеджером» ниже."
+    )
+    about_kb = types.InlineKeyboardMarkup()
+    about_kb.add(types.InlineKeyboardButton("📝 Начать", callback_data="act_start"))
+    about_kb.add(types.InlineKeyboardButton("📞 Связаться с менеджером", url="https://t.me/PlaBarov"))
+    await safe_edit_text(ch, mid, about_text, about_kb)
 
-@bot.callback_query_handler(func=lambda c: True)
-def on_cb(c):
-    ch, mid, data = c.message.chat.id, c.message.message_id, c.data
+@CB.exact("ui_home")
+async def cb_home(ch: int, mid: int, _):
+    await safe_edit_text(ch, mid, "Главное меню:", main_menu_kb())
 
-    # 👇 защита: если чата ещё нет в памяти, создаём
-    if ch not in USER:
-        init_user(ch)
+# категории
+CB_CATEGORIES = {"cat_fl": "Физическое лицо", "cat_ip": "ИП", "cat_ul": "Юридическое лицо", "cat_other": "Свой вариант"}
 
-    set_last_mid(ch, mid)
+@CB.exact(*CB_CATEGORIES)
+async def cb_category(ch: int, mid: int, data: str):
+    USER[ch]["data"]["org_category"] = CB_CATEGORIES[data]
+    next_step(ch)
+    await send_step(ch, cur_step(ch), mid, edit=True)
 
-    if data == "ui_back":
-        go_back(ch, mid)
+# есть сайт?
+@CB.exact("yn_yes", "yn_no")
+async def cb_has_site(ch: int, mid: int, data: str):
+    if cur_step(ch) != "has_site":
         return
-    try:
-        bot.answer_callback_query(c.id)
-    except Exception:
-        pass
-    log.info(
-        f"cb:{data} idx={USER.get(ch, {}).get('idx')} step={USER.get(ch, {}).get('flow', [None])[USER.get(ch, {}).get('idx', 0)] if USER.get(ch) else '—'}")
+    USER[ch].setdefault("data", {})["has_site"] = "Да" if data == "yn_yes" else "Нет"
+
+    # да — короткий маршрут: комментарий → контакты → подтверждение;
+    # нет — полный: задача → действие → продукт → решение ...
+    step = fire(ch, "has_site:yes" if data == "yn_yes" else "has_site:no")
+    await send_step(ch, step, mid, edit=True)
+
+# goal buttons
+CB_GOALS = {"goal_sell": "Продавать товары или услуги", "goal_leads": "Собирать заявки",
+            "goal_info2": "Информировать о товарах или услугах",
+            "goal_info": "Информировать о деятельности",
+            "goal_brand": "Повышать узнаваемость бренда"}
+
+@CB.exact(*CB_GOALS)
+async def cb_goal(ch: int, mid: int, data: str):
+    USER[ch]["data"]["biz_goal"] = CB_GOALS[data]
+    next_step(ch)
+    await send_step(ch, cur_step(ch), mid, edit=True)
+
+@CB.exact("goal_custom")
+async def cb_goal_custom(ch: int, mid: int, _):
+    await api.set_state(ch, St.biz_goal, ch)  # <-- state только здесь
+    await safe_edit_text(
+        ch, mid,
+        f"{render_for_step(ch, 'biz_goal')}{framed(numbered_title(ch, 'biz_goal', 'Опишите вашу ключевую задачу текстом:'))}",
+        kb(add_back=True, add_home=True)
+    )
 
-    try:
-        if data == "act_start":
-            init_user(ch)
-            send_step(ch, 'name', mid, edit=True)
-            return
-        if data == "act_about":
-            about_text = (
-                "ℹ️ <b>О боте</b>\n\n"
-                "1) Отвечаете на вопросы (≈3–5 минут).\n"
-                "2) Выбираете решение и нужные опции.\n"
-                "3) Получаете готовое КП в PDF.\n\n"
-                "<b>Конфиденциальность</b>\n"
-                "Ответы используются только для формирования КП и связи с вами.\n\n"
-                "Если возникнут вопросы — нажмите «Связаться с менеджером» ниже."
-            )
-            about_kb = types.InlineKeyboardMarkup()
-            about_kb.add(types.InlineKeyboardButton("📝 Начать", callback_data="act_start"))
-            about_kb.add(types.InlineKeyboardButton("📞 Связаться с менеджером", url="https://t.me/PlaBarov"))
-            safe_edit_text(ch, mid, about_text, about_kb)
-            return
+# user action buttons
+CB_ACTIONS = {"act_buy": "Купить", "act_call": "Позвонить", "act_lead": "Оставить заявку", "act_sub": "Подписаться"}
 
-        if data == "ui_home":
-            safe_edit_text(ch, mid, "Главное меню:", main_menu_kb())
-            return
-        if data == "ui_back":
-            go_back(ch, mid)
-            return
-        # категории
-        if data.startswith("cat_"):
-            USER[ch]["data"]["org_category"] = \
-                {"cat_fl": "Физическое лицо", "cat_ip": "ИП", "cat_ul": "Юридическое лицо", "cat_other": "Свой вариант"}[
-                    data]
-            next_step(ch)
-            send_step(ch, cur_step(ch), mid, edit=True)
-            return
-
-        # есть сайт?
-        if data in ("yn_yes", "yn_no") and cur_step(ch) == "has_site":
-            USER[ch].setdefault("data", {})["has_site"] = "Да" if data == "yn_yes" else "Нет"
-
-            if data == "yn_yes":
-                # короткий маршрут: комментарий → контакты → подтверждение
-                USER[ch]["flow"] = ["name", "org_name", "has_site", "has_site_comment", "contacts", "confirm"]
-                set_step(ch, "has_site_comment")
-                bot.set_state(ch, St.has_site_comment, ch)
-                prompt = framed(
-                    numbered_title(ch, 'has_site_comment',
-                                   "<b>Что вам нравится в вашем сайте, и что бы вы хотели изменить?</b>")
-                    + "\n<i>Например: «нравится дизайн, но нет корзины».</i>"
-                )
-                safe_edit_text(
-                    ch, mid,
-                    f"{render_for_step(ch, 'has_site_comment')}{prompt}",
-                    kb([types.InlineKeyboardButton(f"{EMOJI['back']} Назад", callback_data='ui_back')])
-                )
-            else:
-                # полный маршрут: задача → действие → продукт → решение ...
-                USER[ch]["flow"] = ["name", "org_name", "has_site", "biz_goal", "user_action", "product", "solution"]
-                set_step(ch, "biz_goal")
-                send_step(ch, "biz_goal", mid, edit=True)
-            return
+@CB.exact(*CB_ACTIONS)
+async def cb_action(ch: int, mid: int, data: str):
+    USER[ch]["data"]["user_action"] = CB_ACTIONS[data]
+    next_step(ch)
+    await send_step(ch, cur_step(ch), mid, edit=True)
+
+@CB.exact("act_custom")
+async def cb_action_custom(ch: int, mid: int, _):
+    await api.set_state(ch, St.user_action, ch)
+    await safe_edit_text(
+        ch, mid,
+        f"{render_for_step(ch, 'user_action')}{framed(numbered_title(ch, 'user_action', 'Укажите нужное действие текстом:'))}",
+        kb(add_back=True, add_home=True)
+    )
 
-        # goal buttons
-        if data.startswith("goal_"):
-            mm = {"goal_sell": "Продавать товары или услуги", "goal_leads": "Собирать заявки",
-                  "goal_info2": "Информировать о товарах или услугах",
-                  "goal_info": "Информировать о деятельности",
-                  "goal_brand": "Повышать узнаваемость бренда"}
-            if data == "goal_custom":
-                bot.set_state(ch, St.biz_goal, ch)  # <-- state только здесь
-                safe_edit_text(
-                    ch, mid,
-                    f"{render_for_step(ch, 'biz_goal')}{framed(numbered_title(ch, 'biz_goal', 'Опишите вашу ключевую задачу текстом:'))}",
-                    kb(add_back=True, add_home=True)
-                )
-            else:
-                USER[ch]["data"]["biz_goal"] = mm[data]
-                next_step(ch)
-                send_step(ch, cur_step(ch), mid, edit=True)
-            return
+# solution + info
+CB_SOLUTIONS = {"sol_land": "Лендинг", "sol_shop": "Интернет-магазин", "sol_corp": "Корпоративный сайт",
+                "sol_bot": "Чат-бот", "sol_mkt": "Маркетинг (SEO/контекст)"}
+
+# таблицы опций мультивыбора для битовых масок в сессии (kp_bot.compact): все варианты
+# опций шага, в т.ч. зависящие от выбранного решения (A1_blocks, timeline)
+register_options({
+    st.key: [k for sol in (None, *CB_SOLUTIONS.values())
+             for k, _ in (st.options({"solution": sol}) if callable(st.options) else st.options)]
+    for st in STEPS if st.multiselect
+})
+
+@CB.exact(*CB_SOLUTIONS)
+async def cb_solution(ch: int, mid: int, data: str):
+    apply_branch_flow(ch, CB_SOLUTIONS[data])
+    next_step(ch)  # перейти на первый шаг ветки
+    await send_step(ch, cur_step(ch), mid, edit=True)
+
+# ==== мультивыбор (компактный "o:NNkey" и старый "opt::step::key") ====
+@CB.op("o", legacy="opt::")
+async def cb_toggle(ch: int, mid: int, step: str, key: str):
+    toggle_select(ch, key)
+    await send_step(ch, step, mid, edit=True)
+
+@CB.op("d", legacy="done::")
+async def cb_done(ch: int, mid: int, step: str, _):
+    if cur_step(ch) != step:
+        return  # повторное нажатие на уже пройденном шаге (апдейты чата идут по порядку — шаг уже сменился)
+    save_multiselect(ch)
+    next_step(ch)
+    await send_step(ch, cur_step(ch), mid, edit=True)
+
+@CB.op("t", legacy="other::")
+async def cb_other(ch: int, mid: int, step: str, _):
+    # кнопка могла остаться от другого шага: его маска к таблице опций этого шага не подходит
+    ensure_multiselect(ch, step, single=step_is_single(step))
+    USER.commit(ch)
+    await api.set_state(ch, St.other_input, ch)
+    await safe_edit_text(
+        ch, mid,
+        f"{render_for_step(ch, step)}{framed(numbered_title(ch, step, 'Напишите ваш вариант текстом:'))}",
+        kb(add_back=True, add_home=True)
+    )
 
-        # user action buttons
-        if data.startswith("act_"):
-            mm = {"act_buy": "Купить", "act_call": "Позвонить", "act_lead": "Оставить заявку", "act_sub": "Подписаться"}
-            if data == "act_custom":
-                bot.set_state(ch, St.user_action, ch)
-                safe_edit_text(
-                    ch, mid,
-                    f"{render_for_step(ch, 'user_action')}{framed(numbered_title(ch, 'user_action', 'Укажите нужное действие текстом:'))}",
-                    kb(add_back=True, add_home=True)
-                )
-            else:
-                USER[ch]["data"]["user_action"] = mm[data]
-                next_step(ch)
-                send_step(ch, cur_step(ch), mid, edit=True)
-            return
+@CB.op("p", legacy="preset::")
+async def cb_preset(ch: int, mid: int, step: str, _):
+    # пресеты
+    if step == "A1_blocks":
+        sol = USER[ch]["solution"]
+        preset = [k for k, _ in (A1_LANDING if sol == "Лендинг" else A1_CORP)][:4]
+    elif step == "B1_sections":
+        preset = ["home", "catalog", "pdp", "cart", "contacts"]
+    elif step == "C1_tasks":
+        preset = ["faq", "consult", "booking"]
+    elif step == "D1_goals":
+        preset = ["leads", "seo"]
+    else:
+        preset = []
+    start_multiselect(ch, step, single=False, seed=preset)
+    await send_step(ch, step, mid, edit=True)
+
+# смена страницы
+@CB.op("g", legacy="page::")
+async def cb_page(ch: int, mid: int, step: str, page_s: str):
+    ensure_multiselect(ch, step, single=step_is_single(step))   # листание со старого шага — его выбор не берём
+    USER[ch].ms_page = max(0, int(page_s))
+    USER.commit(ch)
+    await send_step(ch, step, mid, edit=True)
+
+# pdf: рендер и отправку делает пул KP_JOBS, здесь только подтверждаем
+@CB.exact("go_pdf", "go_kp")
+async def cb_make_kp(ch: int, mid: int, _):
+    if not KP_INFLIGHT.acquire(ch):
+        return  # КП этого чата уже готовится — повторное нажатие второй рендер не запускает
+    try:
+        wait = await api.send_message(ch, "⏳ Готовим ваше коммерческое предложение…")
+        queued = KP_JOBS.submit(deliver_kp, ch, wait.message_id)   # KP_INFLIGHT отпустит deliver_kp
+    except Exception:
+        KP_INFLIGHT.release(ch)
+        raise
+    if not queued:
+        KP_INFLIGHT.release(ch)
+        await safe_edit_text(ch, wait.message_id,
+                             "Сейчас много заявок — нажмите «Создать КП» ещё раз через минуту.")
 
-        # solution + info
-        if data.startswith("sol_"):
-            label = {"sol_land": "Лендинг", "sol_shop": "Интернет-магазин", "sol_corp": "Корпоративный сайт",
-                     "sol_bot": "Чат-бот", "sol_mkt": "Маркетинг (SEO/контекст)"}[data]
-            apply_branch_flow(ch, label)
-            next_step(ch)  # перейти на первый шаг ветки
-            send_step(ch, cur_step(ch), mid, edit=True)
-            return
 
-        # ==== мультивыбор ====
-        if data.startswith("opt::"):
-            _, step, key = data.split("::", 2)
-            toggle_select(ch, key)
-            send_step(ch, step, mid, edit=True)
-            return
+async def _answer_duplicate(callback_id: str):
+    try:
+        await api.answer_callback_query(callback_id)
+    except Exception:
+        pass
 
-        if data.startswith("done::"):
-            _, step = data.split("::", 1)
-            save_multiselect(ch)
-            next_step(ch)
-            send_step(ch, cur_step(ch), mid, edit=True)
-            return
+def accept_update(u) -> bool:
+    """
+    Фильтр при приёме апдейта (runtime.filter_updates), до on_cb и хендлеров
+    сообщений: повтор update_id, повторное нажатие той же кнопки того же
+    сообщения или тот же текст в пределах TAP_TTL — не обрабатываем.
+    """
+    if not UPDATES.accept(u.update_id):
+        return False
+    if accept_tap(u):
+        return True
+    UPDATES.done(u.update_id)      # отброшен — обрабатывать нечего
+    return False
+
+def update_done(u):
+    """Апдейт обработан (runtime: задача чата закончилась) — его update_id может лечь под сохраняемый «пол»."""
+    UPDATES.done(u.update_id)
+
+# повторное нажатие этих кнопок — осознанное действие (снять только что поставленную галочку,
+# листнуть вперёд и обратно, «Назад» два раза — на два шага), а не дубль: их TAP_TTL не отсекает.
+# У «Назад»/«Меню» callback_data одинаковые на всех экранах, а шаг при приёме апдейта ещё старый —
+# по ключу их не различить
+TAP_REPEATABLE = ("o:", "g:", "opt::", "page::", "ui_back", "ui_home")
+
+def accept_tap(u) -> bool:
+    """Часть accept_update без update_id (в режиме шардов update_id проверяет приёмник)."""
+    c = u.callback_query
+    if c is not None and c.message is not None:
+        if (c.data or "").startswith(TAP_REPEATABLE):
+            return True
+        if TAPS.seen((c.message.chat.id, c.message.message_id, c.data)):
+            runtime.call_later(0, _answer_duplicate, c.id)   # «часики» на кнопке всё равно снимаем
+            return False
+        return True
+    m = u.message
+    if m is not None and m.text:
+        return not TAPS.seen((m.chat.id, m.text))
+    return True
+
+
+@handlers.callback(func=lambda c: True)
+async def on_cb(c):
+    ch, mid, data = c.message.chat.id, c.message.message_id, c.data
 
-        if data.startswith("other::"):
-            _, step = data.split("::", 1)
-            multiselect_state(ch)["step"] = step
-            bot.set_state(ch, St.other_input, ch)
-            safe_edit_text(
-                ch, mid,
-                f"{render_for_step(ch, step)}{framed(numbered_title(ch, step, 'Напишите ваш вариант текстом:'))}",
-                kb(add_back=True, add_home=True)
-            )
-            return
+    # 👇 защита: если чата ещё нет в памяти, создаём
+    if ch not in USER:
+        init_user(ch)
 
-        if data.startswith("preset::"):
-            _, step = data.split("::", 1)
-            # пресеты
-            if step == "A1_blocks":
-                sol = USER[ch]["solution"]
-                preset = [k for k, _ in (A1_LANDING if sol == "Лендинг" else A1_CORP)][:4]
-            elif step == "B1_sections":
-                preset = ["home", "catalog", "pdp", "cart", "contacts"]
-            elif step == "C1_tasks":
-                preset = ["faq", "consult", "booking"]
-            elif step == "D1_goals":
-                preset = ["leads", "seo"]
-            else:
-                preset = []
-            start_multiselect(ch, step, single=False, seed=preset)
-            send_step(ch, step, mid, edit=True)
-            return
+    set_last_mid(ch, mid)
 
-        # смена страницы
-        if data.startswith("page::"):
-            _, step, page_s = data.split("::", 2)
-            st = multiselect_state(ch)
-            st["step"] = step
-            st["page"] = max(0, int(page_s))
-            send_step(ch, step, mid, edit=True)
-            return
+    try:
+        await api.answer_callback_query(c.id)
+    except Exception:
+        pass
+    log.info(f"cb:{data} idx={USER[ch].get('idx')} step={cur_step(ch)}")
 
-        # pdf
-        if data in ("go_pdf", "go_kp"):
-            try:
-                path = make_kp_html(ch)
-                with open(path, "rb") as f:
-                    bot.send_document(
-                        ch, f,
-                        visible_file_name=os.path.basename(path),
-                        caption="✅ Ваше коммерческое предложение готово!"
-                    )
-                # 👇 Добавляем сообщение про менеджера
-                mgr_kb = types.InlineKeyboardMarkup()
-                mgr_kb.add(types.InlineKeyboardButton("📞 Связаться с менеджером", url="https://t.me/PlaBarov"))
-                bot.send_message(
-                    ch,
-                    "Если остались вопросы — напишите менеджеру:",
-                    reply_markup=mgr_kb
-                )
-            except Exception as e:
-                log.error(f"make_kp_html failed: {e}")
-                bot.send_message(ch, "Не удалось сформировать файл. Сообщите менеджеру, пожалуйста.")
-            return
+    try:
+        if not await CB.dispatch(ch, mid, data):
+            log.info(f"cb:{data} — нет обработчика")
     except Exception:
         log.exception("callback error")
 
@@ -1683,17 +1884,17 @@ def format_contacts(c: dict | None) -> str:
     if c.get("telegram"): parts.append(f"Telegram {c['telegram']}")
     return "; ".join(parts)
 
-@bot.message_handler(commands=['start'])
-def on_start(m):
+@handlers.message(commands=['start'])
+async def on_start(m):
     init_user(m.chat.id)
-    # ⚠️ Если фото по пути отсутствует — закомментируйте блок ниже
-    try:
-        with open("C:/Users/Maksim/Documents/Платон/chat bot/бот КП/фото.jpg", "rb") as photo:
-            bot.send_photo(m.chat.id, photo)
-    except Exception:
-        pass
-
-    m = bot.send_message(
+    # фото — по file_id из MEDIA; если файла нет и id ещё не получен (или бот перегружен) — просто без фото
+    if not LOAD.skip("photo"):
+        try:
+            await MEDIA.send(api.send_photo, m.chat.id, "welcome", WELCOME_PHOTO)
+        except Exception:
+            pass
+
+    m = await api.send_message(
         m.chat.id,
         "👋 <b>Здравствуйте!  Меня зовут Ева!</b>\n\n"
         "Я помогу Вам создать сайт\n"
@@ -1704,131 +1905,232 @@ def on_start(m):
     set_last_mid(m.chat.id, m.message_id)
 
 
-from threading import Timer
-
-@bot.message_handler(state=St.name)
-@bot.message_handler(state=St.name)
-def in_name(m):
+@handlers.message(state=St.name)
+@handlers.message(state=St.name)
+async def in_name(m):
     ch = m.chat.id
     name = (m.text or "").strip()
     USER[ch]["data"]["name"] = name
-    safe_delete(ch, m.message_id)          # 🗑️ удалить ответ
+    await safe_delete(ch, m.message_id)          # 🗑️ удалить ответ
     next_step(ch)
 
     # показываем краткое приветствие тем же сообщением бота
-    safe_edit_text(ch, get_last_mid(ch), f"Рада нашему знакомству, <b>{h(name)}</b>!")
+    await safe_edit_text(ch, get_last_mid(ch), f"Рада нашему знакомству, <b>{h(name)}</b>!")
 
-    from threading import Timer
-    Timer(2, lambda: send_step(ch, cur_step(ch), mid=get_last_mid(ch), edit=True)).start()
+    # снимается в send_step, если пользователь успел уйти дальше
+    chat_later(2, ch, lambda: send_step(ch, cur_step(ch), mid=get_last_mid(ch), edit=True), key=("step", ch))
 
 
-@bot.message_handler(state=St.org_name)
-def in_org_name(m):
+@handlers.message(state=St.org_name)
+async def in_org_name(m):
     ch = m.chat.id
     t = (m.text or "").strip()
-    safe_delete(ch, m.message_id)          # 🗑️
+    await safe_delete(ch, m.message_id)          # 🗑️
     if len(t) < 2:
         # краткое системное напоминание (исчезнет при следующем редактировании)
-        bot.send_message(ch, "❌ Введите название организации.")
+        await api.send_message(ch, "❌ Введите название организации.")
         return
     USER[ch]["data"]["org_name"] = t
     next_step(ch)
-    send_step(ch, cur_step(ch), mid=get_last_mid(ch), edit=True)
+    await send_step(ch, cur_step(ch), mid=get_last_mid(ch), edit=True)
 
 
-@bot.message_handler(state=St.has_site_comment)
-def in_site_comment(m):
+@handlers.message(state=St.has_site_comment)
+async def in_site_comment(m):
     ch = m.chat.id
     USER[ch]["data"]["has_site_comment"] = (m.text or "").strip()
-    safe_delete(ch, m.message_id)
-
-    # Гарантируем, что в пользовательском потоке есть контакты и подтверждение
-    flow = get_flow(ch)
-    extra = []
-    if "contacts" not in flow:
-        extra.append("contacts")
-    if "confirm" not in flow:
-        extra.append("confirm")
-    if extra:
-        USER[ch]["flow"] = flow + extra
-
-    # Переходим на шаг 'contacts' и показываем экран на месте текущего сообщения бота
-    USER[ch]["idx"] = USER[ch]["flow"].index("contacts")
-    clear_state(ch)
-    send_step(ch, "contacts", mid=get_last_mid(ch), edit=True)
-
-@bot.message_handler(state=St.product)
-def in_product(m):
+    await safe_delete(ch, m.message_id)
+
+    # короткий маршрут → шаг 'contacts', экран на месте текущего сообщения бота
+    fire(ch, "site_comment")
+    await clear_state(ch)
+    await send_step(ch, "contacts", mid=get_last_mid(ch), edit=True)
+
+@handlers.message(state=St.product)
+async def in_product(m):
     ch = m.chat.id
     USER[ch]["data"]["product"] = (m.text or "").strip()
-    safe_delete(ch, m.message_id)          # 🗑️
+    await safe_delete(ch, m.message_id)          # 🗑️
     next_step(ch)
-    send_step(ch, cur_step(ch), mid=get_last_mid(ch), edit=True)
+    await send_step(ch, cur_step(ch), mid=get_last_mid(ch), edit=True)
 
 
-@bot.message_handler(state=St.biz_goal)
-def in_goal(m):
+@handlers.message(state=St.biz_goal)
+async def in_goal(m):
     ch = m.chat.id
     USER[ch]["data"]["biz_goal"] = (m.text or "").strip()
-    safe_delete(ch, m.message_id)          # 🗑️
+    await safe_delete(ch, m.message_id)          # 🗑️
     next_step(ch)
-    send_step(ch, cur_step(ch), mid=get_last_mid(ch), edit=True)
+    await send_step(ch, cur_step(ch), mid=get_last_mid(ch), edit=True)
 
 
-@bot.message_handler(state=St.audience)
-def in_aud(m):
+@handlers.message(state=St.audience)
+async def in_aud(m):
     ch = m.chat.id
     USER[ch]["data"]["audience"] = (m.text or "").strip()
-    safe_delete(ch, m.message_id)          # 🗑️
+    await safe_delete(ch, m.message_id)          # 🗑️
     next_step(ch)
-    send_step(ch, cur_step(ch), mid=get_last_mid(ch), edit=True)
+    await send_step(ch, cur_step(ch), mid=get_last_mid(ch), edit=True)
 
 
-@bot.message_handler(state=St.user_action)
-def in_act(m):
+@handlers.message(state=St.user_action)
+async def in_act(m):
     ch = m.chat.id
     USER[ch]["data"]["user_action"] = (m.text or "").strip()
-    safe_delete(ch, m.message_id)          # 🗑️
+    await safe_delete(ch, m.message_id)          # 🗑️
     next_step(ch)
-    send_step(ch, cur_step(ch), mid=get_last_mid(ch), edit=True)
+    await send_step(ch, cur_step(ch), mid=get_last_mid(ch), edit=True)
 
 
-@bot.message_handler(state=St.other_input)
-def in_other(m):
+@handlers.message(state=St.other_input)
+async def in_other(m):
     ch = m.chat.id
     set_other_value(ch, (m.text or "").strip())
-    safe_delete(ch, m.message_id)          # 🗑️
-    step = USER[ch]["multiselect_ctx"]["step"]
-    send_step(ch, step, mid=get_last_mid(ch), edit=True)
+    await safe_delete(ch, m.message_id)          # 🗑️
+    step = USER[ch].ms_step
+    await send_step(ch, step, mid=get_last_mid(ch), edit=True)
 
-@bot.message_handler(state=St.contacts)
-def in_contacts(m):
+@handlers.message(state=St.contacts)
+async def in_contacts(m):
     ch, txt = m.chat.id, (m.text or "").strip()
     parsed = parse_contacts(txt, m.from_user.username)
-    safe_delete(ch, m.message_id)  # не копим текст пользователя
+    await safe_delete(ch, m.message_id)  # не копим текст пользователя
 
     if not parsed:
-        send_temp(ch, "❌ Введите email, телефон (цифрами) или @username.", ttl=6)
+        await send_temp(ch, "❌ Введите email, телефон (цифрами) или @username.", ttl=6, essential=True)
         return
 
     USER[ch]["data"]["contacts"] = format_contacts(parsed)
-    send_temp(ch, "✅ Контакт добавлен!", ttl=5)
+    await send_temp(ch, "✅ Контакт добавлен!", ttl=5)
     next_step(ch)
-    send_step(ch, cur_step(ch), mid=USER[ch].get("last_mid"), edit=True)
+    await send_step(ch, cur_step(ch), mid=USER[ch].get("last_mid"), edit=True)
 
-@bot.message_handler(func=lambda m: True)
-def fallback(m):
+@handlers.message(func=lambda m: True)
+async def fallback(m):
     ch = m.chat.id
     # удаляем произвольный текст пользователя, чтобы не копился «хвост»
-    safe_delete(ch, m.message_id)
+    await safe_delete(ch, m.message_id)
     if ch not in USER:
-        on_start(m)
+        await on_start(m)
     # иначе — ничего не делаем: активный вопрос редактируется в одном сообщении
 
 # =========================
 # RUN
 # =========================
+def ensure_webhook_secret():
+    """
+    Webhook без secret token принимал бы апдейты от любого, кто узнал URL. Без
+    KP_WEBHOOK_SECRET: если webhook регистрируем мы (KP_WEBHOOK_URL), берём
+    случайный secret на этот запуск — Telegram получит его в set_webhook;
+    если webhook настроен снаружи, его secret нам неизвестен — не стартуем.
+    """
+    global WEBHOOK_SECRET
+    if BOT_INGEST != "webhook" or WEBHOOK_SECRET:
+        return
+    if not WEBHOOK_URL:
+        raise SystemExit("KP_WEBHOOK_SECRET is required for webhook mode when KP_WEBHOOK_URL is not set")
+    WEBHOOK_SECRET = secrets.token_urlsafe(32)
+    log.warning("webhook: KP_WEBHOOK_SECRET is not set, using a random secret token for this run")
+
+async def flush_update_ids():
+    UPDATES.flush()
+    runtime.call_later(1.0, flush_update_ids, key="update_ids")
+
+def start_services():
+    t0 = time.perf_counter()
+    restored = USER.recover()  # недописанные в SQLite изменения из журнала
+    log.info(f"sessions: restored {restored} from journal in {time.perf_counter() - t0:.3f}s")
+    USER.start()
+    if KP_FORMAT == "pdf":
+        PDF.start()  # процессы рендера поднимаем до приёма апдейтов
+    if STATS_SEC > 0:
+        runtime.call_later(STATS_SEC, log_stats, key="stats")
+    if not SHARD:
+        runtime.call_later(1.0, flush_update_ids, key="update_ids")   # у шардов update_id проверяет приёмник
+
+def stop_services():
+    if CHATS:
+        CHATS.close(timeout=10)   # доигрываем уже принятые апдейты
+    log.info(f"kp jobs: {KP_JOBS.stats()}")
+    KP_JOBS.close(timeout=10)
+    KP_STORE.close(timeout=30)   # дописываем отправленные, но ещё не записанные КП
+    PDF.close()
+    USER.close()  # дописываем несброшенные сессии
+    UPDATES.close()
+    KP_SEQ.close()
+    KP_INDEX.close()
+
+def serve_shard(index: int, updates):
+    """Процесс-шард (KP_SHARDS > 1): апдейты своих чатов из очереди ShardSupervisor."""
+    start_services()
+    try:
+        runtime.serve_queue(bot, handlers, updates, chats=CHATS, accept=accept_tap)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_services()
+
+def run_sharded():
+    """Приёмник апдейтов + SHARDS процессов-шардов; повторы update_id отсекаем здесь, до шардов."""
+    USER.recover()  # журнал прежнего запуска одним процессом — в SQLite до старта шардов
+    sup = ShardSupervisor(SHARDS, serve_shard, queue_size=SHARD_QUEUE)
+
+    def route(updates):
+        fresh = [u for u in updates if UPDATES.accept(u["update_id"])]
+        if fresh:
+            sup.route(fresh)
+        for u in fresh:     # для приёмника «обработан» = отдан шарду (или отброшен: очередь шарда полна)
+            UPDATES.done(u["update_id"])
+
+    async def log_shards():
+        log.info(f"shards: {sup.stats()} updates={UPDATES.stats()}")
+        runtime.call_later(STATS_SEC, log_shards, key="stats")
+
+    sup.start()
+    if STATS_SEC > 0:
+        runtime.call_later(STATS_SEC, log_shards, key="stats")
+    runtime.call_later(1.0, flush_update_ids, key="update_ids")
+    try:
+        if BOT_INGEST == "webhook":
+            server = WebhookServer(
+                route, secret=WEBHOOK_SECRET, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                workers=1, queue_size=WEBHOOK_QUEUE, batch=WEBHOOK_BATCH, parse=False,
+            )   # один воркер — пачки уходят в шарды в порядке приёма
+            if WEBHOOK_URL:
+                telebot.apihelper.set_webhook(TOKEN, url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET,
+                                              max_connections=WEBHOOK_WORKERS * 10)
+            server.start()
+            try:
+                threading.Event().wait()
+            finally:
+                server.stop()
+        else:
+            poll_updates(TOKEN, route)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sup.close(timeout=30)
+        log.info(f"shards: {sup.stats()}")
+        UPDATES.close()
+        USER.close()
+
 if __name__ == "__main__":
-    print("Bot is running…")
-    bot.add_custom_filter(telebot.custom_filters.StateFilter(bot))
-    bot.infinity_polling()
+    ensure_webhook_secret()
+    print(f"Bot is running… (mode={BOT_MODE}, shards={max(1, SHARDS)})")
+    if SHARDS > 1:
+        run_sharded()
+    else:
+        start_services()
+        try:
+            if BOT_INGEST == "webhook":
+                server = WebhookServer(
+                    None, secret=WEBHOOK_SECRET, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                    workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE, batch=WEBHOOK_BATCH,
+                )
+                LOAD.add_gauge("webhook_queue", server.queue.qsize, WEBHOOK_QUEUE // 2)
+                runtime.run_webhook(bot, handlers, server, url=WEBHOOK_URL, chats=CHATS, accept=accept_update,
+                                    done=update_done)
+            else:
+                runtime.run_polling(bot, handlers, chats=CHATS, accept=accept_update, done=update_done)
+        finally:
+            stop_services()
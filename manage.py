@@ -5,7 +5,9 @@ from kp_admin import create_app, db
 app = create_app()
 
 # импортируем после create_app, чтобы не схватить циклические импорты
-from kp_admin.routes import rescan_new_files  # noqa: E402  (используем готовую логику сканирования)
+from kp_admin.routes import rescan_new_files, uploads_folder  # noqa: E402  (используем готовую логику сканирования)
+from kp_admin.models import KPFile  # noqa: E402
+from kp_bot.kpfiles import LAYOUTS, migrate_layout  # noqa: E402
 
 
 @app.cli.command("init-db")
@@ -17,8 +19,28 @@ def init_db():
 
 
 @app.cli.command("scan-kp")
-def scan_kp():
+@click.option("--full", is_flag=True, help="Обойти все папки, а не только изменившиеся с прошлого скана.")
+def scan_kp(full):
     """Просканировать папку с КП и добавить новые файлы в БД."""
     with app.app_context():
-        added = rescan_new_files(silent=True)
+        added = rescan_new_files(silent=True, full=full)
         click.echo(f"Импортировано файлов: {added}")
+
+
+@app.cli.command("migrate-kp-layout")
+@click.option("--layout", type=click.Choice(LAYOUTS), default=None,
+              help="Целевая раскладка (по умолчанию — KP_STORAGE_LAYOUT).")
+@click.option("--batch", default=1000, show_default=True, help="Сколько файлов переносить между коммитами БД.")
+def migrate_kp_layout(layout, batch):
+    """Разложить существующие КП по подпапкам и обновить KPFile.filename."""
+    with app.app_context():
+        layout = layout or app.config["KP_STORAGE_LAYOUT"]
+        total = 0
+        for moved in migrate_layout(uploads_folder(), layout, batch=batch):
+            renames = dict(moved)
+            for k in KPFile.query.filter(KPFile.filename.in_(list(renames))):
+                k.filename = renames[k.filename]
+            db.session.commit()
+            total += len(moved)
+            click.echo(f"  перенесено: {total}")
+        click.echo(f"Готово, раскладка {layout}: перенесено файлов {total}")
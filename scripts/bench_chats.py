@@ -0,0 +1,114 @@
+# scripts/bench_chats.py
+"""
+Порядок апдейтов одного чата: общий пул потоков (как TeleBot с num_threads)
+против ChatDispatcher (kp_bot.actors) с тем же числом воркеров.
+
+Каждый чат стоит на мультивыборе A2_functions и присылает пачкой: --toggles
+нажатий разных опций, «Готово» и ещё одно «Готово» (двойной тап). Правильный
+итог — в ответах все выбранные опции и ровно один шаг вперёд. Telegram
+подменён фейковым API с задержкой --latency мс на сетевой вызов.
+
+    python scripts/bench_chats.py --chats 200 --workers 8 --latency 5
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace as NS
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("KP_SESSION_DB", "")
+os.environ.setdefault("KP_SESSION_JOURNAL", "")
+os.environ.setdefault("KP_RATE_GLOBAL", "0")
+os.environ.setdefault("KP_EDIT_WINDOW", "0")
+
+import main  # noqa: E402
+from kp_bot import runtime  # noqa: E402
+from kp_bot.actors import ChatDispatcher  # noqa: E402
+
+STEP = "A2_functions"
+
+
+class FakeApi:
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def __getattr__(self, name):
+        async def call(*args, **kwargs):
+            time.sleep(self.latency)
+            return NS(message_id=1)
+        return call
+
+
+def make_updates(n_chats: int, toggles: int):
+    keys = [k for k, _ in main.A2_FUNCTIONS][:toggles]
+    start = main.FLOW.index("base+A", STEP)
+    out = []
+    for ch in range(1, n_chats + 1):
+        main.init_user(ch)
+        main.USER[ch].update(flow="base+A", idx=start, branch="A", solution="Лендинг")
+        main.start_multiselect(ch, STEP)
+        datas = [main.CB.data("o", STEP, k) for k in keys] + [main.CB.data("d", STEP)] * 2
+        for i, data in enumerate(datas):
+            out.append(NS(id=f"{ch}:{i}", data=data,
+                          message=NS(chat=NS(id=ch), message_id=100 + ch)))
+    # нажатия одного чата идут подряд (быстрые тапы), следом — пачка следующего чата
+    return keys, start, out
+
+
+def check(n_chats: int, keys, start: int):
+    lost = skipped = 0
+    for ch in range(1, n_chats + 1):
+        sess = main.USER[ch]
+        got = sess["data"].get(STEP) or {"items": []}
+        lost += set(got["items"]) != set(keys)
+        skipped += sess["idx"] != start + 1
+    return lost, skipped
+
+
+def run_pool(updates, workers: int) -> float:
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(lambda c: runtime.run_sync(main.on_cb(c)), updates))
+    return time.perf_counter() - t0
+
+
+def run_chats(updates, workers: int, queue: int) -> float:
+    chats = ChatDispatcher(workers, max_per_chat=queue)
+    t0 = time.perf_counter()
+    for c in updates:
+        chats.submit(c.message.chat.id, main.on_cb, c)
+    chats.close(timeout=600)
+    dt = time.perf_counter() - t0
+    print(f"  dispatcher: {chats.stats()}")
+    return dt
+
+
+def main_cli():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--chats", type=int, default=200)
+    ap.add_argument("--toggles", type=int, default=4, help="нажатий опций на чат перед «Готово»")
+    ap.add_argument("--workers", type=int, default=8)
+    ap.add_argument("--latency", type=float, default=5.0, help="мс на вызов Bot API")
+    args = ap.parse_args()
+
+    logging.getLogger("kp-bot-branch").setLevel(logging.WARNING)
+    runtime.MODE = "sync"
+    main.api = FakeApi(args.latency / 1000)
+
+    print(f"chats={args.chats} toggles={args.toggles} workers={args.workers} latency={args.latency:.0f}ms")
+    print(f"{'executor':<18}{'upd/s':>10}{'lost choices':>14}{'wrong step':>12}")
+    for name, run in (("thread pool", lambda u: run_pool(u, args.workers)),
+                      ("ChatDispatcher", lambda u: run_chats(u, args.workers, args.toggles + 2))):
+        keys, start, updates = make_updates(args.chats, args.toggles)
+        dt = run(updates)
+        lost, skipped = check(args.chats, keys, start)
+        print(f"{name:<18}{len(updates) / dt:>10.0f}{lost:>14}{skipped:>12}")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,98 @@
+# scripts/bench_kp_delivery.py
+"""
+Время до документа у клиента: прежний путь (рендер → запись файла → open(path)
+→ send_document) против нового (рендер в память → send_document из буфера,
+запись на диск — в фоне, KP_STORE).
+
+Диск можно «замедлить» (--disk-ms: задержка на каждую запись файла КП),
+загрузку в Telegram — тоже (--upload-ms). Формат — HTML (KP_FORMAT по умолчанию).
+
+    python scripts/bench_kp_delivery.py --runs 50 --disk-ms 20
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace as NS
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("KP_SESSION_DB", "")
+os.environ.setdefault("KP_SESSION_JOURNAL", "")
+os.environ.setdefault("KP_SEQ_DB", "")
+os.environ.setdefault("KP_RATE_GLOBAL", "0")
+os.environ.setdefault("KP_DEDUP", "0")          # каждый прогон — новый рендер и новый файл
+
+import main  # noqa: E402
+from kp_bot import kpfiles, runtime  # noqa: E402
+
+
+class FakeApi:
+    def __init__(self, upload_ms: float):
+        self.upload = upload_ms / 1000
+        self.sent_at = []
+
+    async def send_document(self, ch, doc, visible_file_name=None, caption=None):
+        doc.read()
+        time.sleep(self.upload)
+        self.sent_at.append(time.perf_counter())
+        return NS(document=NS(file_id=None))
+
+    async def send_message(self, *a, **k):
+        return NS(message_id=1)
+
+    async def delete_message(self, *a, **k):
+        pass
+
+
+async def legacy_deliver(ch: int):
+    """Прежний _deliver_kp (без дедупликации): файл на диск, затем загрузка из файла."""
+    path = main.make_kp_file(ch)
+    with open(path, "rb") as f:
+        await main.api.send_document(ch, f, visible_file_name=os.path.basename(path), caption="")
+
+
+def run(fn, runs: int, api: FakeApi) -> list:
+    out = []
+    for i in range(runs):
+        ch = 500 + i
+        main.init_user(ch)
+        main.USER[ch]["data"].update(name="Иван", contacts=f"+7 999 000-00-{i % 100:02d}")
+        main.USER[ch]["solution"] = "Лендинг"
+        t0 = time.perf_counter()
+        runtime.run_sync(fn(ch))
+        out.append((api.sent_at[-1] - t0) * 1000)
+    return sorted(out)
+
+
+def main_cli():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--runs", type=int, default=50)
+    ap.add_argument("--disk-ms", type=float, default=0.0, help="задержка записи файла КП, мс")
+    ap.add_argument("--upload-ms", type=float, default=0.0, help="задержка send_document, мс")
+    args = ap.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix="kp_bench_"))      # generated_kp — во временной папке
+    save = kpfiles.KpDocument.save
+
+    def slow_save(doc, alloc):
+        time.sleep(args.disk_ms / 1000)
+        return save(doc, alloc)
+    kpfiles.KpDocument.save = slow_save
+
+    api = main.api = FakeApi(args.upload_ms)
+    print(f"runs={args.runs} disk={args.disk_ms}ms upload={args.upload_ms}ms  (time to document, ms)")
+    print(f"{'path':<22}{'p50':>8}{'p95':>8}")
+    for name, fn in (("file, then upload", legacy_deliver),
+                     ("buffer + async store", lambda ch: main.deliver_kp(ch))):
+        t = run(fn, args.runs, api)
+        print(f"{name:<22}{t[len(t) // 2]:>8.2f}{t[int(len(t) * .95)]:>8.2f}")
+    main.KP_STORE.close(timeout=60)
+    print(f"stored in background: {main.KP_STORE.stats()['done']} files, "
+          f"on disk: {sum(len(f) for _, _, f in os.walk('generated_kp'))}")
+
+
+if __name__ == "__main__":
+    main_cli()
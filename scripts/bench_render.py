@@ -0,0 +1,76 @@
+# scripts/bench_render.py
+"""
+Рендеров КП в секунду: прекомпилированный KP_TPL против Template(KP_TEMPLATE) на каждый вызов
+(как было раньше). Контексты — типичные анкеты веток A/B/C/D, собранные build_kp_context.
+
+    python scripts/bench_render.py --seconds 1
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("KP_SESSION_DB", "")
+os.environ.setdefault("KP_SESSION_JOURNAL", "")
+
+from jinja2 import Template  # noqa: E402
+
+import main  # noqa: E402
+
+
+def _ms(options, n=3, other=None):
+    return {"items": [k for k, _ in options[:n]], "other": other}
+
+
+COMMON = {
+    "name": "Иван", "org_name": "ООО «Ромашка» & Co", "org_category": "Юр. лицо",
+    "biz_goal": "Заявки с сайта", "audience": "B2B, 25–45", "has_site": "Нет",
+    "contacts": "+7 999 123-45-67, ivan@example.com",
+    "design": _ms(main.DESIGN, 1), "content": _ms(main.CONTENT, 1), "timeline": {"items": ["2-4w"], "other": None},
+}
+BRANCHES = {
+    "A": ("Лендинг", {"A1_blocks": _ms(main.A1_LANDING, 5, "Калькулятор"), "A2_functions": _ms(main.A2_FUNCTIONS, 4)}),
+    "B": ("Интернет-магазин", {"B1_sections": _ms(main.B1_SECTIONS, 6), "B2_assort": _ms(main.B2_ASSORT, 1),
+                               "B3_functions": _ms(main.B3_FUNCTIONS, 4, "1С")}),
+    "C": ("Чат-бот", {"C1_tasks": _ms(main.C1_TASKS, 4), "C2_platforms": _ms(main.C2_PLATFORMS, 2),
+                      "C3_integrations": _ms(main.C3_INTEGR, 3)}),
+    "D": ("Маркетинг (SEO/контекст)", {"D1_goals": _ms(main.D1_GOALS, 3), "D2_channels": _ms(main.D2_CHANNELS, 4),
+                                       "D4_budget": _ms(main.D4_BUDGET, 1)}),
+}
+
+
+def context_for(branch: str, ch: int) -> dict:
+    solution, data = BRANCHES[branch]
+    main.init_user(ch)
+    main.USER[ch]["solution"] = solution
+    main.USER[ch]["data"].update(COMMON, **data)
+    return main.build_kp_context(ch)
+
+
+def rate(fn, seconds: float) -> float:
+    n, t0 = 0, time.perf_counter()
+    while time.perf_counter() - t0 < seconds:
+        fn()
+        n += 1
+    return n / (time.perf_counter() - t0)
+
+
+def main_cli():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--seconds", type=float, default=1.0, help="сколько крутить каждый замер")
+    args = ap.parse_args()
+
+    print(f"{'branch':<8}{'precompiled/s':>15}{'Template()/s':>15}{'speedup':>9}{'html KB':>9}")
+    for i, branch in enumerate(BRANCHES, start=1):
+        ctx = context_for(branch, i)
+        fast = rate(lambda: main.KP_TPL.render(**ctx), args.seconds)
+        slow = rate(lambda: Template(main.KP_TEMPLATE, autoescape=True).render(**ctx), args.seconds)
+        size = len(main.KP_TPL.render(**ctx).encode()) / 1024
+        print(f"{branch:<8}{fast:>15.0f}{slow:>15.0f}{fast / slow:>8.1f}x{size:>9.1f}")
+
+
+if __name__ == "__main__":
+    main_cli()
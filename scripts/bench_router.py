@@ -0,0 +1,131 @@
+# scripts/bench_router.py
+"""
+Стоимость выбора обработчика callback_data: таблица CB (kp_bot.router) против
+прежней цепочки if/elif из on_cb (воспроизведена ниже в том же порядке проверок).
+
+Словарь — все кнопки бота: меню, категории, цели, действия, решения и действия
+мультивыбора для каждой опции каждого шага — в новом компактном и старом формате.
+
+    python scripts/bench_router.py --seconds 1
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("KP_SESSION_DB", "")
+os.environ.setdefault("KP_SESSION_JOURNAL", "")
+
+import main  # noqa: E402
+
+STEP_OPTIONS = {
+    "A1_blocks": main.A1_LANDING + main.A1_CORP, "A2_functions": main.A2_FUNCTIONS,
+    "B1_sections": main.B1_SECTIONS, "B2_assort": main.B2_ASSORT, "B3_functions": main.B3_FUNCTIONS,
+    "C1_tasks": main.C1_TASKS, "C2_platforms": main.C2_PLATFORMS, "C3_integrations": main.C3_INTEGR,
+    "D1_goals": main.D1_GOALS, "D2_channels": main.D2_CHANNELS, "D4_budget": main.D4_BUDGET,
+    "design": main.DESIGN, "content": main.CONTENT,
+    "timeline": [("asap", ""), ("2-4w", ""), ("1-2m", ""), ("flex", "")],
+}
+
+
+def vocabulary():
+    """(новый, старый) callback_data для каждой кнопки."""
+    out = [(k, k) for k in ("act_start", "act_about", "ui_home", "ui_back", "yn_yes", "yn_no",
+                            "goal_custom", "act_custom", "go_pdf")]
+    for table in (main.CB_CATEGORIES, main.CB_GOALS, main.CB_ACTIONS, main.CB_SOLUTIONS):
+        out += [(k, k) for k in table]
+    for step, opts in STEP_OPTIONS.items():
+        out += [(main.CB.data("o", step, k), f"opt::{step}::{k}") for k, _ in opts]
+        out += [(main.CB.data("g", step, "1"), f"page::{step}::1"),
+                (main.CB.data("d", step), f"done::{step}"),
+                (main.CB.data("t", step), f"other::{step}"),
+                (main.CB.data("p", step), f"preset::{step}")]
+    return out
+
+
+def legacy_route(data: str) -> str:
+    """Порядок проверок старого on_cb (без тел веток): какая ветка сработала бы."""
+    if data == "ui_back":
+        return "back"
+    if data == "act_start":
+        return "start"
+    if data == "act_about":
+        return "about"
+    if data == "ui_home":
+        return "home"
+    if data == "ui_back":
+        return "back"
+    if data.startswith("cat_"):
+        return "cat"
+    if data in ("yn_yes", "yn_no"):
+        return "yn"
+    if data.startswith("goal_"):
+        return "goal"
+    if data.startswith("act_"):
+        return "act"
+    if data.startswith("sol_"):
+        return "sol"
+    if data.startswith("opt::"):
+        _, step, key = data.split("::", 2)
+        return "opt"
+    if data.startswith("done::"):
+        _, step = data.split("::", 1)
+        return "done"
+    if data.startswith("other::"):
+        _, step = data.split("::", 1)
+        return "other"
+    if data.startswith("preset::"):
+        _, step = data.split("::", 1)
+        return "preset"
+    if data.startswith("page::"):
+        _, step, page_s = data.split("::", 2)
+        return "page"
+    if data in ("go_pdf", "go_kp"):
+        return "pdf"
+    return ""
+
+
+def router_route(data: str):
+    """resolve + разбор шага/аргумента, как делают обёртки router.op."""
+    fn, rest = main.CB.resolve(data)
+    if data[1:2] == ":":
+        main.CB.codec.decode_rest(rest)
+    return fn
+
+
+def per_call_ns(fn, items, seconds: float) -> float:
+    n, t0 = 0, time.perf_counter()
+    while time.perf_counter() - t0 < seconds:
+        for d in items:
+            fn(d)
+        n += len(items)
+    return (time.perf_counter() - t0) / n * 1e9
+
+
+def main_():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--seconds", type=float, default=1.0)
+    args = ap.parse_args()
+
+    vocab = vocabulary()
+    new, old = [n for n, _ in vocab], [o for _, o in vocab]
+    missing = [d for d in new + old if main.CB.resolve(d)[0] is None]
+    assert not missing, f"unrouted callbacks: {missing[:5]}"
+
+    print(f"vocabulary: {len(vocab)} buttons, {main.CB.stats()['exact']} exact keys, "
+          f"{main.CB.stats()['prefixes']} prefixes")
+    print(f"callback_data bytes, avg: compact {sum(map(len, new)) / len(new):.1f}, "
+          f"old {sum(map(len, old)) / len(old):.1f}")
+    t_legacy = per_call_ns(legacy_route, old, args.seconds)
+    t_router_old = per_call_ns(router_route, old, args.seconds)
+    t_router_new = per_call_ns(router_route, new, args.seconds)
+    print(f"if/elif chain (old data):   {t_legacy:7.0f} ns/dispatch")
+    print(f"router (old data, legacy):  {t_router_old:7.0f} ns/dispatch")
+    print(f"router (compact data):      {t_router_new:7.0f} ns/dispatch")
+
+
+if __name__ == "__main__":
+    main_()
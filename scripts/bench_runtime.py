@@ -0,0 +1,121 @@
+# scripts/bench_runtime.py
+"""
+Апдейтов в секунду: sync-режим (пул потоков, как TeleBot) против async (один event loop).
+
+Telegram подменён фейковым API с задержкой --latency мс на каждый сетевой вызов;
+апдейты — нажатия опций мультивыбора (кнопки opt) от --chats разных чатов,
+то есть answer_callback_query + edit_message_text на каждый апдейт.
+
+    python scripts/bench_runtime.py --updates 3000 --chats 1000 --latency 30 --threads 2
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+# сессии только в памяти, без журнала — меряем рантайм, а не диск
+os.environ.setdefault("KP_SESSION_DB", "")
+os.environ.setdefault("KP_SESSION_JOURNAL", "")
+
+import main  # noqa: E402
+from kp_bot import runtime  # noqa: E402
+from kp_bot.states import SessionStateStorage  # noqa: E402
+
+
+class FakeApi:
+    """Имитация Bot API: сетевые методы «спят» latency секунд."""
+
+    def __init__(self, latency: float, mode: str):
+        self.latency = latency
+        self.mode = mode
+        self.calls = 0
+        self.states = SessionStateStorage(main.USER)
+
+    # FSM-состояния — локальные операции, без задержки
+    async def set_state(self, user_id, state, chat_id=None):
+        return self.states.set_state(chat_id or user_id, user_id, state)
+
+    async def get_state(self, user_id, chat_id=None):
+        return self.states.get_state(chat_id or user_id, user_id)
+
+    async def delete_state(self, user_id, chat_id=None):
+        return self.states.delete_state(chat_id or user_id, user_id)
+
+    def __getattr__(self, name):
+        async def call(*args, **kwargs):
+            self.calls += 1
+            if self.mode == "async":
+                await asyncio.sleep(self.latency)
+            else:
+                time.sleep(self.latency)
+            return SimpleNamespace(message_id=1)
+        return call
+
+
+def make_updates(n_updates: int, n_chats: int):
+    for ch in range(1, n_chats + 1):
+        main.init_user(ch)
+        main.USER[ch]["flow"] = "base+A"
+        main.USER[ch]["idx"] = main.FLOW.index("base+A", "A2_functions")
+    keys = [k for k, _ in main.A2_FUNCTIONS]
+    out = []
+    for i in range(n_updates):
+        ch = 1 + i % n_chats
+        out.append(SimpleNamespace(
+            id=str(i), data=main.CB.data("o", "A2_functions", keys[i % len(keys)]),
+            message=SimpleNamespace(chat=SimpleNamespace(id=ch), message_id=100 + ch),
+        ))
+    return out
+
+
+def bench_sync(updates, latency: float, threads: int) -> float:
+    runtime.MODE = "sync"
+    main.api = FakeApi(latency, "sync")
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(lambda c: runtime.run_sync(main.on_cb(c)), updates))
+    return time.perf_counter() - t0
+
+
+def bench_async(updates, latency: float) -> float:
+    runtime.MODE = "async"
+    main.api = FakeApi(latency, "async")
+
+    async def go():
+        await asyncio.gather(*(main.on_cb(c) for c in updates))
+
+    t0 = time.perf_counter()
+    asyncio.run(go())
+    return time.perf_counter() - t0
+
+
+def main_cli():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--updates", type=int, default=2000)
+    ap.add_argument("--chats", type=int, default=500)
+    ap.add_argument("--latency", type=float, default=30.0, help="мс на вызов Bot API")
+    ap.add_argument("--threads", type=int, default=2, help="воркеры sync-режима (у TeleBot по умолчанию 2)")
+    args = ap.parse_args()
+    lat = args.latency / 1000.0
+
+    import logging
+    logging.getLogger("kp-bot-branch").setLevel(logging.WARNING)
+
+    sync_updates = make_updates(args.updates, args.chats)
+    dt_sync = bench_sync(sync_updates, lat, args.threads)
+    async_updates = make_updates(args.updates, args.chats)
+    dt_async = bench_async(async_updates, lat)
+
+    print(f"updates={args.updates} chats={args.chats} latency={args.latency:.0f}ms")
+    print(f"sync  (threads={args.threads}): {args.updates / dt_sync:10.1f} upd/s  ({dt_sync:.2f}s)")
+    print(f"async (1 loop)   : {args.updates / dt_async:10.1f} upd/s  ({dt_async:.2f}s)")
+
+
+if __name__ == "__main__":
+    main_cli()
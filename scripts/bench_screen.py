@@ -0,0 +1,120 @@
+# scripts/bench_screen.py
+"""
+Стоимость одного экрана шага — то, что считается на каждом показе/правке:
+прогресс (progress_for_step), номер шага (step_no), сборка экрана (render_step)
+и отпечаток экрана (screen_fingerprint).
+
+progress_for_step сравнивается с прежней реализацией (воспроизведена ниже):
+max()/len()/.index() на каждый вызов против таблицы PROGRESS. Перед замером
+проверяется, что обе дают одинаковый результат для всех маршрутов, веток и шагов.
+
+    python scripts/bench_screen.py --seconds 1
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("KP_SESSION_DB", "")
+os.environ.setdefault("KP_SESSION_JOURNAL", "")
+
+import main  # noqa: E402
+from kp_bot.edits import screen_fingerprint  # noqa: E402
+
+
+def legacy_progress_for_step(ch: int, step_key: str):
+    """progress_for_step до таблиц прогресса."""
+    USER, BASE_FLOW, BRANCH_FLOW, COMMON_FLOW = main.USER, main.BASE_FLOW, main.BRANCH_FLOW, main.COMMON_FLOW
+    base_len = len(BASE_FLOW)
+    b_max = max(len(v) for v in BRANCH_FLOW.values())
+    total = base_len + b_max + len(COMMON_FLOW)
+
+    branch = USER.get(ch, {}).get("branch")
+    if not branch:
+        if step_key in BASE_FLOW:
+            idx_in_base = BASE_FLOW.index(step_key) + 1
+        else:
+            idx_in_base = min(base_len, USER.get(ch, {}).get("idx", 0) + 1)
+        return idx_in_base, total
+
+    if step_key in BASE_FLOW:
+        return BASE_FLOW.index(step_key) + 1, total
+
+    if step_key in BRANCH_FLOW[branch]:
+        i = BRANCH_FLOW[branch].index(step_key) + 1
+        sel_len = len(BRANCH_FLOW[branch])
+        if sel_len <= 1:
+            scaled = 1
+        else:
+            scaled = 1 + round((i - 1) * (b_max - 1) / (sel_len - 1))
+        return base_len + scaled, total
+
+    if step_key in COMMON_FLOW:
+        i = COMMON_FLOW.index(step_key) + 1
+        return base_len + b_max + i, total
+
+    flow = main.get_flow(ch)
+    return min(len(flow), flow.index(step_key) + 1 if step_key in flow else USER[ch]['idx'] + 1), total
+
+
+def positions():
+    """(chat, шаг) для каждого шага каждого маршрута — сессия стоит на этом шаге."""
+    out = []
+    ch = 1
+    for branch in (None, *main.BRANCH_FLOW):
+        for flow, seq in main.FLOW.flows.items():
+            for idx, key in enumerate(seq):
+                main.init_user(ch)
+                main.USER[ch].update(flow=flow, idx=idx, branch=branch)
+                out.append((ch, key))
+                ch += 1
+    return out
+
+
+def check(cases) -> int:
+    bad = 0
+    for ch, key in cases:
+        for probe in (key, *main.STEP_ORDER):       # и «чужие» шаги — ветка фолбэка
+            if main.progress_for_step(ch, probe) != legacy_progress_for_step(ch, probe):
+                bad += 1
+    return bad
+
+
+def rate(fn, cases, seconds: float) -> float:
+    n, t0 = 0, time.perf_counter()
+    while time.perf_counter() - t0 < seconds:
+        for ch, key in cases:
+            fn(ch, key)
+        n += len(cases)
+    return n / (time.perf_counter() - t0)
+
+
+def main_cli():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--seconds", type=float, default=1.0, help="сколько крутить каждый замер")
+    args = ap.parse_args()
+
+    cases = positions()
+    bad = check(cases)
+    print(f"positions: {len(cases)}  mismatches vs legacy: {bad}")
+
+    steps = main.FLOW.steps
+    screens = {(ch, key): main.render_step(ch, steps[key]) for ch, key in cases}
+    rows = [
+        ("progress_for_step (table)", main.progress_for_step),
+        ("progress_for_step (legacy)", legacy_progress_for_step),
+        ("step_no", main.step_no),
+        ("render_step", lambda ch, key: main.render_step(ch, steps[key])),
+        ("screen_fingerprint", lambda ch, key: screen_fingerprint(*screens[(ch, key)])),
+    ]
+    print(f"{'per render':<28}{'calls/s':>12}{'us/call':>9}")
+    for name, fn in rows:
+        r = rate(fn, cases, args.seconds)
+        print(f"{name:<28}{r:>12.0f}{1e6 / r:>9.2f}")
+
+
+if __name__ == "__main__":
+    main_cli()
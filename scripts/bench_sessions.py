@@ -0,0 +1,116 @@
+# scripts/bench_sessions.py
+"""
+Память на сессию: прежний dict (копия списка маршрута, dict ответов,
+multiselect_ctx с set) против ChatSession (kp_bot.compact).
+
+Синтетические сессии — как их видит SessionCache после загрузки из SQLite
+(decode_session): доля только нажавших /start, застрявших посреди анкеты и
+дошедших до подтверждения задаётся ключами. Память — tracemalloc, прирост
+после построения всех сессий, в байтах на сессию.
+
+    python scripts/bench_sessions.py --sessions 100000
+"""
+import argparse
+import gc
+import os
+import random
+import sys
+import tracemalloc
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("KP_SESSION_DB", "")
+os.environ.setdefault("KP_SESSION_JOURNAL", "")
+
+import main  # noqa: E402
+from kp_bot.compact import FLOW_NAMES, ChatSession  # noqa: E402
+from kp_bot.sessions import decode_session, encode_session  # noqa: E402
+
+SOLUTIONS = {"A": "Лендинг", "B": "Интернет-магазин", "C": "Чат-бот", "D": "Маркетинг (SEO/контекст)"}
+
+
+def legacy_session(rnd: random.Random, kind: str) -> dict:
+    """Сессия в прежнем формате (как init_user до компактных сессий)."""
+    s = {"idx": 0, "flow": list(main.BASE_ORDER), "data": {}, "branch": None, "solution": None,
+         "multiselect_ctx": {}, "last_mid": rnd.randint(10, 10 ** 6), "screen": None, "state": None}
+    if kind == "start":
+        return s
+    b = rnd.choice("ABCD")
+    flow = main.FLOWS[f"nosite+{b}"]
+    s.update(flow=list(flow), branch=b, solution=SOLUTIONS[b])
+    d = s["data"]
+    d.update(name=f"Имя{rnd.randint(1, 9999)}", org_name=f"ООО «Ромашка {rnd.randint(1, 999)}»",
+             biz_goal="Увеличить заявки", user_action="Оставить заявку", product="Услуги")
+    steps = main.BRANCH_FLOW[b] + (["design", "content", "timeline"] if kind == "done" else [])
+    for step in steps:
+        opts = main.FLOW.steps[step].options
+        opts = opts(s) if callable(opts) else opts
+        keys = dict.fromkeys(k for k, _ in opts)            # в таблицах бывают повторы ключей
+        d[step] = {"items": rnd.sample(list(keys), min(len(keys), rnd.randint(1, 4))),
+                   "other": "свой вариант" if rnd.random() < 0.2 else None}
+    last = steps[-1]
+    s["multiselect_ctx"] = {"step": last, "selected": set(d[last]["items"]), "single": False,
+                            "preset": [], "page": 0}
+    if kind == "done":
+        d["contacts"] = f"+7 999 {rnd.randint(100, 999)}-{rnd.randint(10, 99)}-{rnd.randint(10, 99)}"
+    s["idx"] = flow.index("confirm" if kind == "done" else last)
+    s["screen"] = [s["last_mid"], "0123456789abcdef"]
+    return s
+
+
+def measure(build, raws) -> float:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objs = [build(r) for r in raws]
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del objs
+    return used / len(raws)
+
+
+def main_cli():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sessions", type=int, default=100_000)
+    ap.add_argument("--start", type=float, default=0.5, help="доля сессий «только /start»")
+    ap.add_argument("--done", type=float, default=0.2, help="доля дошедших до подтверждения")
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    rnd = random.Random(args.seed)
+    kinds = []
+    for _ in range(args.sessions):
+        x = rnd.random()
+        kinds.append("start" if x < args.start else "done" if x < args.start + args.done else "mid")
+    raws = [encode_session(legacy_session(rnd, k)) for k in kinds]
+
+    # сессии должны пережить преобразование без потерь (порядок выбранных — по таблице опций,
+    # список шагов маршрута — его имя)
+    def norm(d):
+        if isinstance(d["flow"], list):
+            d["flow"] = FLOW_NAMES.get(tuple(d["flow"]), d["flow"])
+        d["data"] = {k: (sorted(v["items"]), v["other"]) if isinstance(v, dict) else v for k, v in d["data"].items()}
+        ctx = d.pop("multiselect_ctx") or {}
+        d.pop("state_data", None)
+        return d, ctx.get("step"), sorted(ctx.get("selected") or ())
+    lost = sum(norm(decode_session(r)) != norm(decode_session(encode_session(ChatSession.load(decode_session(r)))))
+               for r in raws[:2000])
+
+    print(f"sessions: {args.sessions}  (start {args.start:.0%}, done {args.done:.0%})  round-trip mismatches: {lost}")
+    print(f"{'representation':<16}{'bytes/session':>15}{'MB total':>10}")
+    rows = [("dict", decode_session),
+            ("ChatSession", lambda r: ChatSession.load(decode_session(r)))]
+    for name, build in rows:
+        per = measure(build, raws)
+        print(f"{name:<16}{per:>15.0f}{per * args.sessions / 2 ** 20:>10.1f}")
+    for kind in ("start", "mid", "done"):
+        sub = [r for r, k in zip(raws, kinds) if k == kind]
+        if sub:
+            a, b = measure(decode_session, sub), measure(rows[1][1], sub)
+            print(f"  {kind:<14}{a:>8.0f} -> {b:.0f} bytes")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,162 @@
+# scripts/bench_shards.py
+"""
+Шарды (kp_bot.shards): распределение чатов и пропускная способность.
+
+1) HashRing: равномерность (самый загруженный шард / средний) и сколько чатов
+   переезжает при N -> N+1 шардах — против chat_id % N.
+2) Апдейтов в секунду при 1..--max-shards процессах: нажатия опций
+   мультивыбора (сборка экрана и клавиатуры — чистый CPU, Telegram подменён
+   API без задержки). Время — от раздачи апдейтов до конца обработки во всех
+   шардах; запуск процессов в замер не входит. Рост с числом шардов
+   ограничен числом ядер машины (печатается в заголовке).
+3) Перезапуск после kill -9: простаивающий шард убивается, пока ждёт апдейтов
+   (держит блокировку чтения своей очереди); новый процесс должен обработать
+   все апдейты, отправленные его чатам после убийства.
+
+    python scripts/bench_shards.py --updates 20000 --chats 2000 --max-shards 4
+"""
+import argparse
+import functools
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import time
+from types import SimpleNamespace as NS
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("KP_SESSION_DB", "")
+os.environ.setdefault("KP_SESSION_JOURNAL", "")
+os.environ.setdefault("KP_RATE_GLOBAL", "0")
+os.environ.setdefault("KP_EDIT_WINDOW", "0")
+os.environ.setdefault("KP_TAP_TTL", "0")
+os.environ.setdefault("KP_UPDATE_IDS", "")
+os.environ.setdefault("KP_STATS_SEC", "0")
+
+from kp_bot.shards import HashRing, ShardSupervisor, chat_of  # noqa: E402
+
+STEP = "A2_functions"
+
+
+class FakeApi:
+    def __getattr__(self, name):
+        async def call(*args, **kwargs):
+            return NS(message_id=1)
+        return call
+
+
+def bench_shard(report, n_chats: int, index: int, updates):
+    """Процесс-шард: сессии всех чатов на шаге STEP, хендлеры бота, API без сети."""
+    import logging
+    import main
+    from kp_bot import runtime
+    logging.getLogger("kp-bot-branch").setLevel(logging.WARNING)
+    main.api = FakeApi()
+    start = main.FLOW.index("base+A", STEP)
+    for ch in range(1, n_chats + 1):
+        main.init_user(ch)
+        main.USER[ch].update(flow="base+A", idx=start, branch="A", solution="Лендинг")
+        main.start_multiselect(ch, STEP)
+    report.put(("ready", index))
+    runtime.serve_queue(main.bot, main.handlers, updates, chats=main.CHATS)
+    if main.CHATS:
+        main.CHATS.close(timeout=600)
+    report.put(("done", index, main.CHATS.stats()["done"] if main.CHATS else None))
+
+
+def make_updates(n_updates: int, n_chats: int):
+    import main
+    keys = [k for k, _ in main.A2_FUNCTIONS]
+    out = []
+    for i in range(n_updates):
+        ch = 1 + i % n_chats
+        out.append({"update_id": i + 1, "callback_query": {
+            "id": str(i), "chat_instance": "x", "data": main.CB.data("o", STEP, keys[i % len(keys)]),
+            "from": {"id": ch, "is_bot": False, "first_name": "u"},
+            "message": {"message_id": 100, "date": 0, "chat": {"id": ch, "type": "private"}, "text": "-"}}})
+    return out
+
+
+def ring_report(max_shards: int, n_keys: int = 100_000):
+    keys = range(10 ** 6, 10 ** 6 + n_keys)
+    print(f"{'shards':<8}{'max/avg load':>14}{'moved ->N+1 (ring)':>20}{'moved (mod N)':>15}")
+    for n in range(1, max_shards + 1):
+        a, b = HashRing(n), HashRing(n + 1)
+        owners = [a.shard(k) for k in keys]
+        load = [owners.count(i) for i in range(n)]
+        moved = sum(x != b.shard(k) for x, k in zip(owners, keys)) / n_keys
+        moved_mod = sum(k % n != k % (n + 1) for k in keys) / n_keys
+        print(f"{n:<8}{max(load) / (n_keys / n):>14.2f}{moved:>20.1%}{moved_mod:>15.1%}")
+
+
+def run(n_shards: int, updates, n_chats: int) -> float:
+    ctx = multiprocessing.get_context("spawn")
+    report = ctx.Queue()
+    sup = ShardSupervisor(n_shards, functools.partial(bench_shard, report, n_chats),
+                          queue_size=len(updates) + 1)
+    sup.start()
+    for _ in range(n_shards):
+        report.get(timeout=300)
+    t0 = time.perf_counter()
+    for i in range(0, len(updates), 100):       # пачками, как из getUpdates
+        sup.route(updates[i:i + 100])
+    sup.close(timeout=600)
+    for _ in range(n_shards):
+        report.get(timeout=600)
+    return time.perf_counter() - t0
+
+
+def restart_check(n_chats: int) -> bool:
+    ctx = multiprocessing.get_context("spawn")
+    report = ctx.Queue()
+    sup = ShardSupervisor(2, functools.partial(bench_shard, report, n_chats))
+    sup.start()
+    for _ in range(2):
+        report.get(timeout=300)
+    time.sleep(1.0)                                 # оба шарда стоят в get() своей очереди
+    victim = sup.stats()["pids"][0]
+    os.kill(victim, signal.SIGKILL)
+    t0 = time.perf_counter()
+    ready = report.get(timeout=300)                 # новый процесс шарда 0 поднялся
+    updates = [u for u in make_updates(n_chats * 2, n_chats) if sup.ring.shard(chat_of(u)) == 0]
+    sup.route(updates)
+    sup.close(timeout=120)
+    done = {}
+    try:
+        for _ in range(2):
+            msg = report.get(timeout=120)
+            done[msg[1]] = msg[2]
+    except queue.Empty:
+        pass
+    st = sup.stats()
+    ok = ready == ("ready", 0) and done.get(0) == len(updates) and st["restarts"] == [1, 0]
+    print(f"kill -9 pid={victim}: {'ok' if ok else 'FAILED'} in {time.perf_counter() - t0:.1f}s, "
+          f"processed {done.get(0)}/{len(updates)}, restarts={st['restarts']} stranded={st['stranded']}")
+    return ok
+
+
+def main_cli():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--updates", type=int, default=20000)
+    ap.add_argument("--chats", type=int, default=2000)
+    ap.add_argument("--max-shards", type=int, default=4)
+    args = ap.parse_args()
+
+    ring_report(args.max_shards)
+    print()
+    restart_check(min(args.chats, 200))
+    updates = make_updates(args.updates, args.chats)
+    print(f"\nupdates={args.updates} chats={args.chats} cpus={os.cpu_count()}")
+    print(f"{'shards':<8}{'upd/s':>10}{'speedup':>9}")
+    base = None
+    for n in sorted({1, 2, args.max_shards} | set(range(2, args.max_shards + 1, 2))):
+        dt = run(n, updates, args.chats)
+        base = base or dt
+        print(f"{n:<8}{args.updates / dt:>10.0f}{base / dt:>9.2f}")
+
+
+if __name__ == "__main__":
+    main_cli()
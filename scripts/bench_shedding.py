@@ -0,0 +1,120 @@
+# scripts/bench_shedding.py
+"""
+Перегрузка: всплеск /start и ввода контактов при ограниченной пропускной
+способности Bot API — со сбросом косметики (LoadShedder) и без него.
+
+Фейковый API пропускает не больше --api-rate вызовов в секунду на всех
+(как общий лимит Telegram). Каждый чат присылает /start (фото + приветствие)
+и контакт текстом (удаление сообщения, «✅ Контакт добавлен!», экран
+следующего шага). Смотрим, через сколько обрабатывается апдейт (p50/p95 от
+приёма до конца хендлера) и сколько вызовов API ушло на косметику
+(фото и удаления, включая отложенные удаления временных сообщений).
+
+    python scripts/bench_shedding.py --chats 300 --api-rate 200
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from types import SimpleNamespace as NS
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("KP_SESSION_DB", "")
+os.environ.setdefault("KP_SESSION_JOURNAL", "")
+os.environ.setdefault("KP_RATE_GLOBAL", "0")
+os.environ.setdefault("KP_EDIT_WINDOW", "0")
+os.environ.setdefault("KP_MEDIA_IDS", "")
+
+import main  # noqa: E402
+from kp_bot import runtime  # noqa: E402
+from kp_bot.actors import ChatDispatcher  # noqa: E402
+from kp_bot.edits import EditCoalescer  # noqa: E402
+from kp_bot.shedding import LoadShedder  # noqa: E402
+
+
+class FakeApi:
+    """Bot API с общей пропускной способностью rate вызовов/с."""
+
+    def __init__(self, rate: float):
+        self.per_call = 1.0 / rate
+        self.lock = threading.Lock()
+        self.calls = Counter()
+
+    def __getattr__(self, name):
+        async def call(*args, **kwargs):
+            with self.lock:
+                time.sleep(self.per_call)
+                self.calls[name] += 1
+            return NS(message_id=1, chat=NS(id=args[0] if args else 0), photo=[NS(file_id="PHOTO")])
+        return call
+
+
+def run(n_chats: int, api_rate: float, workers: int, shed: bool):
+    main.api = api = FakeApi(api_rate)
+    main.LOAD = load = LoadShedder(main.SHED_LATENCY_MS / 1000, enabled=shed)
+    chats = ChatDispatcher(workers, max_per_chat=10, observer=load.observe)
+    main.CHATS = chats
+    main.EDITS = EditCoalescer(main._edit_message, min_interval=main.EDIT_WINDOW, submit=chats.submit)
+    load.add_gauge("chat_backlog", lambda: chats.backlog, main.SHED_DEPTH)
+    lat = []
+    lock = threading.Lock()
+
+    def timed(fn, m, queued):
+        async def job():
+            await fn(m)
+            with lock:
+                lat.append(time.perf_counter() - queued)
+        return job()
+
+    user = NS(username="client", id=0)
+    t0 = time.perf_counter()
+    for ch in range(1, n_chats + 1):
+        start = NS(chat=NS(id=ch), message_id=10, text="/start", from_user=user)
+        chats.submit(ch, timed, main.on_start, start, time.perf_counter())
+    for ch in range(1, n_chats + 1):
+        contact = NS(chat=NS(id=ch), message_id=11, text="+7 999 123-45-67", from_user=user)
+        chats.submit(ch, timed, main.in_contacts, contact, time.perf_counter())
+    chats.close(timeout=3600)
+    dt = time.perf_counter() - t0
+    while runtime.SCHEDULER.stats()["depth"]:      # отложенные удаления «✅ …» — тоже работа этого прогона
+        time.sleep(0.1)
+    time.sleep(0.5)
+    lat.sort()
+    cosmetic = api.calls["send_photo"] + api.calls["delete_message"]
+    return dt, lat, api.calls, cosmetic, load.stats()
+
+
+def main_cli():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--chats", type=int, default=300)
+    ap.add_argument("--api-rate", type=float, default=200.0, help="вызовов Bot API в секунду на всех")
+    ap.add_argument("--workers", type=int, default=8)
+    args = ap.parse_args()
+
+    logging.getLogger("kp-bot-branch").setLevel(logging.WARNING)
+    runtime.MODE = "sync"
+    photo = tempfile.NamedTemporaryFile(suffix=".jpg", delete=False)
+    photo.write(b"\xff\xd8fake")
+    photo.close()
+    main.WELCOME_PHOTO = photo.name
+
+    print(f"chats={args.chats} api_rate={args.api_rate:.0f}/s workers={args.workers} "
+          f"shed_depth={main.SHED_DEPTH} shed_latency={main.SHED_LATENCY_MS:.0f}ms")
+    print(f"{'shedding':<10}{'total s':>9}{'p50 ms':>9}{'p95 ms':>9}{'api calls':>11}{'cosmetic':>10}")
+    for shed in (False, True):
+        dt, lat, calls, cosmetic, st = run(args.chats, args.api_rate, args.workers, shed)
+        print(f"{'on' if shed else 'off':<10}{dt:>9.2f}{lat[len(lat) // 2] * 1000:>9.0f}"
+              f"{lat[int(len(lat) * .95)] * 1000:>9.0f}{sum(calls.values()):>11}{cosmetic:>10}")
+        if shed:
+            print(f"  shedder: raised={st['raised']} shed={st['shed']}")
+    os.unlink(photo.name)
+
+
+if __name__ == "__main__":
+    main_cli()
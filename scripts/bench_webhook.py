@@ -0,0 +1,119 @@
+# scripts/bench_webhook.py
+"""
+Сквозная задержка webhook-режима под нагрузкой.
+
+Поднимает WebhookServer на локальном порту с настоящими хендлерами main.py,
+а «фейковый Telegram» шлёт в него POST'ы с апдейтами (нажатия opt::) с заданной
+частотой. Bot API подменён FakeApi из bench_runtime (задержка --latency мс).
+
+    python scripts/bench_webhook.py --rate 600 --seconds 5 --workers 32 --latency 20
+"""
+import argparse
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("KP_SESSION_DB", "")
+os.environ.setdefault("KP_SESSION_JOURNAL", "")
+os.environ["KP_BOT_MODE"] = "sync"
+os.environ["KP_BOT_INGEST"] = "webhook"
+
+import main  # noqa: E402
+from kp_bot import runtime  # noqa: E402
+from kp_bot.webhook import WebhookServer  # noqa: E402
+from bench_runtime import FakeApi, make_updates  # noqa: E402
+
+SECRET = "bench-secret"
+
+
+def update_json(uid: int, c) -> bytes:
+    ch = c.message.chat.id
+    return json.dumps({
+        "update_id": uid,
+        "callback_query": {
+            "id": str(uid), "chat_instance": str(ch), "data": c.data,
+            "from": {"id": ch, "is_bot": False, "first_name": "Bench"},
+            "message": {"message_id": c.message.message_id, "date": 0,
+                        "chat": {"id": ch, "type": "private"}},
+        },
+    }).encode()
+
+
+def sender(port: int, bodies, rate_per_thread: float, rtts: list, codes: dict):
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    interval = 1.0 / rate_per_thread
+    nxt = time.perf_counter()
+    for body in bodies:
+        delay = nxt - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        nxt += interval
+        t0 = time.perf_counter()
+        conn.request("POST", "/webhook", body, {
+            "Content-Type": "application/json",
+            "X-Telegram-Bot-Api-Secret-Token": SECRET,
+        })
+        r = conn.getresponse()
+        r.read()
+        rtts.append(time.perf_counter() - t0)
+        codes[r.status] = codes.get(r.status, 0) + 1
+    conn.close()
+
+
+def main_cli():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rate", type=float, default=600, help="апдейтов в секунду от фейкового Telegram")
+    ap.add_argument("--seconds", type=float, default=5)
+    ap.add_argument("--chats", type=int, default=2000)
+    ap.add_argument("--senders", type=int, default=8, help="параллельных соединений отправителя")
+    ap.add_argument("--workers", type=int, default=32)
+    ap.add_argument("--batch", type=int, default=16)
+    ap.add_argument("--queue", type=int, default=5000)
+    ap.add_argument("--latency", type=float, default=20.0, help="мс на вызов Bot API")
+    args = ap.parse_args()
+
+    import logging
+    logging.getLogger("kp-bot-branch").setLevel(logging.WARNING)
+
+    total = int(args.rate * args.seconds)
+    updates = make_updates(total, args.chats)
+    bodies = [update_json(i + 1, c) for i, c in enumerate(updates)]
+
+    main.api = FakeApi(args.latency / 1000.0, "sync")
+    runtime.install(main.bot, main.handlers)
+    server = WebhookServer(main.bot.process_new_updates, secret=SECRET, port=0,
+                           workers=args.workers, queue_size=args.queue, batch=args.batch)
+    server.start()
+
+    rtts, codes = [], {}
+    per = [bodies[i::args.senders] for i in range(args.senders)]
+    threads = [threading.Thread(target=sender, args=(server.port, p, args.rate / args.senders, rtts, codes))
+               for p in per]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    sent_dt = time.perf_counter() - t0
+    while server.queue.qsize() or server.processed + server.failed < codes.get(200, 0):
+        time.sleep(0.01)
+    done_dt = time.perf_counter() - t0
+    server.stop()
+
+    rtts.sort()
+    st = server.stats()
+    print(f"sent {total} updates in {sent_dt:.2f}s ({total / sent_dt:.0f}/s), all processed in {done_dt:.2f}s "
+          f"({st['processed'] / done_dt:.0f}/s)")
+    print(f"http codes: {codes}")
+    print(f"POST rtt p50={rtts[len(rtts) // 2] * 1000:.1f}ms p99={rtts[int(len(rtts) * .99)] * 1000:.1f}ms")
+    print(f"server: {st}")
+
+
+if __name__ == "__main__":
+    main_cli()